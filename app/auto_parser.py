@@ -1,16 +1,30 @@
+import asyncio
+import copy
+import hashlib
 import logging
+import io
 import os
-from PIL import Image
+import shutil
+import zipfile
 import pypandoc
 from fastapi import FastAPI
-from docx import Document
 from docx.document import Document as _Document
 from docx.oxml.text.paragraph import CT_P
 from docx.oxml.table import CT_Tbl
 from docx.table import Table as _Table
 from docx.text.paragraph import Paragraph
+from lxml import etree
 import re
-import subprocess
+
+from app import media_store, subproc
+from app.config import IMG_DIR, PANDOC_CONCURRENCY, PANDOC_CONCURRENCY_PER_REQUEST, PANDOC_TIMEOUT
+from app.docx_package import DOC_RELS, DOC_XML, Definitions, read_document_rels, zip_target
+from app.mathtype import find_equations
+from app.media import extract_media, load_media, publish_media
+from app.parse_cache import parse_cache, resolve_media, tokenize_media
+from app.rows import QuestionRow
+from app.tracing import span
+
 app = FastAPI()
 logger = logging.getLogger(__name__)
 
@@ -25,112 +39,429 @@ def iter_block_items(parent):
         elif isinstance(child, CT_Tbl):
             yield _Table(child, parent)
 
-def split_docx_into_questions(input_path: str, output_dir: str) -> list[str]:
-    os.makedirs(output_dir, exist_ok=True)
-    doc = Document(input_path)
-    header_re = re.compile(r'^\d+\.?\s*задани', re.IGNORECASE)
-    blocks = list(iter_block_items(doc))
-    starts = [i for i, b in enumerate(blocks)
-              if isinstance(b, Paragraph) and header_re.match(b.text.strip())]
-    if not starts:
-        raise ValueError("Заголовки заданий не найдены")
-    ranges = [
-        (s, starts[idx+1]-1 if idx+1 < len(starts) else len(blocks)-1)
-        for idx, s in enumerate(starts)
-    ]
-    out_paths = []
-    for num, (s, e) in enumerate(ranges, start=1):
-        part = Document(input_path)
-        body = part.element.body
-        elems = list(body)
-        for i in range(len(elems)-1, -1, -1):
-            if i < s or i > e:
-                if elems[i].tag.endswith('}sectPr'):
+R_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# Части архива, которые копируются в вопрос, только если он на них ссылается
+_PER_PART_PREFIXES = ("word/media/", "word/embeddings/")
+_HEADER_RE = re.compile(r'^\d+\.?\s*задани', re.IGNORECASE)
+
+# Служебная разметка Word, которая меняется от сохранения к сохранению
+# и не влияет на содержимое вопроса
+_VOLATILE_TAGS = ("}proofErr", "}bookmarkStart", "}bookmarkEnd", "}lastRenderedPageBreak")
+_VOLATILE_ATTRS = ("rsid", "paraId", "textId")
+_DRAWING_ID_TAGS = ("}docPr", "}cNvPr")
+
+
+def fingerprint_block(elems, rels: dict, member_sha,
+                      definitions: Definitions | None = None) -> tuple[str, dict]:
+    """
+    Нормализованный отпечаток блока вопроса: sha256 от XML его элементов
+    (без rsid, закладок и id рисунков) и байтов связанных медиа вместо r:id.
+    Одинаковые вопросы из разных файлов дают одинаковый отпечаток.
+    member_sha(target) — sha256 части архива по Target связи.
+    definitions — нумерация и стили документа: numId и id стилей заменяются
+    отпечатками их определений (Definitions.resolve).
+    Возвращает (отпечаток, {Target медиа: sha256}).
+    """
+    h = hashlib.sha256()
+    media = {}
+    for el in elems:
+        el = copy.deepcopy(el)
+        for node in list(el.iter()):
+            if not isinstance(node.tag, str) or node.tag.endswith(_VOLATILE_TAGS):
+                node.getparent().remove(node)
+                continue
+            if definitions is not None:
+                definitions.resolve(node)
+            for key in list(node.attrib):
+                local = key.rsplit("}", 1)[-1]
+                if local.startswith(_VOLATILE_ATTRS) or (
+                        node.tag.endswith(_DRAWING_ID_TAGS) and local in ("id", "name")):
+                    del node.attrib[key]
+                elif key.startswith(R_NS):
+                    rel = rels.get(node.attrib[key])
+                    if rel is None:
+                        continue
+                    target, external = rel
+                    if external:
+                        node.attrib[key] = target
+                        continue
+                    sha = member_sha(target)
+                    media[target] = sha
+                    node.attrib[key] = sha
+        h.update(etree.tostring(el))
+    return h.hexdigest(), media
+
+
+def _paragraph_text(p) -> str:
+    return "".join(p.itertext(W_NS + "t"))
+
+
+def _prune_rels(rels_xml: bytes, used: set) -> bytes:
+    """Убирает связи с медиа и OLE-объектами, на которые часть не ссылается."""
+    root = etree.fromstring(rels_xml)
+    for r in list(root):
+        target = r.get("Target", "")
+        if r.get("TargetMode") == "External" or target in used:
+            continue
+        if zip_target(target).startswith(_PER_PART_PREFIXES):
+            root.remove(r)
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+
+def _write_part(zin: zipfile.ZipFile, dest, doc_xml: bytes, rels_xml: bytes | None, used: set) -> None:
+    """
+    Собирает .docx вопроса: document.xml вопроса, урезанные связи и только
+    его медиа; остальные части архива копируются потоково.
+    """
+    used_members = {zip_target(t) for t in used}
+    with zipfile.ZipFile(dest, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            name = info.filename
+            if name.startswith(_PER_PART_PREFIXES) and name not in used_members:
+                continue
+            zi = zipfile.ZipInfo(name, info.date_time)
+            zi.compress_type = info.compress_type
+            if name == DOC_XML:
+                zout.writestr(zi, doc_xml)
+            elif name == DOC_RELS and rels_xml is not None:
+                zout.writestr(zi, _prune_rels(rels_xml, used))
+            else:
+                with zin.open(info) as fsrc, zout.open(zi, "w") as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1 << 16)
+
+
+def _body_sectpr(zin: zipfile.ZipFile):
+    """
+    Параметры страниц документа — w:sectPr, последний элемент body.
+    Отдельный потоковый проход: части пишутся раньше, чем разбор доходит
+    до конца body, а параметры нужны каждой (без них pandoc и LibreOffice
+    берут страницу по умолчанию). None — документ без sectPr.
+    """
+    body = sect_pr = None
+    with zin.open(DOC_XML) as xml_stream:
+        for event, el in etree.iterparse(xml_stream, events=("start", "end")):
+            if event == "start":
+                if body is None and el.tag == W_NS + "body":
+                    body = el
+                continue
+            if body is not None and el.getparent() is body:
+                if el.tag == W_NS + "sectPr":
+                    sect_pr = el
+                body.remove(el)
+    return sect_pr
+
+
+def split_docx_into_parts(input_path, output_dir: str | None, skip=None) -> list[dict]:
+    """
+    Делит документ на вопросы по заголовкам «N задание».
+    word/document.xml читается из архива потоково (iterparse): элементы body
+    переносятся в часть текущего вопроса и сохраняются, как только начинается
+    следующий заголовок, так что в памяти держится не больше одного вопроса.
+    Возвращает [{"path", "fingerprint", "media"}]; для частей, на которых
+    skip(part) вернул True, файл не сохраняется (path=None) — их результат
+    берётся из прошлого разбора или кэша. Каждая сохранённая часть получает
+    копию sectPr документа; в отпечаток он не входит.
+    input_path — путь или файловый объект; при output_dir=None части
+    не пишутся на диск, а кладутся в part["data"] байтами.
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    parts = []
+    with zipfile.ZipFile(input_path) as zin:
+        rels = read_document_rels(zin)
+        try:
+            rels_xml = zin.read(DOC_RELS)
+        except KeyError:
+            rels_xml = None
+        shas: dict[str, str] = {}
+        definitions = Definitions(zin)
+
+        def member_sha(target: str) -> str:
+            if target not in shas:
+                h = hashlib.sha256()
+                try:
+                    with zin.open(zip_target(target)) as f:
+                        for chunk in iter(lambda: f.read(1 << 16), b""):
+                            h.update(chunk)
+                except KeyError:
+                    h.update(target.encode())
+                shas[target] = h.hexdigest()
+            return shas[target]
+
+        root = body = None
+        shell = shell_body = None
+        sect_pr = False  # sectPr документа; читается при первой сохраняемой части
+
+        def close_part():
+            nonlocal sect_pr
+            num = len(parts) + 1
+            fingerprint, media = fingerprint_block(list(shell_body), rels, member_sha, definitions)
+            info = {"path": None, "data": None, "fingerprint": fingerprint, "media": media}
+            if skip is None or not skip(info):
+                if sect_pr is False:
+                    sect_pr = _body_sectpr(zin)
+                if sect_pr is not None:
+                    shell_body.append(copy.deepcopy(sect_pr))
+                doc_xml = etree.tostring(shell, xml_declaration=True, encoding="UTF-8", standalone=True)
+                if output_dir is None:
+                    buf = io.BytesIO()
+                    _write_part(zin, buf, doc_xml, rels_xml, set(media))
+                    info["data"] = buf.getvalue()
+                else:
+                    out_file = os.path.join(output_dir, f"question{num}.docx")
+                    _write_part(zin, out_file, doc_xml, rels_xml, set(media))
+                    info["path"] = out_file
+            parts.append(info)
+
+        with zin.open(DOC_XML) as xml_stream:
+            for event, el in etree.iterparse(xml_stream, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = el
+                    elif body is None and el.tag == W_NS + "body":
+                        body = el
+                    continue
+                if body is None or el.getparent() is not body:
                     continue
-                body.remove(elems[i])
-        out_file = os.path.join(output_dir, f"question{num}.docx")
-        part.save(out_file)
-        out_paths.append(out_file)
-    return out_paths
+                if el.tag == W_NS + "sectPr":
+                    body.remove(el)  # в части идёт копия из _body_sectpr
+                    continue
+                if el.tag == W_NS + "p" and _HEADER_RE.match(_paragraph_text(el).strip()):
+                    if shell is not None:
+                        close_part()
+                    shell = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+                    shell_body = etree.SubElement(shell, body.tag)
+                if shell is None:
+                    body.remove(el)  # текст до первого задания
+                else:
+                    shell_body.append(el)  # переносит элемент из дерева разбора
+        if shell is not None:
+            close_part()
+
+    if not parts:
+        raise ValueError("Заголовки заданий не найдены")
+    return parts
+
+
+def split_docx_into_questions(input_path: str, output_dir: str) -> list[str]:
+    return [p["path"] for p in split_docx_into_parts(input_path, output_dir)]
+
+
+PANDOC_TO = "markdown+tex_math_dollars"
+
+
+def _pandoc_args(part: dict) -> list[str]:
+    # Путь — pandoc читает файл сам, часть в памяти идёт через stdin
+    args = [pypandoc.get_pandoc_path(), "-f", "docx", "-t", PANDOC_TO, "--wrap=none"]
+    return args + [part["path"]] if part["path"] is not None else args
+
+
+def docx_to_markdown(part: dict) -> str:
+    # Часть в памяти pandoc получает через stdin
+    proc = subproc.run(_pandoc_args(part), PANDOC_TIMEOUT, input=part["data"], check=False)
+    if proc.returncode != 0:
+        raise RuntimeError(f"pandoc: {proc.stderr.decode('utf-8', 'replace').strip()}")
+    return proc.stdout.decode("utf-8").strip()
+
+
+# Общий на процесс лимит одновременных pandoc; семафор привязан к циклу событий
+_pandoc_slots: tuple[asyncio.AbstractEventLoop, asyncio.Semaphore] | None = None
+
+
+def _global_pandoc_slots() -> asyncio.Semaphore:
+    global _pandoc_slots
+    loop = asyncio.get_running_loop()
+    if _pandoc_slots is None or _pandoc_slots[0] is not loop:
+        _pandoc_slots = (loop, asyncio.Semaphore(PANDOC_CONCURRENCY))
+    return _pandoc_slots[1]
+
+
+async def docx_to_markdown_async(part: dict) -> str:
+    """То же, что docx_to_markdown, но pandoc — асинхронный подпроцесс."""
+    async with _global_pandoc_slots():
+        proc = await subproc.run_async(_pandoc_args(part), PANDOC_TIMEOUT,
+                                       input=part["data"], check=False)
+    if proc.returncode != 0:
+        raise RuntimeError(f"pandoc: {proc.stderr.decode('utf-8', 'replace').strip()}")
+    return proc.stdout.decode("utf-8").strip()
+
+
+def _previous_media(parts: list[dict], reused: dict, previous: dict, img_dir: str) -> dict:
+    """
+    Медиа, на которые ссылаются только блоки из прошлого разбора: их файлы,
+    уже сконвертированные прошлой загрузкой, читаются из img_dir вместо
+    повторной конвертации (имя в архиве могло смениться, содержимое — нет).
+    Возвращает {путь в архиве: (имя прошлого файла, байты)}.
+    """
+    fresh = {t for p in parts if p["fingerprint"] not in reused for t in p["media"]}
+    kept: dict[str, tuple[str, bytes]] = {}
+    for part in parts:
+        if part["fingerprint"] not in reused:
+            continue
+        files = previous.get(part["fingerprint"], {}).get("files") or {}
+        for target, sha in part["media"].items():
+            member = zip_target(target)
+            name = files.get(sha)
+            if name is None or target in fresh or member in kept:
+                continue
+            name = os.path.basename(name)
+            try:
+                with open(os.path.join(img_dir, name), "rb") as f:
+                    kept[member] = (name, f.read())
+            except OSError:
+                continue  # файл уже удалён — сконвертируется заново
+    return kept
 
 
-def split_questions_logic(src: str) -> list[dict]:
-    tmp = os.path.dirname(src)
-    docname = os.path.splitext(os.path.basename(src))[0]
+def _split_for_parse(src, previous: dict | None, docname: str | None) -> dict:
+    """
+    Общая часть разбора: формулы и части документа. Возвращает контекст
+    {"src", "docname", "img_dir", "equations", "previews", "parts", "reused", "kept"};
+    reused — {fingerprint: markdown с метками медиа} для частей без pandoc.
+    Медиа извлекает _extract_for_parse.
+    """
+    previous = previous or {}
+    reused: dict[str, str] = {}
+    in_memory = not isinstance(src, str)
+    if docname is None:
+        docname = os.path.splitext(os.path.basename(src))[0]
     docname = docname.replace(' ', '_')  # Нормализация имени документа
+    img_dir = os.path.join(IMG_DIR, docname)
+
+    # 1) Формулы MathType → LaTeX; их превью не извлекаются
+    with span("mathtype"):
+        equations, previews = find_equations(src)
+
+    # 2) Разбиваем на части; неизменившиеся берут markdown из прошлого разбора или кэша
+    subproc.check_cancelled()
+    parts_dir = None if in_memory else os.path.join(os.path.dirname(src), "parts")
+    def lookup(part: dict) -> bool:
+        fp = part["fingerprint"]
+        md = previous.get(fp, {}).get("markdown")
+        if md is None:
+            md = parse_cache.get_markdown(fp, part["media"])
+            if md is not None:
+                md = tokenize_media(md, part["media"])
+        if md is not None:
+            reused[fp] = md
+        return md is not None
+
+    with span("split_docx"):
+        parts = split_docx_into_parts(src, parts_dir, skip=lookup)
+    # Картинки только неизменившихся вопросов берутся готовыми из прошлой загрузки
+    kept = _previous_media(parts, reused, previous, img_dir)
+    return {"src": src, "docname": docname, "img_dir": img_dir, "equations": equations,
+            "previews": previews, "parts": parts, "reused": reused, "kept": kept}
+
+
+def _extract_for_parse(ctx: dict) -> None:
+    """
+    Извлекает и конвертирует медиа прямо из архива; кладёт в контекст
+    media_map и media_files (буферы для публикации, если разбор в памяти).
+    """
+    subproc.check_cancelled()
+    src, kept = ctx["src"], ctx.pop("kept")
+    media_files = None
+    with span("extract_media", kept=len(kept)):
+        if isinstance(src, str):
+            media_map = extract_media(src, ctx["img_dir"], ctx["docname"], skip=ctx["previews"], kept=kept)
+        else:
+            media_map, media_files = load_media(src, ctx["docname"], skip=ctx["previews"], kept=kept)
+    ctx["media_map"], ctx["media_files"] = media_map, media_files
 
-    # 1) Разбиваем на части
-    parts_dir = os.path.join(tmp, "parts")
-    part_paths = split_docx_into_questions(src, parts_dir)
 
-    # 2) Готовим папку для медиафайлов
-    media_dir = os.path.join(tmp, "media")
-    os.makedirs(media_dir, exist_ok=True)
+def _question(ctx: dict, idx: int, part: dict, md: str | None) -> dict:
+    """
+    Вопрос из сконвертированной части (md) или из переиспользованного
+    markdown (md=None). Кроме итогового текста несёт markdown с метками
+    медиа и {sha256 медиа: имя файла} — для следующего разбора документа.
+    """
+    fp = part["fingerprint"]
+    if md is None:
+        md = resolve_media(ctx["reused"][fp], part["media"])
+    else:
+        part["data"] = None
+        parse_cache.put_markdown(fp, md, part["media"])
+    # 4) Ссылки на медиа → итоговые URL текущей версии документа
+    text = normalize_image_links(md, ctx["docname"], ctx["media_map"], ctx["equations"])
+    media_map = ctx["media_map"]
+    files = {sha: os.path.basename(media_map[target])
+             for target, sha in part["media"].items() if target in media_map}
+    return {"number": idx, "text": text, "fingerprint": fp,
+            "markdown": tokenize_media(md, part["media"]), "files": files}
+
 
+def _publish(ctx: dict, questions: list[dict]) -> None:
+    if ctx["media_files"] is not None:
+        with span("publish_media"):
+            publish_media(ctx["media_files"], ctx["img_dir"])
+    media_store.commit(ctx["docname"], [q["text"] for q in questions], ctx["media_map"].values())
+
+
+def split_questions_logic(src, previous: dict | None = None, docname: str | None = None) -> list[dict]:
+    """
+    previous — {fingerprint: {"markdown", "files", ...}} из прошлого разбора
+    того же документа; неизменившиеся вопросы не идут через pandoc, а их
+    картинки — через конвертацию.
+    Вопросы, уже встречавшиеся в других файлах, берутся из parse_cache.
+    Медиа документа извлекаются один раз в static/img/<docname>.
+    src — путь к .docx или файловый объект (BytesIO) с указанным docname:
+    тогда части, pandoc и медиа работают в памяти, без временных файлов,
+    а медиа публикуются в static/img только после разбора всех вопросов.
+    """
+    ctx = _split_for_parse(src, previous, docname)
+    _extract_for_parse(ctx)
     questions: list[dict] = []
-    for idx, path in enumerate(part_paths, start=1):
-        # 3) Конвертация в Markdown с извлечением медиа
-        md = pypandoc.convert_file(
-            path,
-            to="markdown+tex_math_dollars",
-            format="docx",
-            extra_args=[
-                "--wrap=none",
-                #f"--extract-media={media_dir}"
-            ],
-        ).strip()
-
-        # 4) Конвертация и нормализация изображений
-        for root, _, files in os.walk(media_dir):
-            for name in files:
-                try:
-                    src_path = os.path.join(root, name)
-
-                    # Нормализация имени файла
-                    normalized_name = name.replace(' ', '_')
-                    if normalized_name != name:
-                        normalized_path = os.path.join(root, normalized_name)
-                        os.rename(src_path, normalized_path)
-                        src_path = normalized_path
-                        name = normalized_name
-
-                    base, ext = os.path.splitext(name)
-                    dst_path = os.path.join(root, f"{base}.jpg")
-
-                    # Конвертация WMF/EMF через LibreOffice
-                    if ext.lower() in ['.emf', '.wmf']:
-                        subprocess.run([
-                            "libreoffice",
-                            "--headless",
-                            "--convert-to", "png",
-                            src_path,
-                            "--outdir", root
-                        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                        os.remove(src_path)
-                        src_path = os.path.join(root, f"{base}.png")
-
-                    # Конвертация в JPEG через PIL
-                    if not src_path.endswith('.jpg'):
-                        img = Image.open(src_path)
-                        rgb_img = img.convert('RGB')
-                        final_name = f"{base.replace(' ', '_')}.jpg"
-                        final_path = os.path.join(root, final_name)
-                        rgb_img.save(final_path, 'JPEG')
-                        if src_path != final_path:
-                            os.remove(src_path)
-
-                except Exception as e:
-                    logger.warning(f"Ошибка обработки {src_path}: {str(e)}")
-
-        # 5) Нормализация ссылок в Markdown
-        real_md = md
-        md = normalize_image_links(md, docname)
-
-        questions.append({
-            "number": idx,
-            "text": md,
-        })
+    for idx, part in enumerate(ctx["parts"], start=1):
+        md = None
+        if part["path"] is not None or part["data"] is not None:
+            # 3) Конвертация в Markdown
+            with span("pandoc", cat="subprocess", part=idx):
+                md = docx_to_markdown(part)
+        questions.append(_question(ctx, idx, part, md))
+    _publish(ctx, questions)
+    return questions
+
 
+async def split_questions_logic_async(src, previous: dict | None = None, docname: str | None = None,
+                                      on_question=None) -> list[dict]:
+    """
+    То же, что split_questions_logic, но части конвертируются параллельно:
+    не больше PANDOC_CONCURRENCY_PER_REQUEST pandoc на документ и
+    PANDOC_CONCURRENCY на процесс. on_question(question) вызывается по мере
+    готовности каждого вопроса (в порядке завершения), так что пайплайн
+    идёт одновременно с конвертацией оставшихся частей. Медиа извлекаются
+    и конвертируются в отдельном потоке одновременно с pandoc; вопрос
+    собирается, когда готовы и его markdown, и медиа документа.
+    """
+    ctx = await asyncio.to_thread(_split_for_parse, src, previous, docname)
+    media = asyncio.ensure_future(asyncio.to_thread(_extract_for_parse, ctx))
+    parts = ctx["parts"]
+    questions: list[dict | None] = [None] * len(parts)
+    slots = asyncio.Semaphore(PANDOC_CONCURRENCY_PER_REQUEST)
+
+    async def convert(idx: int, part: dict) -> None:
+        md = None
+        if part["path"] is not None or part["data"] is not None:
+            async with slots:
+                with span("pandoc", cat="subprocess", part=idx):
+                    md = await docx_to_markdown_async(part)
+        await asyncio.shield(media)  # отмена вопроса не снимает общую конвертацию медиа
+        questions[idx - 1] = q = _question(ctx, idx, part, md)
+        if on_question is not None:
+            on_question(q)
+
+    tasks = [asyncio.ensure_future(convert(idx, part)) for idx, part in enumerate(parts, start=1)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Поток медиа не отменить — ждём его, чтобы он не писал после ответа
+        await asyncio.gather(media, *tasks, return_exceptions=True)
+        raise
+    _publish(ctx, questions)
     return questions
 
 LETTER_TO_INDEX = {"A": 0, "B": 1, "C": 2, "D": 3}
@@ -648,19 +979,30 @@ def extract_quarter(state: dict) -> dict:
     return new
 
 # Собирающая функция
-def pipeline_mcq(raw_item) -> dict:
+MCQ_STEPS = (
+    extract_number_and_vopros,
+    extract_temy,
+    extract_otvety,
+    extract_prav_otv,
+    extract_exp,
+    extract_target,
+    extract_difficulty,
+    extract_quarter,
+)
+
+
+def run_steps(raw_item, steps) -> dict:
     st = wrap_raw(raw_item)
-    st = extract_number_and_vopros(st)
-    st = extract_temy(st)
-    st = extract_otvety(st)
-    st = extract_prav_otv(st)
-    st = extract_exp(st)
-    st = extract_target(st)
-    st = extract_difficulty(st)
-    st = extract_quarter(st)
+    for step in steps:
+        with span(step.__name__, cat="pipeline"):
+            st = step(st)
     return st
 
 
+def pipeline_mcq(raw_item) -> dict:
+    return run_steps(raw_item, MCQ_STEPS)
+
+
 
 def extract_matching_number_and_vopros(state: dict) -> dict:
     """
@@ -782,32 +1124,63 @@ def extract_matching_pravotv(st: dict) -> dict:
     st["pravOtv"] = prav
     return st
 
+MATCHING_STEPS = (
+    extract_matching_number_and_vopros,
+    extract_temy,
+    extract_matching_options,
+    extract_matching_pravotv,
+    extract_exp,
+    extract_target,
+    extract_difficulty,
+    extract_quarter,
+)
+
+
 def pipeline_matching(raw_item) -> dict:
-    st = wrap_raw(raw_item)
-    st = extract_matching_number_and_vopros(st)
-    st = extract_temy(st)
-    st = extract_matching_options(st)
-    st = extract_matching_pravotv(st)
-    st = extract_exp(st)
-    st = extract_target(st)
-    st = extract_difficulty(st)
-    st = extract_quarter(st)
-    return st
+    return run_steps(raw_item, MATCHING_STEPS)
 
 
 
 
 
 
-def build_rows_with_placeholders(
+_OPTION_LINE_RE = re.compile(r'^\s*>?\s*[A-FА-Е]\\?\)')
+_PAIR_LINE_RE = re.compile(r'^\s*>?\s*\d+\\?[.)]\s+\S.*\s[A-E]\\?\)\s+\S')
+_DASHES_RE = re.compile(r'-{3,}')
+
+
+def detect_question_type(text: str) -> str:
+    """
+    Тип вопроса по markdown части: "matching", если есть пары «1. … A) …»
+    и разделитель из дефисов, иначе "mcq" (варианты A)–F) с начала строки).
+    """
+    lines = text.replace("\r", "").split("\n")
+    has_pairs = any(_PAIR_LINE_RE.match(ln) for ln in lines)
+    has_dashes = any(_DASHES_RE.search(ln) for ln in lines)
+    has_options = sum(1 for ln in lines if _OPTION_LINE_RE.match(ln)) >= 2
+    if has_pairs and (has_dashes or not has_options):
+        return "matching"
+    return "mcq"
+
+
+def pipeline_auto(raw_item) -> dict:
+    text = wrap_raw(raw_item)["text"]
+    kind = detect_question_type(text)
+    st = pipeline_matching(raw_item) if kind == "matching" else pipeline_mcq(raw_item)
+    st["question_type"] = kind
+    return st
+
+
+def build_rows(
     states: list[dict],
     subject: dict,
     language: str,
     klass: str,
-    tip: int) -> list[dict]:
+    tip: int,
+    question_type: str | None = None) -> list[QuestionRow]:
     """
     Из списка состояний (pipeline output) формирует итоговые строки с заглушками
-    для пропущенных номеров.
+    для пропущенных номеров. question_type — тип вопросов, если его нет в состоянии.
     """
     rows = []
     last_id = 0
@@ -818,92 +1191,43 @@ def build_rows_with_placeholders(
             # 1) Заглушки для пропущенных вопросов
             for missing in range(last_id + 1, curr_id):
                 logger.debug("Placeholder for missing question %d", missing)
-                rows.append({
-                    "id": missing,
-                    "id_predmet": 1,
-                    "subject": subject,
-                    "language": language,
-                    "klass": klass,
-                    "vopros": "вопрос не опознан",
-
-                    "temy_id": None,
-                    "temy_name": None,
-                    "podtemy_id": None,
-                    "podtemy_name": None,
-
-                    "target": "",
-                    "tip": tip,
-                    "texty": "",
-                    "otvety": ["", "", "", ""],
-                    "pravOtv": [],
-                    "exp": "",
-                    "difficulty": None,
-                    "quarter": None
-                })
+                rows.append(QuestionRow.placeholder(missing, subject, language, klass, tip))
 
             # 2) Собственно вопрос
-            rows.append({
-                "id": curr_id,
-                "id_predmet": 1,
-                "subject": subject,
-                "language": language,
-                "klass": klass,
-                "vopros": state.get("vopros", "вопрос не опознан"),
-
-
-                "temy_id": state.get("temy_id"),
-                "temy_name": state.get("temy_name"),
-                "podtemy_id": state.get("podtemy_id"),
-                "podtemy_name": state.get("podtemy_name"),
-
-
-                "target": state.get("target", ""),
-                "tip": tip,
-                "texty": "",
-                "otvety": state.get("otvety", ["", "", "", ""]),
-                "pravOtv": state.get("pravOtv", []),
-                "exp": state.get("exp", ""),
-                "difficulty": state.get("difficulty"),
-                "quarter": state.get("quarter")
-                #,"raw": state.get("raw")
-            })
-
+            rows.append(QuestionRow.from_state(state, subject, language, klass, tip, question_type))
             last_id = curr_id
 
         else:
             # Если номер не найден — просто возвращаем, что есть
             logger.debug("Unnumbered question, adding as-is")
-            rows.append({
-                "id": None,
-                "id_predmet": 1,
-                "subject": subject,
-                "language": language,
-                "klass": klass,
-                "vopros": state.get("vopros", "вопрос не опознан"),
-
-                "temy_id": state.get("temy_id"),
-                "temy_name": state.get("temy_name"),
-                "podtemy_id": state.get("podtemy_id"),
-                "podtemy_name": state.get("podtemy_name"),
-
-                "target": state.get("target", ""),
-                "tip": tip,
-                "texty": "",
-                "otvety": state.get("otvety", ["", "", "", ""]),
-                "pravOtv": state.get("pravOtv", []),
-                "exp": state.get("exp", ""),
-                "difficulty": state.get("difficulty"),
-                "quarter": state.get("quarter")
-                #,"raw": state.get("raw")
-            })
+            rows.append(QuestionRow.from_state(state, subject, language, klass, tip, question_type))
 
     return rows
 
 
+def build_rows_with_placeholders(
+    states: list[dict],
+    subject: dict,
+    language: str,
+    klass: str,
+    tip: int) -> list[dict]:
+    """То же, что build_rows, но строки — словари."""
+    return [row.to_dict() for row in build_rows(states, subject, language, klass, tip)]
+
+
+# Формулы $…$ и $$…$$ (LaTeX из MathType); \$ — экранированный доллар, не формула
+_MATH_SPAN = re.compile(r'(?<!\\)(\$\$(?:\\.|[^\\$])+\$\$|\$(?:\\.|[^\\$])+\$)')
+
+
 def clean_math_and_sub(s: str) -> str:
     if not s:
         return s
+    # Формулы не трогаем: в LaTeX обратные слэши — часть команд
+    parts = _MATH_SPAN.split(s)
+    return "".join(part if i % 2 else _clean_text(part) for i, part in enumerate(parts)).strip()
+
 
+def _clean_text(s: str) -> str:
     # 0) Убираем экранирующие слэши
     s = s.replace('\\', '')
 
@@ -925,25 +1249,47 @@ def clean_math_and_sub(s: str) -> str:
     s = re.sub(r'\s+\(', ' (', s)
     s = re.sub(r'\)\s+', ') ', s)
 
-    return s.strip()
+    return s
+
+
+def clean_row(row: QuestionRow) -> QuestionRow:
+    """Чистит математику в текстовых полях строки (MCQ — список, matching — группы)."""
+    row.vopros = clean_math_and_sub(row.vopros or "")
+    row.exp = clean_math_and_sub(row.exp or "")
+    if isinstance(row.otvety, dict):
+        for group_name, opts in row.otvety.items():
+            for key, val in list(opts.items()):
+                opts[key] = clean_math_and_sub(val)
+    else:
+        row.otvety = [clean_math_and_sub(opt) for opt in row.otvety or []]
+    return row
 
 
-def normalize_image_links(md: str, docname: str) -> str:
+def normalize_image_links(md: str, docname: str, media_map: dict | None = None,
+                          equations: dict | None = None) -> str:
     """
     Преобразует ![](media/filename.ext){...} в ![](/img/docname/filename.jpg),
-    удаляя width/height и расширение файла.
+    удаляя width/height. Если передан media_map из extract_media,
+    URL берётся из него точно, иначе угадывается по имени файла.
+    Превью формул из equations (find_equations) заменяются их LaTeX.
     """
     docname = docname.replace(' ', '_')  # Нормализуем имя директории
+    media_map = media_map or {}
+    equations = equations or {}
 
     def replacer(match):
         filepath = match.group(1)
+        if filepath in equations:
+            return equations[filepath]
+        if filepath in media_map:
+            return f"![]({media_map[filepath]})"
         filename = os.path.basename(filepath).replace(' ', '_')
         base, _ = os.path.splitext(filename)
         return f"![](/img/{docname}/{base}.jpg)"
 
     # Удаляем width/height
     return re.sub(
-        r'!\[\]\((.*?)\)\s*\{[^}]*\}',
+        r'!\[[^\]]*\]\((.*?)\)(?:\s*\{[^}]*\})?',
         replacer,
         md
-    )
\ No newline at end of file
+    )
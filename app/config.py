@@ -0,0 +1,126 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, "data"))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+IMG_DIR = os.path.join(STATIC_DIR, "img")
+
+# Инкрементальный повторный разбор: результаты прошлых загрузок по имени документа
+INCREMENTAL_PARSE = os.getenv("INCREMENTAL_PARSE", "1") == "1"
+PARSE_STATE_DIR = os.getenv("PARSE_STATE_DIR", os.path.join(DATA_DIR, "parsed"))
+
+# Общий кэш разбора вопросов (markdown и состояния пайплайна), число записей
+PARSE_CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", "5000"))
+
+# Разбор без временных файлов: загрузка, части и медиа держатся в памяти.
+# Документы больше лимита всё равно разбираются через диск.
+PARSE_IN_MEMORY = os.getenv("PARSE_IN_MEMORY", "0") == "1"
+PARSE_IN_MEMORY_MAX_MB = int(os.getenv("PARSE_IN_MEMORY_MAX_MB", "50"))
+
+# Внешние программы; pandoc задаётся через PYPANDOC_PANDOC (читает pypandoc)
+LIBREOFFICE_BIN = os.getenv("LIBREOFFICE_BIN", "libreoffice")
+
+# Трассировка запросов в формате Chrome trace: доля случайно трассируемых
+# запросов (заголовок X-Trace: 1 включает её принудительно) и куда писать файлы
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_DIR = os.getenv("TRACE_DIR", os.path.join(DATA_DIR, "traces"))
+TRACE_MAX_FILES = int(os.getenv("TRACE_MAX_FILES", "200"))
+
+# Гибридный разбор (mode=hybrid): вопросы, у которых доля распознанных полей
+# (вопрос, варианты, правильный ответ) ниже порога, дораспознаются GPT по картинке
+HYBRID_MIN_SCORE = float(os.getenv("HYBRID_MIN_SCORE", "1.0"))
+HYBRID_RENDER_DPI = int(os.getenv("HYBRID_RENDER_DPI", "150"))
+
+# Пакетная отправка картинок заданий в GPT: картинок и оценочных
+# токенов изображений на один запрос (1 — по картинке на запрос)
+GPT_BATCH_MAX_IMAGES = int(os.getenv("GPT_BATCH_MAX_IMAGES", "6"))
+GPT_BATCH_MAX_TOKENS = int(os.getenv("GPT_BATCH_MAX_TOKENS", "12000"))
+
+# Вызовы GPT: дедлайн на вызов (с), перцентиль недавних задержек, после
+# которого уходит дубликат запроса (0 — без дубликатов), и его нижняя граница;
+# предохранитель размыкается после N ошибок подряд на COOLDOWN секунд
+GPT_TIMEOUT = float(os.getenv("GPT_TIMEOUT", "120"))
+GPT_HEDGE_PERCENTILE = float(os.getenv("GPT_HEDGE_PERCENTILE", "95"))
+GPT_HEDGE_MIN_DELAY = float(os.getenv("GPT_HEDGE_MIN_DELAY", "10"))
+GPT_BREAKER_FAILURES = int(os.getenv("GPT_BREAKER_FAILURES", "5"))
+GPT_BREAKER_COOLDOWN = float(os.getenv("GPT_BREAKER_COOLDOWN", "30"))
+
+# Одновременные процессы pandoc: на один документ и на весь процесс сервиса
+PANDOC_CONCURRENCY_PER_REQUEST = int(os.getenv("PANDOC_CONCURRENCY_PER_REQUEST", "4"))
+PANDOC_CONCURRENCY = int(os.getenv("PANDOC_CONCURRENCY", str(os.cpu_count() or 4)))
+
+# Внешние программы: таймауты вызова (с) и общий лимит одновременных процессов
+PANDOC_TIMEOUT = float(os.getenv("PANDOC_TIMEOUT", "60"))
+LIBREOFFICE_TIMEOUT = float(os.getenv("LIBREOFFICE_TIMEOUT", "90"))
+SUBPROCESS_MAX_CHILDREN = int(os.getenv("SUBPROCESS_MAX_CHILDREN", str(2 * (os.cpu_count() or 2))))
+
+# Как часто проверять, не отключился ли клиент во время разбора, секунды
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# Кэш конвертации EMF/WMF → JPEG по хэшу исходных байт (0 МБ — выключен)
+CONVERSION_CACHE_DIR = os.getenv("CONVERSION_CACHE_DIR", os.path.join(DATA_DIR, "conversions"))
+CONVERSION_CACHE_MAX_MB = int(os.getenv("CONVERSION_CACHE_MAX_MB", "200"))
+
+# Растеризация WMF/EMF: wmf2gd (libwmf-bin) и встроенный рендер EMF,
+# LibreOffice — только если они не справились
+WMF2GD_BIN = os.getenv("WMF2GD_BIN", "wmf2gd")
+WMF2GD_TIMEOUT = float(os.getenv("WMF2GD_TIMEOUT", "15"))
+RASTER_DPI = int(os.getenv("RASTER_DPI", "200"))
+RASTER_FONT_DIR = os.getenv("RASTER_FONT_DIR", "/usr/share/fonts/truetype/dejavu")
+
+# Формулы MathType (OLE Equation.*) → LaTeX вместо растеризации превью; нужен olefile
+MATHTYPE_TO_LATEX = os.getenv("MATHTYPE_TO_LATEX", "1") == "1"
+
+# Перекодирование картинок в JPEG: наибольшая сторона результата и предел
+# пикселей декодированного кадра (больше — картинка остаётся как есть)
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "2048"))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "40000000"))
+
+# Просмотр сохранённых разборов (/preview): база, сколько последних разборов
+# хранить (0 — не сохранять) и наибольший размер страницы
+PREVIEW_DB = os.getenv("PREVIEW_DB", os.path.join(DATA_DIR, "preview.sqlite"))
+PREVIEW_MAX_DOCUMENTS = int(os.getenv("PREVIEW_MAX_DOCUMENTS", "200"))
+PREVIEW_PAGE_MAX = int(os.getenv("PREVIEW_PAGE_MAX", "100"))
+
+# Индекс почти-дубликатов вопросов (MinHash/LSH): база, порог похожести
+# (оценка Жаккара по шинглам) и сколько похожих вопросов отдавать на строку
+DEDUP_INDEX = os.getenv("DEDUP_INDEX", "1") == "1"
+DEDUP_DB = os.getenv("DEDUP_DB", os.path.join(DATA_DIR, "dedup.sqlite"))
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+DEDUP_MAX_MATCHES = int(os.getenv("DEDUP_MAX_MATCHES", "5"))
+
+# Поисковый индекс вопросов (/search/questions): база и наибольший размер страницы
+SEARCH_INDEX = os.getenv("SEARCH_INDEX", "1") == "1"
+SEARCH_DB = os.getenv("SEARCH_DB", os.path.join(DATA_DIR, "search.sqlite"))
+SEARCH_PAGE_MAX = int(os.getenv("SEARCH_PAGE_MAX", "100"))
+
+# Хранилище медиа static/img: манифесты документов, квота на диск и срок
+# хранения неиспользуемых документов в днях (0 — выключены: выданные ссылки
+# /img живут, пока документ не перезагрузят) и период фоновой сборки мусора
+# в секундах (0 — выключена)
+MEDIA_MANIFEST_DIR = os.getenv("MEDIA_MANIFEST_DIR", os.path.join(DATA_DIR, "media"))
+MEDIA_QUOTA_MB = int(os.getenv("MEDIA_QUOTA_MB", "0"))
+MEDIA_TTL_DAYS = float(os.getenv("MEDIA_TTL_DAYS", "0"))
+MEDIA_GC_INTERVAL = int(os.getenv("MEDIA_GC_INTERVAL", "600"))
+
+# Сэмплирующий профилировщик (/debug/profile): снимков стеков в секунду
+# (0 — выключен), допустимая доля времени на снимки, сколько разных стеков
+# хранить. DEBUG_TOKEN — токен доступа к нему (X-Debug-Token; пустой — закрыт)
+PROFILER_HZ = float(os.getenv("PROFILER_HZ", "0"))
+PROFILER_MAX_OVERHEAD = float(os.getenv("PROFILER_MAX_OVERHEAD", "0.01"))
+PROFILER_MAX_STACKS = int(os.getenv("PROFILER_MAX_STACKS", "20000"))
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
+# Учёт памяти запросов /split*: период фонового замера RSS, секунды (0 — только
+# на границах этапов). Бюджет памяти воркера на одновременные разборы, МБ
+# (0 — без ограничения): оценка документа больше бюджета — отказ (413),
+# иначе документ ждёт свободного бюджета не дольше MEMORY_QUEUE_TIMEOUT (503).
+# MEMORY_XML_FACTOR — во сколько раз память разбора больше document.xml
+MEMORY_SAMPLE_INTERVAL = float(os.getenv("MEMORY_SAMPLE_INTERVAL", "0.05"))
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_QUEUE_TIMEOUT = float(os.getenv("MEMORY_QUEUE_TIMEOUT", "30"))
+MEMORY_XML_FACTOR = float(os.getenv("MEMORY_XML_FACTOR", "16"))
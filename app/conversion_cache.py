@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from app import metrics
+from app.config import CONVERSION_CACHE_DIR, CONVERSION_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionCache:
+    """
+    Дисковый кэш конвертации векторных картинок (EMF/WMF → JPEG) по sha256
+    исходных байт. Общий для всех документов и воркеров; при превышении
+    max_bytes удаляются давно не использованные файлы (по mtime).
+    Объём каталога воркер оценивает по своим записям, а с диска (с учётом
+    записей других воркеров) пересчитывает, когда записал ещё 10% лимита
+    или оценка превысила лимит, — так каталог больше лимита не более чем
+    на 10% на каждый воркер.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: int | None = None  # оценка, пересчитывается с диска
+        self._written = 0  # записано этим воркером после пересчёта
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.jpg")
+
+    def get(self, key: str) -> bytes | None:
+        if self.max_bytes <= 0:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # отметка использования для вытеснения
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.incr(f"conversion_cache.{'miss' if data is None else 'hit'}")
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if self.max_bytes <= 0:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Не удалось сохранить конвертацию %s в кэш: %s", key, e)
+            return
+        with self._lock:
+            self._written += len(data)
+            if self._size is not None:
+                self._size += len(data)
+            if self._size is None or self._size > self.max_bytes or self._written > self.max_bytes // 10:
+                self._evict()
+
+    def _files(self) -> list[tuple[float, int, str]]:
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self) -> None:
+        # Объём — с диска; при превышении лимита освобождаем до 90% лимита,
+        # чтобы не сканировать каталог на каждую запись
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_bytes * 0.9) if total > self.max_bytes else total
+        self._written = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+            metrics.incr("conversion_cache.evictions")
+        self._size = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._size is None and self.max_bytes > 0:
+                self._size = self._scan_size()
+            total = self.hits + self.misses
+            return {
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+conversion_cache = ConversionCache(CONVERSION_CACHE_DIR, CONVERSION_CACHE_MAX_MB * 1024 * 1024)
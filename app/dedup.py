@@ -0,0 +1,203 @@
+"""
+Поиск почти-дубликатов вопросов по всему банку: MinHash + LSH.
+
+Вопрос → множество шинглов (тройки токенов текста, формул LaTeX и
+вариантов ответа) → MinHash-подпись из NUM_PERM чисел. Подпись режется на
+BANDS полос по ROWS чисел; вопросы с совпавшей хотя бы одной полосой —
+кандидаты. Кандидаты ищутся по индексу (полоса, корзина) в SQLite, так что
+поиск не перебирает банк; похожесть кандидата — доля совпавших чисел
+подписи (оценка коэффициента Жаккара), в дубликаты идут те, у кого она
+не ниже DEDUP_THRESHOLD.
+"""
+import hashlib
+import logging
+import os
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+
+from app import metrics
+from app.config import DEDUP_DB, DEDUP_INDEX, DEDUP_MAX_MATCHES, DEDUP_THRESHOLD
+from app.rows import PLACEHOLDER_VOPROS, QuestionRow
+
+logger = logging.getLogger(__name__)
+
+# 16 полос по 8: кандидатом почти наверняка станет пара с похожестью
+# от ~0.8 и почти никогда — с похожестью ниже ~0.5
+NUM_PERM = 128
+BANDS, ROWS = 16, 8
+SHINGLE = 3
+
+_P = (1 << 61) - 1
+_rng = random.Random(20240601)  # подписи должны совпадать между процессами
+_PERMS = [(_rng.randrange(1, _P), _rng.randrange(0, _P)) for _ in range(NUM_PERM)]
+_SIG = struct.Struct(f"<{NUM_PERM}Q")
+
+_IMAGE_RE = re.compile(r'!\[[^\]]*\]\([^)]*\)(?:\{[^}]*\})?')
+_TOKEN_RE = re.compile(r'\\[a-zA-Z]+|\w+|[^\s\w{}$]')
+# Разметка, которая не меняет смысла формулы
+_NOISE = {"\\left", "\\right", "\\displaystyle", "\\text", "\\mathrm", "\\quad", "\\"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    entry_id INTEGER PRIMARY KEY,
+    docname TEXT NOT NULL,
+    qid INTEGER,
+    vopros TEXT,
+    sig BLOB NOT NULL,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_doc ON entries(docname);
+CREATE TABLE IF NOT EXISTS bands (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    entry_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_bands_bucket ON bands(band, bucket);
+CREATE INDEX IF NOT EXISTS idx_bands_entry ON bands(entry_id);
+"""
+
+_init_lock = threading.Lock()
+_ready = False
+# Один документ индексируется целиком, чтобы параллельные загрузки
+# не видели половину чужой версии
+_write_lock = threading.Lock()
+
+
+def tokens(text: str) -> list[str]:
+    """Токены нормализованного текста: слова, числа, команды и знаки LaTeX."""
+    text = _IMAGE_RE.sub(" ", text or "").lower()
+    return [t for t in _TOKEN_RE.findall(text) if t not in _NOISE]
+
+
+def _shingles(toks: list[str]) -> set[str]:
+    if len(toks) < SHINGLE:
+        return {" ".join(toks)} if toks else set()
+    return {" ".join(toks[i:i + SHINGLE]) for i in range(len(toks) - SHINGLE + 1)}
+
+
+def _option_texts(otvety) -> list[str]:
+    if isinstance(otvety, dict):  # matching: {группа: {ключ: текст}}
+        return [t for group in otvety.values() for t in (group.values() if isinstance(group, dict) else [group])]
+    return list(otvety or [])
+
+
+def shingles(row: QuestionRow) -> set[str]:
+    """
+    Шинглы вопроса: по тексту и по каждому варианту ответа отдельно,
+    так что перестановка вариантов не меняет множества.
+    """
+    result = _shingles(tokens(row.vopros))
+    for text in _option_texts(row.otvety):
+        result |= {"#" + s for s in _shingles(tokens(str(text)))}
+    return result
+
+
+def signature(items: set[str]) -> list[int]:
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little")
+              for s in items]
+    return [min((a * h + b) % _P for h in hashes) for a, b in _PERMS]
+
+
+def _buckets(sig: list[int]) -> list[int]:
+    out = []
+    for band in range(BANDS):
+        chunk = struct.pack(f"<{ROWS}Q", *sig[band * ROWS:(band + 1) * ROWS])
+        out.append(int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), "little", signed=True))
+    return out
+
+
+def similarity(a: list[int], b: list[int]) -> float:
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+def _connect() -> sqlite3.Connection:
+    global _ready
+    if not _ready:
+        os.makedirs(os.path.dirname(DEDUP_DB), exist_ok=True)
+    conn = sqlite3.connect(DEDUP_DB, timeout=10)
+    if not _ready:
+        with _init_lock:
+            if not _ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                _ready = True
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _matches(conn: sqlite3.Connection, sig: list[int], buckets: list[int]) -> list[dict]:
+    candidates: set[int] = set()
+    for band, bucket in enumerate(buckets):
+        candidates.update(r[0] for r in conn.execute(
+            "SELECT entry_id FROM bands WHERE band = ? AND bucket = ?", (band, bucket)))
+    found = []
+    for entry_id in candidates:
+        docname, qid, vopros, blob = conn.execute(
+            "SELECT docname, qid, vopros, sig FROM entries WHERE entry_id = ?", (entry_id,)).fetchone()
+        score = similarity(sig, _SIG.unpack(blob))
+        if score >= DEDUP_THRESHOLD:
+            found.append({"docname": docname, "id": qid, "vopros": vopros, "similarity": round(score, 3)})
+    found.sort(key=lambda m: -m["similarity"])
+    return found[:DEDUP_MAX_MATCHES]
+
+
+def flag_duplicates(docname: str, rows: list[QuestionRow]) -> int:
+    """
+    Помечает строки похожими вопросами из банка (row.duplicates) и заносит
+    их в индекс вместо прошлой версии того же документа. Повтор внутри
+    документа тоже помечается — ссылкой на более ранний вопрос.
+    Возвращает число помеченных строк.
+    """
+    if not DEDUP_INDEX:
+        return 0
+    prepared = []
+    for row in rows:
+        if row.vopros == PLACEHOLDER_VOPROS:
+            continue
+        items = shingles(row)
+        if items:
+            sig = signature(items)
+            prepared.append((row, sig, _buckets(sig)))
+
+    flagged = 0
+    try:
+        with _write_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM bands WHERE entry_id IN "
+                                 "(SELECT entry_id FROM entries WHERE docname = ?)", (docname,))
+                    conn.execute("DELETE FROM entries WHERE docname = ?", (docname,))
+                    now = time.time()
+                    for row, sig, buckets in prepared:
+                        found = _matches(conn, sig, buckets)
+                        if found:
+                            row.duplicates = found
+                            flagged += 1
+                        entry_id = conn.execute(
+                            "INSERT INTO entries (docname, qid, vopros, sig, created) VALUES (?, ?, ?, ?, ?)",
+                            (docname, row.id, row.vopros[:200], _SIG.pack(*sig), now)).lastrowid
+                        conn.executemany("INSERT INTO bands VALUES (?, ?, ?)",
+                                         [(band, bucket, entry_id) for band, bucket in enumerate(buckets)])
+            finally:
+                conn.close()
+    except Exception as e:
+        logger.warning("Не удалось обновить индекс дубликатов для %s: %s", docname, e)
+        return 0
+    metrics.incr("dedup.indexed", len(prepared))
+    metrics.incr("dedup.flagged", flagged)
+    return flagged
+
+
+def stats() -> dict:
+    if not DEDUP_INDEX or not os.path.exists(DEDUP_DB):
+        return {"entries": 0}
+    conn = _connect()
+    try:
+        return {"entries": conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]}
+    finally:
+        conn.close()
@@ -0,0 +1,129 @@
+import copy
+import hashlib
+import posixpath
+import zipfile
+
+from lxml import etree
+
+DOC_XML = "word/document.xml"
+DOC_RELS = "word/_rels/document.xml.rels"
+MEDIA_PREFIX = "word/media/"
+
+
+def zip_target(target: str) -> str:
+    """Путь внутри архива для Target из word/_rels/document.xml.rels."""
+    if target.startswith("/"):
+        return posixpath.normpath(target.lstrip("/"))
+    return posixpath.normpath(posixpath.join("word", target))
+
+
+def read_document_rels(zf: zipfile.ZipFile) -> dict:
+    """{rId: (Target, внешняя ли ссылка)} для word/document.xml."""
+    try:
+        root = etree.fromstring(zf.read(DOC_RELS))
+    except KeyError:
+        return {}
+    return {r.get("Id"): (r.get("Target"), r.get("TargetMode") == "External") for r in root}
+
+
+NUMBERING_XML = "word/numbering.xml"
+STYLES_XML = "word/styles.xml"
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Ссылки на определения: w:val этих элементов — id, свой в каждом документе
+_NUM_REFS = (W_NS + "numId",)
+_STYLE_REFS = (W_NS + "pStyle", W_NS + "rStyle", W_NS + "tblStyle", W_NS + "basedOn")
+# Служебное в определениях, не влияющее на вид абзаца
+_DEFINITION_NOISE = (W_NS + "nsid", W_NS + "tmpl", W_NS + "rsid", W_NS + "link", W_NS + "next")
+
+
+class Definitions:
+    """
+    Нумерация (numbering.xml) и стили (styles.xml), на которые ссылаются
+    элементы document.xml. numId и id стилей у каждого документа свои:
+    один и тот же список может быть numId=3 в одном файле и numId=7 в
+    другом, а один id — разными списками. resolve заменяет такую ссылку на
+    sha256 самого определения (с разрешёнными вложенными ссылками), и
+    одинаково оформленные блоки разных файлов получают одинаковый отпечаток.
+    Части читаются из архива при первой ссылке на них.
+    """
+
+    def __init__(self, zf: zipfile.ZipFile):
+        self._zf = zf
+        self._nums: dict | None = None
+        self._abstract: dict = {}
+        self._styles: dict | None = None
+        self._shas: dict[tuple, str] = {}
+        self._pending: set[tuple] = set()
+
+    def _read(self, name: str):
+        try:
+            return etree.fromstring(self._zf.read(name))
+        except KeyError:
+            return None
+
+    def resolve(self, node) -> None:
+        """Заменяет w:val ссылки в node на sha256 определения."""
+        key = W_NS + "val"
+        val = node.get(key)
+        if val is None:
+            return
+        if node.tag in _NUM_REFS:
+            node.set(key, self._sha(("num", val), self._numbering))
+        elif node.tag in _STYLE_REFS:
+            node.set(key, self._sha(("style", val), self._style))
+
+    def _sha(self, ref: tuple, definition) -> str:
+        if ref in self._shas:
+            return self._shas[ref]
+        h = hashlib.sha256(ref[0].encode())
+        if ref in self._pending:  # циклическая ссылка (basedOn по кругу)
+            return h.hexdigest()
+        self._pending.add(ref)
+        try:
+            elements = definition(ref[1])
+            if not elements:
+                h.update(ref[1].encode())  # нет определения (numId=0 — «без нумерации»)
+            for el in elements:
+                h.update(self._canonical(el))
+        finally:
+            self._pending.discard(ref)
+        self._shas[ref] = h.hexdigest()
+        return self._shas[ref]
+
+    def _canonical(self, el) -> bytes:
+        el = copy.deepcopy(el)
+        for key in (W_NS + "styleId", W_NS + "abstractNumId", W_NS + "numId"):
+            el.attrib.pop(key, None)
+        for node in list(el.iter()):
+            if not isinstance(node.tag, str) or node.tag in _DEFINITION_NOISE:
+                node.getparent().remove(node)
+                continue
+            for key in list(node.attrib):
+                if key.rsplit("}", 1)[-1].startswith("rsid"):
+                    del node.attrib[key]
+            self.resolve(node)
+        return etree.tostring(el, method="c14n", exclusive=True)
+
+    def _numbering(self, num_id: str) -> list:
+        if self._nums is None:
+            root = self._read(NUMBERING_XML)
+            self._nums = {}
+            if root is not None:
+                self._abstract = {el.get(W_NS + "abstractNumId"): el for el in root.iter(W_NS + "abstractNum")}
+                self._nums = {el.get(W_NS + "numId"): el for el in root.iter(W_NS + "num")}
+        num = self._nums.get(num_id)
+        if num is None:
+            return []
+        abstract_id = num.find(W_NS + "abstractNumId")
+        abstract = None if abstract_id is None else self._abstract.get(abstract_id.get(W_NS + "val"))
+        # Уровни списка и переопределения уровней в самом w:num
+        return ([] if abstract is None else [abstract]) + list(num.iter(W_NS + "lvlOverride"))
+
+    def _style(self, style_id: str) -> list:
+        if self._styles is None:
+            root = self._read(STYLES_XML)
+            self._styles = {} if root is None else {
+                el.get(W_NS + "styleId"): el for el in root.iter(W_NS + "style")}
+        style = self._styles.get(style_id)
+        return [] if style is None else [style]
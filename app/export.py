@@ -0,0 +1,138 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+import zipfile
+
+from app.rows import QuestionRow
+
+# Скалярные поля строки в таблице questions; otvety/pravOtv хранятся как JSON
+# и дополнительно разворачиваются в таблицу options
+QUESTION_COLUMNS = (
+    "row_no", "id", "id_predmet", "subject_name", "subject_namekz", "language", "klass",
+    "vopros", "temy_id", "temy_name", "podtemy_id", "podtemy_name", "target", "tip",
+    "texty", "otvety", "pravOtv", "exp", "difficulty", "quarter", "question_type",
+)
+OPTION_COLUMNS = ("row_no", "grp", "opt_key", "text")
+
+_SCHEMA = """
+CREATE TABLE questions (
+    row_no INTEGER PRIMARY KEY,
+    id INTEGER,
+    id_predmet INTEGER,
+    subject_name TEXT,
+    subject_namekz TEXT,
+    language TEXT,
+    klass TEXT,
+    vopros TEXT,
+    temy_id TEXT,
+    temy_name TEXT,
+    podtemy_id TEXT,
+    podtemy_name TEXT,
+    target TEXT,
+    tip INTEGER,
+    texty TEXT,
+    otvety TEXT,
+    pravOtv TEXT,
+    exp TEXT,
+    difficulty TEXT,
+    quarter INTEGER,
+    question_type TEXT
+);
+CREATE TABLE options (
+    row_no INTEGER NOT NULL REFERENCES questions(row_no),
+    grp TEXT,
+    opt_key TEXT,
+    text TEXT
+);
+"""
+
+
+def question_records(rows: list[QuestionRow]):
+    for row_no, r in enumerate(rows, start=1):
+        subject = r.subject or {}
+        yield (
+            row_no, r.id, r.id_predmet, subject.get("name"), subject.get("namekz"),
+            r.language, r.klass, r.vopros, r.temy_id, r.temy_name, r.podtemy_id,
+            r.podtemy_name, r.target, r.tip, r.texty,
+            json.dumps(r.otvety, ensure_ascii=False), json.dumps(r.pravOtv, ensure_ascii=False),
+            r.exp, r.difficulty, r.quarter, r.question_type,
+        )
+
+
+def option_records(rows: list[QuestionRow]):
+    """MCQ: (row_no, None, индекс, текст); matching: (row_no, group1/group2, ключ, текст)."""
+    for row_no, r in enumerate(rows, start=1):
+        if isinstance(r.otvety, dict):
+            for grp, opts in r.otvety.items():
+                for key, text in opts.items():
+                    yield row_no, grp, str(key), text
+        else:
+            for idx, text in enumerate(r.otvety or []):
+                yield row_no, None, str(idx), text
+
+
+def export_sqlite(rows: list[QuestionRow], path: str) -> str:
+    """Пишет строки в новый SQLite-файл одной транзакцией."""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        # Файл создаётся с нуля — журнал и fsync не нужны
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.executescript(_SCHEMA)
+        with conn:
+            conn.executemany(
+                f"INSERT INTO questions VALUES ({','.join('?' * len(QUESTION_COLUMNS))})",
+                question_records(rows))
+            conn.executemany(
+                f"INSERT INTO options VALUES ({','.join('?' * len(OPTION_COLUMNS))})",
+                option_records(rows))
+        conn.execute("CREATE INDEX idx_options_row ON options(row_no)")
+    finally:
+        conn.close()
+    return path
+
+
+def export_csv(rows: list[QuestionRow], path: str) -> str:
+    """ZIP с questions.csv и options.csv (UTF-8 с BOM, чтобы открывался в Excel)."""
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, columns, records in (
+                ("questions.csv", QUESTION_COLUMNS, question_records(rows)),
+                ("options.csv", OPTION_COLUMNS, option_records(rows))):
+            with zf.open(name, "w") as raw:
+                f = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(records)
+                f.flush()
+                f.detach()
+    return path
+
+
+def export_parquet(rows: list[QuestionRow], path: str) -> str:
+    """ZIP с questions.parquet и options.parquet; нужен pyarrow."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Экспорт в parquet недоступен: не установлен pyarrow")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:
+        for name, columns, records in (
+                ("questions.parquet", QUESTION_COLUMNS, question_records(rows)),
+                ("options.parquet", OPTION_COLUMNS, option_records(rows))):
+            records = list(records)
+            table = pa.table({c: [rec[i] for rec in records] for i, c in enumerate(columns)})
+            buf = io.BytesIO()
+            pq.write_table(table, buf)
+            zf.writestr(name, buf.getvalue())
+    return path
+
+
+EXPORTERS = {
+    "sqlite": (export_sqlite, ".sqlite", "application/vnd.sqlite3"),
+    "csv": (export_csv, ".csv.zip", "application/zip"),
+    "parquet": (export_parquet, ".parquet.zip", "application/zip"),
+}
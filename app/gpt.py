@@ -0,0 +1,240 @@
+"""
+Вызовы GPT: распознавание заданий по картинке и исправление математики в JSON.
+Все вызовы идут через endpoint (дедлайн, дубликат медленного запроса,
+предохранитель); недоступность модели — исключение ServiceUnavailable.
+"""
+import base64
+import json
+import logging
+import math
+import os
+
+import openai
+from PIL import Image
+
+from app import metrics
+from app.config import GPT_BATCH_MAX_IMAGES, GPT_BATCH_MAX_TOKENS, GPT_TIMEOUT, \
+    GPT_HEDGE_PERCENTILE, GPT_HEDGE_MIN_DELAY, GPT_BREAKER_FAILURES, GPT_BREAKER_COOLDOWN
+from app.promt import GLOBAL_SYSTEM_PROMPT, GLOBAL_FIX_PROMPT
+from app.resilience import GuardedEndpoint, ServiceUnavailable
+from app.tracing import span
+
+logger = logging.getLogger(__name__)
+
+endpoint = GuardedEndpoint("gpt", GPT_TIMEOUT, GPT_HEDGE_PERCENTILE, GPT_HEDGE_MIN_DELAY,
+                           GPT_BREAKER_FAILURES, GPT_BREAKER_COOLDOWN)
+_client: openai.AsyncOpenAI | None = None
+
+
+def _get_client() -> openai.AsyncOpenAI:
+    # Повторы делает endpoint, собственные ретраи клиента отключены
+    global _client
+    if _client is None:
+        _client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
+
+
+async def _complete(messages: list):
+    return await endpoint.call(lambda: _get_client().chat.completions.create(
+        model="gpt-4o",
+        messages=messages,
+        temperature=0.0,
+        functions=FUNCTIONS,
+        function_call={"name": "return_json"}
+    ))
+
+PROMPT = GLOBAL_SYSTEM_PROMPT
+SYSTEM_PROMPT = GLOBAL_FIX_PROMPT
+
+# Дополнение к PROMPT для запроса с несколькими картинками заданий
+BATCH_PROMPT = PROMPT + """
+❗**Несколько заданий в одном запросе**: перед каждым изображением идёт подпись
+"Задание N". Верни вопросы со всех изображений в одном массиве "questions" и
+у каждого вопроса добавь поле "task_index": N — номер изображения, с которого
+он взят. Это единственное разрешённое дополнительное поле.
+"""
+
+FUNCTIONS = [
+    {
+        "name": "return_json",
+        "description": "Return the parsed questions as JSON matching the schema.",
+        "parameters": {
+            "type": "object",
+            "properties": {"questions": {"type": "array", "items": {"type": "object"}}},
+            "required": ["questions"]
+        }
+    }
+]
+
+
+def _image_part(image_path: str) -> dict:
+    with open(image_path, "rb") as f:
+        b64 = base64.b64encode(f.read()).decode("utf-8")
+    return {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}}
+
+
+async def send_image_to_gpt(image_path: str) -> dict:
+    """Вопросы с одной картинки; ServiceUnavailable, если модель недоступна."""
+    logger.info(f"Sending image to GPT: {image_path}")
+    messages = [
+        {"role": "system", "content": PROMPT},
+        {"role": "user", "content": [_image_part(image_path)]},
+    ]
+    metrics.incr("gpt.requests")
+    metrics.incr("gpt.images")
+    with span("send_image_to_gpt", cat="gpt", image=os.path.basename(image_path)):
+        return await _request_questions(messages)
+
+
+async def _request_questions(messages: list) -> dict:
+    """
+    Запрос с функцией return_json. Ответ без вызова функции или с битым
+    JSON — {"questions": [], "error": ...}; недоступность модели пробрасывается.
+    """
+    resp = await _complete(messages)
+    logger.info("Received GPT response with function call")
+
+    # Access function call args
+    func_call = resp.choices[0].message.function_call
+    if not func_call or not func_call.arguments:
+        logger.error("No function_call in GPT response")
+        return {"questions": [], "error": "No function_call in GPT response"}
+    args = func_call.arguments
+    try:
+        parsed = json.loads(args)
+        logger.info("Successfully parsed JSON from GPT")
+        return parsed
+    except Exception as e:
+        logger.error(f"JSON parse error: {e}, raw args: {args}")
+        return {"questions": [], "error": "Invalid JSON from GPT", "raw": args}
+
+
+def estimate_image_tokens(image_path: str) -> int:
+    """
+    Оценка токенов картинки в режиме detail=high: вписывание в 2048×2048,
+    короткая сторона до 768, 170 токенов за плитку 512×512 плюс 85.
+    """
+    with Image.open(image_path) as img:
+        w, h = img.size
+    scale = min(1.0, 2048 / max(w, h))
+    w, h = w * scale, h * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+def plan_batches(image_paths: list[str]) -> list[list[int]]:
+    """Индексы картинок по запросам: не больше GPT_BATCH_MAX_IMAGES и GPT_BATCH_MAX_TOKENS."""
+    batches: list[list[int]] = []
+    current: list[int] = []
+    tokens = 0
+    for i, path in enumerate(image_paths):
+        cost = estimate_image_tokens(path)
+        if current and (len(current) >= GPT_BATCH_MAX_IMAGES or tokens + cost > GPT_BATCH_MAX_TOKENS):
+            batches.append(current)
+            current, tokens = [], 0
+        current.append(i)
+        tokens += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _task_index(q, size: int) -> int | None:
+    index = str(q.get("task_index", "")).strip() if isinstance(q, dict) else ""
+    return int(index) - 1 if index.isdigit() and 0 < int(index) <= size else None
+
+
+def _split_by_task(questions: list, size: int) -> list[list[dict]] | None:
+    """
+    Раскладывает вопросы пакета по task_index (1..size); None, если сопоставить нельзя.
+    Вопросы без task_index (или с неверным) достаются по порядку заданиям,
+    для которых модель не вернула ни одного вопроса, — только если их
+    столько же, сколько таких заданий; иначе ответ не сопоставляется.
+    """
+    per_task: list[list[dict]] = [[] for _ in range(size)]
+    unindexed = []
+    for q in questions:
+        idx = _task_index(q, size)
+        if idx is None:
+            unindexed.append(q)
+            continue
+        q.pop("task_index")
+        per_task[idx].append(q)
+    if not unindexed:
+        return per_task
+    if size == 1:
+        per_task[0].extend(unindexed)
+        return per_task
+    # Без task_index доверяем только раскладке «один вопрос на картинку»
+    empty = [i for i, task in enumerate(per_task) if not task]
+    if len(unindexed) != len(empty):
+        return None
+    for i, q in zip(empty, unindexed):
+        if isinstance(q, dict):
+            q.pop("task_index", None)
+        per_task[i].append(q)
+    return per_task
+
+
+async def send_images_to_gpt(image_paths: list[str]) -> list[list[dict]]:
+    """
+    Отправляет картинки заданий пакетами (несколько картинок в одном запросе,
+    системный промпт — один раз на пакет). Возвращает вопросы для каждой
+    картинки в исходном порядке. Картинки, ответ для которых не удалось
+    сопоставить, отправляются повторно по одной. Если модель недоступна,
+    у оставшихся картинок список вопросов пустой.
+    """
+    results: list[list[dict]] = [[] for _ in image_paths]
+    retry: list[int] = []
+    for batch in plan_batches(image_paths):
+        if len(batch) == 1:
+            retry.append(batch[0])
+            continue
+        content = []
+        for n, i in enumerate(batch, start=1):
+            content.append({"type": "text", "text": f"Задание {n}"})
+            content.append(_image_part(image_paths[i]))
+        messages = [
+            {"role": "system", "content": BATCH_PROMPT},
+            {"role": "user", "content": content},
+        ]
+        metrics.incr("gpt.requests")
+        metrics.incr("gpt.images", len(batch))
+        try:
+            with span("send_images_to_gpt", cat="gpt", images=len(batch)):
+                resp = await _request_questions(messages)
+        except ServiceUnavailable as e:
+            logger.warning("GPT недоступен, пакет из %d картинок пропущен: %s", len(batch), e)
+            continue
+        per_task = _split_by_task(resp.get("questions") or [], len(batch))
+        if per_task is None:
+            logger.warning("Ответ на пакет из %d картинок не сопоставлен с заданиями", len(batch))
+            per_task = [[] for _ in batch]
+        for i, questions in zip(batch, per_task):
+            if questions:
+                results[i] = questions
+            else:
+                metrics.incr("gpt.batch.retries")
+                retry.append(i)
+
+    for i in retry:
+        try:
+            results[i] = (await send_image_to_gpt(image_paths[i])).get("questions") or []
+        except ServiceUnavailable as e:
+            logger.warning("GPT недоступен, картинка %s пропущена: %s", image_paths[i], e)
+    return results
+
+
+async def fix_math_json(input_data: dict) -> dict:
+    with span("fix_math_json", cat="gpt"):
+        response = await _complete([
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": json.dumps(input_data, ensure_ascii=False)}
+        ])
+    args = response.choices[0].message.function_call.arguments
+    try:
+        corrected_json = json.loads(args)
+        return corrected_json
+    except json.JSONDecodeError:
+        raise ValueError("Ответ от GPT не является валидным JSON:", args)
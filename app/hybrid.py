@@ -0,0 +1,190 @@
+"""
+Гибридный разбор: сначала локальный пайплайн, затем GPT по картинке только
+для вопросов, которые пайплайн распознал не полностью. Число запросов к
+модели растёт с числом неудач, а не с размером документа.
+"""
+import asyncio
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from pdf2image import convert_from_path
+from PIL import Image
+
+from app import metrics, subproc
+from app.auto_parser import split_docx_into_parts
+from app.config import HYBRID_MIN_SCORE, HYBRID_RENDER_DPI, LIBREOFFICE_BIN, LIBREOFFICE_TIMEOUT
+from app.gpt import endpoint as gpt_endpoint, send_images_to_gpt
+from app.parse_cache import parse_cache
+from app.rows import PLACEHOLDER_VOPROS
+from app.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Страниц одного вопроса, склеиваемых в картинку для модели
+MAX_RENDER_PAGES = 3
+
+_LETTERS = {"А": "A", "В": "B", "С": "C", "Д": "D", "Е": "E"}
+
+
+def completeness(state: dict) -> float:
+    """Доля распознанных ключевых полей MCQ-вопроса: вопрос, варианты, правильный ответ."""
+    otvety = [o for o in state.get("otvety") or [] if str(o).strip()]
+    checks = (
+        bool(state.get("vopros")) and state.get("vopros") != PLACEHOLDER_VOPROS,
+        len(otvety) >= 2,
+        bool(state.get("pravOtv")) and all(i < len(otvety) for i in state["pravOtv"]),
+    )
+    return sum(checks) / len(checks)
+
+
+def needs_vision(state: dict) -> bool:
+    return state.get("question_type", "mcq") == "mcq" and completeness(state) < HYBRID_MIN_SCORE
+
+
+def render_part(docx_path: str) -> str:
+    """Часть .docx → PDF (LibreOffice) → PNG; страницы склеиваются по вертикали."""
+    out_dir = os.path.dirname(docx_path)
+    base = os.path.splitext(os.path.basename(docx_path))[0]
+    with span("libreoffice_pdf", cat="subprocess", part=base):
+        subproc.run([
+            LIBREOFFICE_BIN,
+            "--headless",
+            "--convert-to", "pdf",
+            docx_path,
+            "--outdir", out_dir
+        ], LIBREOFFICE_TIMEOUT)
+    pdf_path = os.path.join(out_dir, f"{base}.pdf")
+    with span("pdf2image", cat="image", part=base):
+        pages = convert_from_path(pdf_path, dpi=HYBRID_RENDER_DPI, last_page=MAX_RENDER_PAGES,
+                                  timeout=LIBREOFFICE_TIMEOUT)
+        if len(pages) == 1:
+            img = pages[0]
+        else:
+            img = Image.new("RGB", (max(p.width for p in pages), sum(p.height for p in pages)), "white")
+            y = 0
+            for page in pages:
+                img.paste(page, (0, y))
+                y += page.height
+        png_path = os.path.join(out_dir, f"{base}.png")
+        img.save(png_path)
+    os.remove(pdf_path)
+    return png_path
+
+
+def _answer_indexes(correct, keys: list[str]) -> list[int]:
+    answers = correct if isinstance(correct, list) else re.split(r"[,;]", str(correct or ""))
+    indexes = []
+    for ans in answers:
+        letter = str(ans).split("|", 1)[0].strip()[:1].upper()
+        letter = _LETTERS.get(letter, letter)
+        if letter in keys and keys.index(letter) not in indexes:
+            indexes.append(keys.index(letter))
+    return indexes
+
+
+def merge_vision(state: dict, q: dict) -> dict:
+    """
+    Дополняет состояние ответом модели. Поля, которые локальный пайплайн
+    распознал, остаются как есть; номер вопроса всегда локальный.
+    """
+    new = state.copy()
+    if not state.get("vopros") or state.get("vopros") == PLACEHOLDER_VOPROS:
+        if q.get("question"):
+            new["vopros"] = q["question"]
+
+    options = q.get("options") or {}
+    keys = [_LETTERS.get(k.strip().upper(), k.strip().upper()) for k in options]
+    if len([o for o in state.get("otvety") or [] if str(o).strip()]) < 2 and options:
+        new["otvety"] = [str(v).strip() for v in options.values()]
+    if not state.get("pravOtv") or any(i >= len(new.get("otvety") or []) for i in state["pravOtv"]):
+        indexes = _answer_indexes(q.get("correct_answer"), keys)
+        if indexes:
+            new["pravOtv"] = indexes
+
+    # Необязательные поля — только если локально пусто
+    if not state.get("exp") and q.get("explanation"):
+        new["exp"] = q["explanation"]
+    section, topic = q.get("section") or {}, q.get("topic") or {}
+    if not state.get("temy_name") and section.get("name"):
+        new["temy_id"], new["temy_name"] = str(section.get("id") or "") or None, section["name"]
+    if not state.get("podtemy_name") and topic.get("name"):
+        new["podtemy_id"], new["podtemy_name"] = str(topic.get("id") or "") or None, topic["name"]
+    if not state.get("target") and q.get("learning_goals"):
+        new["target"] = q["learning_goals"]
+    if not state.get("difficulty") and q.get("difficulty_level"):
+        new["difficulty"] = str(q["difficulty_level"]).strip()[:1].upper() or None
+    if not state.get("quarter") and q.get("quarter") in (1, 2, 3, 4):
+        new["quarter"] = q["quarter"]
+    return new
+
+
+async def repair_states(src, raw_list: list[dict], states: list[dict], kind: str) -> list[dict]:
+    """
+    Для неполных вопросов заново вырезает из src только их части,
+    рендерит в картинки и отправляет в модель. Возвращает новый список
+    состояний. Дополненные состояния кладутся в parse_cache отдельно от
+    локальных (вид f"{kind}+hybrid"), чтобы mode=local их не получал.
+    """
+    hybrid_kind = f"{kind}+hybrid"
+    failed = [i for i, st in enumerate(states) if needs_vision(st)]
+    metrics.incr("hybrid.questions", len(states))
+    metrics.incr("hybrid.failed", len(failed))
+    # Вопросы, уже дополненные GPT в прошлых гибридных разборах
+    states, pending = list(states), []
+    for i in failed:
+        cached = parse_cache.get_state(raw_list[i]["text"], hybrid_kind)
+        if cached is None:
+            pending.append(i)
+        else:
+            states[i] = cached
+    metrics.incr("hybrid.cached", len(failed) - len(pending))
+    failed = pending
+    logger.info("Гибридный разбор: %d из %d вопросов идут в GPT", len(failed), len(states))
+    if not failed:
+        return states
+    if not gpt_endpoint.available():
+        # Модель недоступна — не тратим время на рендер, остаётся локальный разбор
+        logger.warning("Гибридный разбор: предохранитель GPT разомкнут, используется локальный разбор")
+        metrics.incr("hybrid.fallbacks", len(failed))
+        return states
+
+    wanted = {raw_list[i]["fingerprint"] for i in failed}
+    tmp = tempfile.mkdtemp()
+    try:
+        with span("split_failed", cat="hybrid", questions=len(failed)):
+            parts = await asyncio.to_thread(split_docx_into_parts, src, tmp,
+                                            lambda p: p["fingerprint"] not in wanted)
+        paths = {p["fingerprint"]: p["path"] for p in parts if p["path"]}
+
+        # Рендерим каждый уникальный вопрос один раз и отправляем пакетами
+        pngs: dict[str, str] = {}
+        for i in failed:
+            fp = raw_list[i]["fingerprint"]
+            if fp in pngs:
+                continue
+            try:
+                with span("render_part", cat="hybrid", question=i + 1):
+                    pngs[fp] = await asyncio.to_thread(render_part, paths[fp])
+            except subproc.Cancelled:
+                raise
+            except Exception as e:
+                logger.warning("Не удалось отрисовать вопрос %d: %s", i + 1, e)
+                metrics.incr("hybrid.render_errors")
+        fps = list(pngs)
+        answers = dict(zip(fps, await send_images_to_gpt([pngs[fp] for fp in fps])))
+
+        for i in failed:
+            q = next(iter(answers.get(raw_list[i]["fingerprint"]) or []), None)
+            if not q:
+                metrics.incr("hybrid.fallbacks")
+                continue
+            states[i] = merge_vision(states[i], q)
+            if not needs_vision(states[i]):
+                metrics.incr("hybrid.repaired")
+            parse_cache.put_state(raw_list[i]["text"], hybrid_kind, states[i])
+        return states
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
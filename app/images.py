@@ -0,0 +1,114 @@
+"""
+Перекодирование растровых картинок документа в JPEG с ограниченной памятью:
+- стороны результата не больше IMAGE_MAX_SIDE;
+- JPEG декодируется сразу уменьшенным (draft: 1/2…1/8 в самом декодере);
+- картинка, которая в памяти займёт больше IMAGE_MAX_PIXELS пикселей,
+  не декодируется вовсе (защита от «бомб»);
+- палитра и прозрачность сводятся к RGB на белом фоне полосами, без
+  полноразмерных промежуточных копий.
+Пик памяти на картинку — декодированный кадр (не больше IMAGE_MAX_PIXELS
+пикселей в исходном режиме) плюс полоса около _STRIP_BYTES и результат.
+"""
+import logging
+import math
+
+from PIL import Image
+
+from app import metrics
+from app.config import IMAGE_MAX_PIXELS, IMAGE_MAX_SIDE
+
+logger = logging.getLogger(__name__)
+
+# Размер полосы при сведении палитры и прозрачности к RGB
+_STRIP_BYTES = 4 << 20
+_JPEG_MODES = ("RGB", "L")
+
+
+class ImageTooLarge(ValueError):
+    """Картинка больше IMAGE_MAX_PIXELS после уменьшенного декодирования."""
+
+
+def _open(fp) -> Image.Image:
+    """Открывает картинку (без декодирования) и для JPEG сразу просит уменьшенный кадр."""
+    img = Image.open(fp)
+    w, h = img.size
+    scale = max(w, h) / IMAGE_MAX_SIDE
+    if scale > 1 and img.format == "JPEG":
+        img.draft("RGB", (math.ceil(w / scale), math.ceil(h / scale)))
+        if img.size != (w, h):
+            metrics.incr("images.reduced_decode")
+    if img.width * img.height > IMAGE_MAX_PIXELS:
+        img.close()
+        metrics.incr("images.rejected")
+        raise ImageTooLarge(f"{w}x{h}: больше {IMAGE_MAX_PIXELS} пикселей")
+    return img
+
+
+def decoded_bytes(fp) -> int:
+    """
+    Сколько займёт декодированный кадр (с учётом уменьшения JPEG в декодере)
+    плюс RGB-результат; 0 — картинка будет отклонена, не декодируясь.
+    """
+    with Image.open(fp) as img:
+        w, h = img.size
+        bands = len(img.getbands())
+        scale = max(w, h) / IMAGE_MAX_SIDE
+        if scale > 1 and img.format == "JPEG":
+            reduce = min(8, 2 ** int(math.log2(scale)))
+            w, h = math.ceil(w / reduce), math.ceil(h / reduce)
+    if w * h > IMAGE_MAX_PIXELS:
+        return 0
+    return w * h * (bands + 3)
+
+
+def needs_transcode(fp) -> bool:
+    """False, если это уже JPEG в RGB/L не больше IMAGE_MAX_SIDE — его можно отдать как есть."""
+    with Image.open(fp) as img:
+        return img.format != "JPEG" or img.mode not in _JPEG_MODES or max(img.size) > IMAGE_MAX_SIDE
+
+
+def to_jpeg(fp, out) -> None:
+    """Перекодирует картинку fp (путь или файловый объект) в JPEG в out."""
+    with _open(fp) as img:
+        rgb = _reduce_to_rgb(img)
+        if max(rgb.size) > IMAGE_MAX_SIDE:
+            rgb.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        rgb.save(out, "JPEG")
+
+
+def _reduce_to_rgb(img: Image.Image) -> Image.Image:
+    """
+    RGB/L-кадр, уменьшенный в целое число раз так, чтобы до IMAGE_MAX_SIDE
+    оставалось не больше двух раз (досчитывает LANCZOS на маленьком кадре).
+    Без уменьшения RGB/L возвращается сам кадр, без копии.
+    """
+    img.load()
+    w, h = img.size
+    factor = max(1, max(w, h) // IMAGE_MAX_SIDE)
+    if factor > 1:
+        metrics.incr("images.downscaled")
+    if img.mode in _JPEG_MODES:
+        return img.reduce(factor) if factor > 1 else img
+
+    # Палитра, прозрачность, CMYK и пр. — полосами, кратными factor
+    out = Image.new("RGB", (math.ceil(w / factor), math.ceil(h / factor)), "white")
+    band = max(1, _STRIP_BYTES // (w * 4 * factor)) * factor
+    for y in range(0, h, band):
+        strip = _flatten(img.crop((0, y, w, min(h, y + band))))
+        if factor > 1:
+            strip = strip.reduce(factor)
+        out.paste(strip, (0, y // factor))
+    return out
+
+
+def _flatten(strip: Image.Image) -> Image.Image:
+    """Полоса → RGB; прозрачное ложится на белый фон."""
+    if strip.mode == "P" and "transparency" not in strip.info:
+        return strip.convert("RGB")
+    if strip.mode in ("P", "PA", "LA", "La", "RGBa"):
+        strip = strip.convert("RGBA")
+    if strip.mode == "RGBA":
+        bg = Image.new("RGB", strip.size, "white")
+        bg.paste(strip, mask=strip.getchannel("A"))
+        return bg
+    return strip.convert("RGB")
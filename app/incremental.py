@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+from app.config import INCREMENTAL_PARSE, PARSE_STATE_DIR
+from app.parse_cache import parse_cache
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних загрузок с одним именем хранить
+_KEEP_PER_NAME = 5
+
+
+def content_digest(data: bytes) -> str:
+    """Хэш содержимого загрузки — ключ её результата среди загрузок с тем же именем."""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def _state_dir(docname: str) -> str:
+    # Имя файла приходит от клиента: только безопасные символы, без путей
+    return os.path.join(PARSE_STATE_DIR, re.sub(r"[^\w.-]", "_", docname).lstrip(".") or "_")
+
+
+def _saved(docname: str) -> list[str]:
+    """Сохранённые разборы документа, от нового к старому."""
+    try:
+        entries = [e for e in os.scandir(_state_dir(docname)) if e.name.endswith(".json")]
+    except FileNotFoundError:
+        return []
+    return [e.path for e in sorted(entries, key=lambda e: e.stat().st_mtime, reverse=True)]
+
+
+def load_previous(docname: str, digest: str) -> dict:
+    """
+    Результат прошлого разбора документа:
+    {fingerprint: {"markdown", "text", "files", "states"}}, где markdown —
+    вывод pandoc с метками медиа по хэшу (как в parse_cache), files —
+    {sha256 медиа: имя файла в static/img/<docname>}.
+    Разборы хранятся по имени и хэшу содержимого (digest): загрузки разных
+    файлов с одним именем не затирают друг друга. Берётся разбор с тем же
+    содержимым, иначе — последний с этим именем (изменённая версия документа).
+    Пустой словарь, если документ ещё не загружали или режим выключен.
+    """
+    if not INCREMENTAL_PARSE:
+        return {}
+    saved = _saved(docname)
+    exact = os.path.join(_state_dir(docname), f"{digest}.json")
+    path = exact if exact in saved else next(iter(saved), None)
+    if path is None:
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            previous = json.load(f)
+    except Exception as e:
+        logger.warning("Не удалось прочитать прошлый разбор %s: %s", docname, e)
+        return {}
+    if path != saved[0]:
+        # В static/img/<docname> уже медиа более поздней загрузки с тем же именем
+        for entry in previous.values():
+            entry["files"] = {}
+    return previous
+
+
+def _previous_states(raw_item: dict, previous: dict) -> dict:
+    entry = previous.get(raw_item["fingerprint"], {})
+    return entry.get("states", {}) if entry.get("text") == raw_item["text"] else {}
+
+
+def pipeline_state(raw_item: dict, previous: dict, kind: str, pipeline) -> tuple[dict, bool]:
+    """
+    Состояние одного вопроса: из прошлого разбора, из общего кэша или
+    через pipeline. Второй элемент — True, если состояние переиспользовано.
+    Состояние прошлого разбора годится, только если итоговый текст тот же:
+    при перенумерации картинок блок не меняется, а ссылки в тексте — да.
+    """
+    cached = _previous_states(raw_item, previous).get(kind)
+    if cached is None:
+        cached = parse_cache.get_state(raw_item["text"], kind)
+    if cached is not None:
+        return cached, True
+    state = pipeline(raw_item)
+    parse_cache.put_state(raw_item["text"], kind, state)
+    return state, False
+
+
+def save_result(docname: str, digest: str, raw_list: list[dict], states: list[dict],
+                kind: str, previous: dict) -> None:
+    """
+    Сохраняет markdown, текст, файлы медиа и состояния текущей версии
+    документа (ключ — имя и digest, см. load_previous). Состояния других
+    пайплайнов для тех же отпечатков сохраняются, если текст вопроса не
+    изменился. Старые разборы с тем же именем сверх _KEEP_PER_NAME удаляются.
+    """
+    if not INCREMENTAL_PARSE:
+        return
+    result = {}
+    for raw_item, state in zip(raw_list, states):
+        fp = raw_item["fingerprint"]
+        entry_states = dict(_previous_states(raw_item, previous))
+        entry_states[kind] = state
+        result[fp] = {"markdown": raw_item["markdown"], "text": raw_item["text"],
+                      "files": raw_item["files"], "states": entry_states}
+    state_dir = _state_dir(docname)
+    os.makedirs(state_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(state_dir, f"{digest}.json"))
+    except Exception as e:
+        logger.warning("Не удалось сохранить разбор %s: %s", docname, e)
+        return
+    for path in _saved(docname)[_KEEP_PER_NAME:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,652 @@
+"""
+Формулы MathType (OLE-объекты Equation.*) → LaTeX без растеризации превью.
+
+В .docx формула — это w:object с картинкой-превью (v:imagedata, WMF/EMF)
+и OLE-объектом word/embeddings/*.bin. Внутри OLE лежит поток
+«Equation Native»: 28-байтовый заголовок и данные MTEF — дерево формулы.
+Здесь разбирается MTEF v5 (MathType 5+, Equation.DSMT*) и основные шаблоны
+MTEF v3 (Equation.3). Всё, чего декодер не знает, даёт Unsupported —
+такая формула остаётся картинкой, как раньше.
+"""
+import logging
+import struct
+import zipfile
+from collections import Counter
+
+from lxml import etree
+
+from app import metrics
+from app.config import MATHTYPE_TO_LATEX
+from app.docx_package import DOC_XML, read_document_rels, zip_target
+
+try:
+    import olefile
+except ImportError:  # без olefile формулы идут обычным путём — через картинку-превью
+    olefile = None
+
+logger = logging.getLogger(__name__)
+
+_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_V = "{urn:schemas-microsoft-com:vml}"
+_O = "{urn:schemas-microsoft-com:office:office}"
+_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+_OBJECT, _IMAGEDATA, _OLE = _W + "object", _V + "imagedata", _O + "OLEObject"
+_BLIP, _P, _TBL, _BODY = _A + "blip", _W + "p", _W + "tbl", _W + "body"
+
+EQUATION_STREAM = "Equation Native"
+
+
+class Unsupported(Exception):
+    """Формулу не удалось перевести в LaTeX — остаётся картинка-превью."""
+
+
+# --- поиск формул в документе ------------------------------------------------
+
+def find_equations(src) -> tuple[dict, set]:
+    """
+    Находит формулы MathType в word/document.xml и переводит их в LaTeX.
+    Возвращает ({Target и rId картинки-превью: "$...$"},
+    {пути в архиве превью, на которые больше ничего не ссылается}) —
+    вторые не нужно ни конвертировать, ни сохранять.
+    """
+    if not MATHTYPE_TO_LATEX or olefile is None:
+        return {}, set()
+    with zipfile.ZipFile(src) as zf:
+        rels = read_document_rels(zf)
+        image_refs: Counter = Counter()
+        objects: list[tuple[str, str]] = []
+        with zf.open(DOC_XML) as stream:
+            for _, el in etree.iterparse(stream, events=("end",),
+                                         tag=(_IMAGEDATA, _BLIP, _OBJECT, _P, _TBL)):
+                if el.tag == _IMAGEDATA:
+                    image_refs[el.get(_R + "id")] += 1
+                elif el.tag == _BLIP:
+                    image_refs[el.get(_R + "embed")] += 1
+                    image_refs[el.get(_R + "link")] += 1
+                elif el.tag == _OBJECT:
+                    ole = el.find(_OLE)
+                    img = el.find(".//" + _IMAGEDATA)
+                    if ole is not None and img is not None \
+                            and ole.get("ProgID", "").startswith("Equation."):
+                        objects.append((img.get(_R + "id"), ole.get(_R + "id")))
+                elif el.getparent() is not None and el.getparent().tag == _BODY:
+                    # Абзацы и таблицы верхнего уровня больше не нужны
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
+
+        equations: dict[str, str] = {}
+        converted: Counter = Counter()
+        for img_rid, ole_rid in objects:
+            img, ole = rels.get(img_rid), rels.get(ole_rid)
+            if img is None or ole is None or img[1] or ole[1]:
+                continue
+            if img_rid not in equations:
+                try:
+                    latex = ole_to_latex(zf.read(zip_target(ole[0])))
+                except Exception as e:
+                    metrics.incr("mathtype.fallback")
+                    logger.debug("Формула %s осталась картинкой: %s", ole[0], e)
+                    continue
+                metrics.incr("mathtype.converted")
+                equations[img_rid] = equations[img[0]] = f"${latex}$"
+            converted[img_rid] += 1
+
+    # Превью можно не извлекать, если все ссылки на файл — из переведённых формул
+    members: dict[str, bool] = {}
+    for rid, count in image_refs.items():
+        rel = rels.get(rid)
+        if rel is None or rel[1]:
+            continue
+        member = zip_target(rel[0])
+        only_equations = count == converted[rid]
+        members[member] = members.get(member, True) and only_equations
+    previews = {member for member, skip in members.items() if skip}
+    metrics.incr("mathtype.previews_skipped", len(previews))
+    return equations, previews
+
+
+def ole_to_latex(blob: bytes) -> str:
+    """LaTeX формулы из OLE-объекта Equation.* (без $)."""
+    with olefile.OleFileIO(blob) as ole:
+        if not ole.exists(EQUATION_STREAM):
+            raise Unsupported(f"нет потока {EQUATION_STREAM}")
+        data = ole.openstream(EQUATION_STREAM).read()
+    # EQNOLEFILEHDR: cbHdr, version, cf, cbObject, 4 резервных
+    cb_hdr, _, _, cb_object = struct.unpack_from("<HIHI", data)
+    return mtef_to_latex(data[cb_hdr:cb_hdr + cb_object])
+
+
+def mtef_to_latex(data: bytes) -> str:
+    """LaTeX по данным MTEF v3/v5."""
+    items = _Reader(data).parse()
+    latex = _render_items(items).strip()
+    if not latex:
+        raise Unsupported("пустая формула")
+    return latex
+
+
+# --- разбор MTEF ---------------------------------------------------------------
+
+_END, _LINE, _CHAR, _TMPL, _PILE, _MATRIX, _EMBELL, _RULER = range(8)
+_SIZE, _FULL, _SUBSYM = 9, 10, 14
+_COLOR, _COLOR_DEF, _FONT_DEF, _EQN_PREFS, _ENCODING_DEF = range(15, 20)
+_FUTURE = 100
+
+# Флаги опций записей
+_NUDGE = 0x08
+_LINE_NULL, _LINE_RULER, _LINE_LSPACE = 0x01, 0x02, 0x04
+_CHAR_EMBELL, _CHAR_FUNC_START, _CHAR_ENC_8 = 0x01, 0x02, 0x04
+_CHAR_ENC_16, _CHAR_NO_MTCODE = 0x10, 0x20
+_V3_CHAR_EMBELL = 0x02
+_COLOR_CMYK, _COLOR_NAME = 0x01, 0x04
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+        self.version = self.byte()
+        if self.version == 5:
+            self.skip(4)  # платформа, продукт, версия продукта
+            self.cstr()  # ключ приложения (DSMT4 и т.п.)
+            self.byte()  # опции формулы
+        elif self.version == 3:
+            self.skip(4)
+        else:
+            raise Unsupported(f"MTEF v{self.version}")
+
+    # примитивы
+    def byte(self) -> int:
+        if self.pos >= len(self.data):
+            raise Unsupported("данные MTEF оборваны")
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def u16(self) -> int:
+        return self.byte() | self.byte() << 8
+
+    def uint(self) -> int:
+        b = self.byte()
+        return self.u16() if b == 255 else b
+
+    def skip(self, n: int) -> None:
+        self.pos += n
+        if self.pos > len(self.data):
+            raise Unsupported("данные MTEF оборваны")
+
+    def cstr(self) -> str:
+        end = self.data.index(b"\0", self.pos)
+        s = self.data[self.pos:end].decode("latin-1")
+        self.pos = end + 1
+        return s
+
+    def nudge(self) -> None:
+        # Сдвиг на отображение в LaTeX не влияет, его нужно только пропустить
+        dx, dy = self.byte(), self.byte()
+        if dx == 128 and dy == 128:
+            self.skip(4)  # большой сдвиг — два 16-битных значения
+
+    def dimensions(self) -> None:
+        """Массив размеров EQN_PREFS: полубайты, каждый размер кончается на 0xF."""
+        n = self.uint()
+        nibbles = 0
+        for _ in range(n):
+            nibbles += 1  # единицы измерения
+            while True:
+                b = self.data[self.pos + nibbles // 2]
+                nib = b >> 4 if nibbles % 2 == 0 else b & 0x0F
+                nibbles += 1
+                if nib == 0x0F:
+                    break
+        self.skip((nibbles + 1) // 2)
+
+    # записи
+    def parse(self) -> list:
+        return self.objects(top=True)
+
+    def objects(self, top: bool = False) -> list:
+        items = []
+        while True:
+            if top and self.pos >= len(self.data):
+                return items
+            rec = self.record()
+            if rec is _END:
+                return items
+            if rec is not None:
+                items.append(rec)
+
+    def record(self):
+        tag = self.byte()
+        if self.version == 5:
+            kind = tag
+            opts = self.byte() if kind in (_LINE, _CHAR, _TMPL, _PILE, _MATRIX, _EMBELL,
+                                           _COLOR_DEF, _EQN_PREFS) else 0
+        else:
+            kind, opts = tag & 0x0F, tag >> 4
+        if kind == _END:
+            return _END
+        if kind in (_LINE, _CHAR, _TMPL, _PILE, _MATRIX, _EMBELL) and opts & _NUDGE:
+            self.nudge()
+
+        if kind == _LINE:
+            if opts & _LINE_LSPACE:
+                if self.version == 5:
+                    self.uint()
+                else:
+                    self.u16()
+            if opts & _LINE_RULER:
+                self.ruler()
+            return ("line", [] if opts & _LINE_NULL else self.objects())
+        if kind == _CHAR:
+            return self.char(opts)
+        if kind == _TMPL:
+            selector = self.byte()
+            variation = self.byte()
+            if self.version == 5 and variation & 0x80:
+                variation = (variation & 0x7F) | self.byte() << 7
+            self.byte()  # опции шаблона
+            if self.version == 3:
+                selector, variation = _v3_template(selector, variation)
+            return ("tmpl", selector, variation, self.objects())
+        if kind == _PILE:
+            halign = self.byte()
+            self.byte()  # вертикальное выравнивание
+            if opts & _LINE_RULER:
+                self.ruler()
+            return ("pile", halign, self.objects())
+        if kind == _MATRIX:
+            self.skip(3)  # выравнивание
+            rows, cols = self.byte(), self.byte()
+            self.skip(((rows + 1) * 2 + 7) // 8 + ((cols + 1) * 2 + 7) // 8)  # линии сетки
+            return ("matrix", rows, cols, self.objects())
+        if kind == _EMBELL:
+            return ("embell", self.byte())
+        if kind == _RULER:
+            self.ruler(tagged=False)
+            return None
+        if kind == 8:
+            if self.version == 5:  # FONT_STYLE_DEF
+                self.uint()
+                self.byte()
+            else:  # FONT
+                self.skip(2)
+                self.cstr()
+            return None
+        if kind == _SIZE:
+            size = self.byte()
+            if size == 101:
+                self.skip(2)
+            elif size == 100:
+                self.skip(3)
+            else:
+                self.skip(1)
+            return None
+        if _FULL <= kind <= _SUBSYM:
+            return None
+        if self.version == 5:
+            if kind == _COLOR:
+                self.uint()
+                return None
+            if kind == _COLOR_DEF:
+                self.skip(2 * (4 if opts & _COLOR_CMYK else 3))
+                if opts & _COLOR_NAME:
+                    self.cstr()
+                return None
+            if kind == _FONT_DEF:
+                self.uint()
+                self.cstr()
+                return None
+            if kind == _EQN_PREFS:
+                self.dimensions()  # размеры
+                self.dimensions()  # интервалы
+                for _ in range(self.uint()):  # стили
+                    if self.byte():
+                        self.byte()
+                return None
+            if kind == _ENCODING_DEF:
+                self.cstr()
+                return None
+            if kind >= _FUTURE:
+                self.skip(self.uint())
+                return None
+        raise Unsupported(f"запись MTEF {kind}")
+
+    def ruler(self, tagged: bool = True) -> None:
+        if tagged and self.byte() != _RULER:
+            raise Unsupported("ожидалась запись RULER")
+        self.skip(3 * self.byte())  # упоры табуляции: тип + смещение
+
+    def char(self, opts: int):
+        typeface = self.byte() - 128
+        if self.version == 5:
+            code = None if opts & _CHAR_NO_MTCODE else self.u16()
+            if opts & _CHAR_ENC_8:
+                self.byte()
+            if opts & _CHAR_ENC_16:
+                self.u16()
+            embells = self.objects() if opts & _CHAR_EMBELL else []
+            func_start = bool(opts & _CHAR_FUNC_START)
+        else:
+            code = self.u16()
+            embells = self.objects() if opts & _V3_CHAR_EMBELL else []
+            func_start = False
+        if code is None:
+            raise Unsupported("символ без MTCode")
+        return ("char", typeface, code, [e[1] for e in embells if e[0] == "embell"], func_start)
+
+
+# --- LaTeX ---------------------------------------------------------------------
+
+# Стили символов (typeface)
+_FN_TEXT, _FN_FUNCTION, _FN_VECTOR, _FN_MARKER, _FN_SPACE = 1, 2, 7, 23, 24
+
+_FUNCTIONS = {
+    "arccos", "arcsin", "arctan", "arg", "cos", "cosh", "cot", "coth", "csc", "deg",
+    "det", "dim", "exp", "gcd", "hom", "inf", "ker", "lg", "lim", "liminf", "limsup",
+    "ln", "log", "max", "min", "Pr", "sec", "sin", "sinh", "sup", "tan", "tanh",
+}
+_LIMIT_OPS = ("\\lim", "\\max", "\\min", "\\sup", "\\inf", "\\liminf", "\\limsup")
+
+_SYMBOLS = {
+    # греческие
+    "α": "\\alpha", "β": "\\beta", "γ": "\\gamma", "δ": "\\delta", "ε": "\\varepsilon",
+    "ϵ": "\\epsilon", "ζ": "\\zeta", "η": "\\eta", "θ": "\\theta", "ϑ": "\\vartheta",
+    "ι": "\\iota", "κ": "\\kappa", "λ": "\\lambda", "μ": "\\mu", "ν": "\\nu", "ξ": "\\xi",
+    "ο": "o", "π": "\\pi", "ϖ": "\\varpi", "ρ": "\\rho", "ϱ": "\\varrho", "σ": "\\sigma",
+    "ς": "\\varsigma", "τ": "\\tau", "υ": "\\upsilon", "φ": "\\varphi", "ϕ": "\\phi",
+    "χ": "\\chi", "ψ": "\\psi", "ω": "\\omega",
+    "Α": "A", "Β": "B", "Γ": "\\Gamma", "Δ": "\\Delta", "Ε": "E", "Ζ": "Z", "Η": "H",
+    "Θ": "\\Theta", "Ι": "I", "Κ": "K", "Λ": "\\Lambda", "Μ": "M", "Ν": "N", "Ξ": "\\Xi",
+    "Ο": "O", "Π": "\\Pi", "Ρ": "P", "Σ": "\\Sigma", "Τ": "T", "Υ": "\\Upsilon",
+    "Φ": "\\Phi", "Χ": "X", "Ψ": "\\Psi", "Ω": "\\Omega", "∆": "\\Delta", "µ": "\\mu",
+    # операции и отношения
+    "±": "\\pm", "∓": "\\mp", "×": "\\times", "÷": "\\div", "·": "\\cdot", "⋅": "\\cdot",
+    "∙": "\\cdot", "−": "-", "∗": "*", "≤": "\\le", "≥": "\\ge", "≠": "\\ne",
+    "≈": "\\approx", "≡": "\\equiv", "∼": "\\sim", "≅": "\\cong", "∝": "\\propto",
+    "≪": "\\ll", "≫": "\\gg", "∞": "\\infty", "→": "\\to", "←": "\\leftarrow",
+    "↔": "\\leftrightarrow", "⇒": "\\Rightarrow", "⇐": "\\Leftarrow",
+    "⇔": "\\Leftrightarrow", "↑": "\\uparrow", "↓": "\\downarrow", "∈": "\\in",
+    "∉": "\\notin", "∋": "\\ni", "⊂": "\\subset", "⊃": "\\supset", "⊆": "\\subseteq",
+    "⊇": "\\supseteq", "∪": "\\cup", "∩": "\\cap", "∅": "\\varnothing", "∀": "\\forall",
+    "∃": "\\exists", "¬": "\\neg", "∧": "\\wedge", "∨": "\\vee", "⊕": "\\oplus",
+    "⊗": "\\otimes", "∂": "\\partial", "∇": "\\nabla", "√": "\\surd", "∑": "\\sum",
+    "∏": "\\prod", "∫": "\\int", "∠": "\\angle", "⊥": "\\perp", "∥": "\\parallel",
+    "△": "\\triangle", "°": "^{\\circ}", "′": "'", "″": "''", "…": "\\ldots",
+    "⋯": "\\cdots", "⋮": "\\vdots", "⋱": "\\ddots", "ℕ": "\\mathbb{N}",
+    "ℤ": "\\mathbb{Z}", "ℚ": "\\mathbb{Q}", "ℝ": "\\mathbb{R}", "ℂ": "\\mathbb{C}",
+    "ℓ": "\\ell", "⟨": "\\langle", "⟩": "\\rangle", "〈": "\\langle", "〉": "\\rangle",
+    "‖": "\\|", "⌊": "\\lfloor", "⌋": "\\rfloor", "⌈": "\\lceil", "⌉": "\\rceil",
+    # ASCII, особые для LaTeX
+    "{": "\\{", "}": "\\}", "\\": "\\backslash", "%": "\\%", "#": "\\#", "&": "\\&",
+    "$": "\\$", "_": "\\_", "~": "\\sim", "^": "\\wedge", " ": "",
+    # пробелы
+    "\u00a0": "~", "\u2009": "\\,", "\u2005": "\\;", "\u2003": "\\quad",
+}
+# Пробелы MathType (MTCode U+EF00…): нулевой, тонкие, em
+_MT_SPACES = {0xEF00: "", 0xEF01: "\\,", 0xEF02: "\\,", 0xEF03: "\\;", 0xEF04: "\\quad",
+              0xEF05: "\\qquad", 0xEF08: ""}
+
+_EMBELLS = {
+    2: "\\dot{%s}", 3: "\\ddot{%s}", 4: "\\dddot{%s}", 5: "%s'", 6: "%s''", 8: "\\tilde{%s}",
+    9: "\\hat{%s}", 10: "\\not%s", 11: "\\vec{%s}", 12: "\\overleftarrow{%s}",
+    13: "\\overleftrightarrow{%s}", 17: "\\bar{%s}", 18: "%s'''",
+}
+
+_FENCES = {
+    "(": "(", ")": ")", "[": "[", "]": "]", "{": "\\{", "}": "\\}", "|": "|", "‖": "\\|",
+    "⟨": "\\langle", "⟩": "\\rangle", "〈": "\\langle", "〉": "\\rangle",
+    "⌊": "\\lfloor", "⌋": "\\rfloor", "⌈": "\\lceil", "⌉": "\\rceil",
+}
+# Шаблоны-скобки MTEF v5: селектор → (левая, правая) по умолчанию
+_FENCE_TEMPLATES = {
+    0: ("\\langle", "\\rangle"), 1: ("(", ")"), 2: ("\\{", "\\}"), 3: ("[", "]"),
+    4: ("|", "|"), 5: ("\\|", "\\|"), 6: ("\\lfloor", "\\rfloor"), 7: ("\\lceil", "\\rceil"),
+}
+_TV_FENCE_L, _TV_FENCE_R = 0x01, 0x02
+
+_BIG_OPS = {16: "\\sum", 17: "\\prod", 18: "\\coprod", 19: "\\bigcup", 20: "\\bigcap"}
+_BIG_OP_CHARS = {"∑": "\\sum", "∏": "\\prod", "∐": "\\coprod", "⋃": "\\bigcup",
+                 "⋂": "\\bigcap", "∫": "\\int", "∬": "\\iint", "∭": "\\iiint", "∮": "\\oint"}
+
+# Шаблоны MTEF v3 → селекторы v5 (только те, у которых совпадает состав слотов)
+_V3_TEMPLATES = {0: 0, 1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 7, 8: 9, 9: 9, 10: 9, 11: 9,
+                 12: 9, 13: 10, 14: 11, 16: 12, 17: 13}
+_V3_SCRIPT, _V3_SLFRACT = 15, 41
+
+_SUB, _SUP, _SUBSUP = 27, 28, 29
+
+
+def _v3_template(selector: int, variation: int) -> tuple[int, int]:
+    """Селектор и вариант шаблона MTEF v3 в терминах v5."""
+    if selector == _V3_SCRIPT:
+        return _SUBSUP, 0  # слоты индексов по позиции: нижний, верхний
+    if selector == _V3_SLFRACT:
+        return 11, 0x02
+    if selector not in _V3_TEMPLATES:
+        raise Unsupported(f"шаблон MTEF v3 {selector}")
+    selector = _V3_TEMPLATES[selector]
+    if selector in _FENCE_TEMPLATES:
+        return selector, _TV_FENCE_L | _TV_FENCE_R
+    return selector, variation if selector == 10 else 0
+
+
+def _render_items(items: list) -> str:
+    pieces: list[str] = []
+    i = 0
+    while i < len(items):
+        item = items[i]
+        kind = item[0]
+        if kind == "char" and item[1] in (_FN_TEXT, _FN_FUNCTION):
+            # Текст и имена функций идут сплошными отрезками
+            style = item[1]
+            run = [item]
+            i += 1
+            while i < len(items) and items[i][0] == "char" and items[i][1] == style \
+                    and not (style == _FN_FUNCTION and items[i][4]):
+                run.append(items[i])
+                i += 1
+            pieces.append(_text(run) if style == _FN_TEXT else _function(run))
+            continue
+        if kind == "char":
+            pieces.append(_char(item))
+        elif kind == "line":
+            pieces.append(_render_items(item[1]))
+        elif kind == "tmpl":
+            pieces.append(_template(item, has_base=bool(pieces)))
+        elif kind == "pile":
+            pieces.append(_pile(item))
+        elif kind == "matrix":
+            pieces.append(_matrix(item))
+        i += 1
+    return _join(pieces)
+
+
+def _join(pieces: list[str]) -> str:
+    out = ""
+    for piece in pieces:
+        if not piece:
+            continue
+        # \alpha x, а не \alphax
+        if out and piece[0].isalpha() and out[-1].isalpha() and "\\" in out:
+            tail = out.rsplit("\\", 1)[1]
+            if tail.isalpha():
+                out += " "
+        out += piece
+    return out
+
+
+def _code(char) -> str:
+    code = char[2]
+    if 0xE000 <= code <= 0xF8FF and code not in _MT_SPACES:
+        raise Unsupported(f"символ MathType U+{code:04X}")
+    return chr(code)
+
+
+def _char(char) -> str:
+    _, typeface, code, embells, _ = char
+    if typeface == _FN_MARKER:
+        return ""
+    if code in _MT_SPACES:
+        return _MT_SPACES[code]
+    if typeface == _FN_SPACE:
+        return "\\,"
+    ch = _code(char)
+    if ch in _SYMBOLS:
+        latex = _SYMBOLS[ch]
+    elif ch.isascii():
+        latex = ch
+    elif ch.isalpha():
+        latex = f"\\text{{{ch}}}"  # кириллица и прочие буквы в формуле
+    else:
+        latex = ch
+    if typeface == _FN_VECTOR and ch.isalnum():
+        latex = f"\\mathbf{{{latex}}}"
+    for embell in embells:
+        if embell not in _EMBELLS:
+            raise Unsupported(f"украшение MTEF {embell}")
+        if embell == 10 and ch == "=":
+            latex = "\\ne"
+            continue
+        latex = _EMBELLS[embell] % latex
+    return latex
+
+
+def _text(run: list) -> str:
+    chars = []
+    for char in run:
+        if char[3]:
+            raise Unsupported("украшение в текстовом стиле")
+        ch = _code(char)
+        chars.append("\\" + ch if ch in "{}$%#&_" else ch)
+    return "\\text{%s}" % "".join(chars)
+
+
+def _function(run: list) -> str:
+    name = "".join(_code(c) for c in run)
+    if name in _FUNCTIONS:
+        return "\\" + name
+    if not name.isalpha():
+        return _join([_char(c) for c in run])
+    return f"\\operatorname{{{name}}}"  # tg, ctg, arctg…
+
+
+def _slots(items: list) -> tuple[list[str], list[str]]:
+    """Слоты шаблона (строки, отрендеренные в LaTeX) и его символы (скобки, знаки операций)."""
+    lines, chars = [], []
+    for item in items:
+        if item[0] == "char":
+            chars.append(chr(item[2]))
+        else:
+            lines.append(_render_items([item]))
+    return lines, chars
+
+
+def _slot(lines: list[str], idx: int) -> str:
+    return lines[idx] if idx < len(lines) else ""
+
+
+def _scripts(sub: str, sup: str) -> str:
+    return (f"_{{{sub}}}" if sub else "") + (f"^{{{sup}}}" if sup else "")
+
+
+def _template(tmpl, has_base: bool) -> str:
+    _, selector, variation, items = tmpl
+    lines, chars = _slots(items)
+    return _template_latex(selector, variation, lines, chars, has_base)
+
+
+def _template_latex(selector: int, variation: int, lines: list[str], chars: list[str],
+                    has_base: bool) -> str:
+    main = _slot(lines, 0)
+    if selector in _FENCE_TEMPLATES or selector == 9:
+        left, right = _FENCE_TEMPLATES.get(selector, (None, None))
+        fences = [_FENCES[c] for c in chars if c in _FENCES]
+        if selector == 9:  # интервал: скобки только из символов шаблона
+            if len(fences) != 2:
+                raise Unsupported("интервал без скобок")
+            left, right = fences
+        elif variation & _TV_FENCE_L and variation & _TV_FENCE_R:
+            if len(fences) == 2:
+                left, right = fences
+        elif variation & _TV_FENCE_L:
+            left, right = fences[0] if fences else left, "."
+        elif variation & _TV_FENCE_R:
+            left, right = ".", fences[0] if fences else right
+        return f"\\left{left} {main} \\right{right}"
+    if selector == 10:
+        index = _slot(lines, 1)
+        return f"\\sqrt[{index}]{{{main}}}" if variation & 1 and index else f"\\sqrt{{{main}}}"
+    if selector == 11:
+        num, den = main, _slot(lines, 1)
+        return f"{{{num}}}/{{{den}}}" if variation & 0x02 else f"\\frac{{{num}}}{{{den}}}"
+    if selector == 12:
+        return f"\\underline{{{main}}}"
+    if selector == 13:
+        return f"\\overline{{{main}}}"
+    if selector == 15 or selector in _BIG_OPS:
+        op = next((_BIG_OP_CHARS[c] for c in chars if c in _BIG_OP_CHARS), None)
+        if op is None:
+            if selector != 15:
+                op = _BIG_OPS[selector]
+            elif variation & 0x0C:
+                op = "\\oint"
+            else:
+                op = {1: "\\int", 2: "\\iint", 3: "\\iiint"}.get(variation & 0x03, "\\int")
+        return f"{op}{_scripts(_slot(lines, 1), _slot(lines, 2))} {main}"
+    if selector == 23:
+        limits = _scripts(_slot(lines, 1), _slot(lines, 2))
+        if main in _LIMIT_OPS:
+            return main + limits
+        return f"\\mathop{{{main}}}\\limits{limits}"
+    if selector == 24:
+        label = _slot(lines, 1)
+        if variation & 0x01:
+            return f"\\overbrace{{{main}}}" + (f"^{{{label}}}" if label else "")
+        return f"\\underbrace{{{main}}}" + (f"_{{{label}}}" if label else "")
+    if selector in (_SUB, _SUP, _SUBSUP):
+        filled = [s for s in lines if s]
+        if selector == _SUB:
+            latex = _scripts(filled[0] if filled else "", "")
+        elif selector == _SUP:
+            latex = _scripts("", filled[-1] if filled else "")
+        else:
+            if len(lines) < 2:
+                raise Unsupported("индексы без слотов")
+            latex = _scripts(lines[0], lines[1])
+        return latex if has_base else "{}" + latex
+    if selector == 31:
+        if variation & 0x0C:
+            raise Unsupported("стрелка-гарпун или стрелка снизу")
+        arrow = {1: "overleftarrow", 3: "overleftrightarrow"}.get(variation & 0x03, "overrightarrow")
+        return f"\\{arrow}{{{main}}}"
+    if selector == 32:
+        return f"\\widetilde{{{main}}}"
+    if selector == 33:
+        return f"\\widehat{{{main}}}"
+    if selector == 34:
+        return f"\\overset{{\\frown}}{{{main}}}"
+    if selector == 37:
+        return f"\\boxed{{{main}}}"
+    raise Unsupported(f"шаблон MTEF {selector}")
+
+
+def _pile(pile) -> str:
+    _, halign, items = pile
+    rows = [_render_items([item]) for item in items]
+    if len(rows) == 1:
+        return rows[0]
+    col = {1: "l", 3: "r"}.get(halign, "c")
+    return "\\begin{array}{%s} %s \\end{array}" % (col, " \\\\ ".join(rows))
+
+
+def _matrix(matrix) -> str:
+    _, rows, cols, items = matrix
+    cells = [_render_items([item]) for item in items]
+    if len(cells) != rows * cols:
+        raise Unsupported("матрица неполная")
+    body = " \\\\ ".join(" & ".join(cells[r * cols:(r + 1) * cols]) for r in range(rows))
+    return "\\begin{matrix} %s \\end{matrix}" % body
@@ -0,0 +1,177 @@
+import io
+import logging
+import os
+import posixpath
+import shutil
+import tempfile
+import zipfile
+
+from app import images, raster, subproc
+from app.conversion_cache import conversion_cache
+from app.docx_package import MEDIA_PREFIX, read_document_rels, zip_target
+from app.tracing import span
+
+logger = logging.getLogger(__name__)
+
+VECTOR_EXTS = (".emf", ".wmf")
+
+
+def convert_to_jpeg(src_path: str) -> str:
+    """
+    Приводит картинку к JPEG рядом с исходником (WMF/EMF — через app.raster).
+    Возвращает путь к итоговому файлу; исходник удаляется.
+    """
+    root = os.path.dirname(src_path)
+    base, ext = os.path.splitext(os.path.basename(src_path))
+
+    # WMF/EMF → PNG: быстрый растеризатор, LibreOffice — запасной вариант
+    if ext.lower() in VECTOR_EXTS:
+        src_path = raster.rasterize(src_path)
+
+    # Конвертация в JPEG с ограничением размера (app.images)
+    final_path = os.path.join(root, f"{base}.jpg")
+    if src_path != final_path or images.needs_transcode(src_path):
+        with span("pil_jpeg", cat="image", file=os.path.basename(src_path)):
+            tmp_path = final_path + ".part"
+            images.to_jpeg(src_path, tmp_path)
+        if src_path != final_path:
+            os.remove(src_path)
+        os.replace(tmp_path, final_path)
+    return final_path
+
+
+def convert_bytes_to_jpeg(name: str, data: bytes) -> tuple[str, bytes]:
+    """
+    То же для картинки в памяти: (имя .jpg, байты JPEG).
+    WMF/EMF сначала ищутся в conversion_cache по хэшу байт; при промахе
+    идут через временный файл — внешние растеризаторы читают только с диска.
+    """
+    base, ext = os.path.splitext(name)
+    if ext.lower() in VECTOR_EXTS:
+        key = conversion_cache.key(data)
+        cached = conversion_cache.get(key)
+        if cached is not None:
+            return f"{base}.jpg", cached
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, name)
+            with open(path, "wb") as f:
+                f.write(data)
+            final_path = convert_to_jpeg(path)
+            with open(final_path, "rb") as f:
+                jpeg = f.read()
+        conversion_cache.put(key, jpeg)
+        return os.path.basename(final_path), jpeg
+    if ext.lower() == ".jpg" and not images.needs_transcode(io.BytesIO(data)):
+        return name, data
+    out = io.BytesIO()
+    with span("pil_jpeg", cat="image", file=name):
+        images.to_jpeg(io.BytesIO(data), out)
+    return f"{base}.jpg", out.getvalue()
+
+
+def _map_rels(rels: dict, urls: dict) -> dict:
+    media_map: dict[str, str] = {}
+    for rid, (target, external) in rels.items():
+        if external:
+            continue
+        url = urls.get(zip_target(target))
+        if url is not None:
+            media_map[target] = url
+            media_map[rid] = url
+    return media_map
+
+
+def _kept_name(name: str, kept_name: str) -> str:
+    """Имя в архиве с расширением уже сконвертированного файла (image3.emf → image3.jpg)."""
+    return os.path.splitext(name)[0] + os.path.splitext(kept_name)[1]
+
+
+def extract_media(src: str, out_dir: str, docname: str, skip: set = frozenset(),
+                  kept: dict | None = None) -> dict:
+    """
+    Извлекает word/media/* прямо из архива в out_dir за один последовательный
+    проход (каждый файл копируется потоком) и конвертирует в JPEG.
+    skip — пути в архиве, которые не нужны (превью формул, ставших LaTeX).
+    kept — {путь в архиве: (имя, байты)} уже сконвертированных файлов:
+    они записываются как есть, без конвертации.
+    Возвращает {Target связи или rId: итоговый URL} для точной замены ссылок.
+    """
+    kept = kept or {}
+    os.makedirs(out_dir, exist_ok=True)
+    with zipfile.ZipFile(src) as zin:
+        rels = read_document_rels(zin)
+        urls: dict[str, str] = {}
+        for info in zin.infolist():
+            if not info.filename.startswith(MEDIA_PREFIX) or info.is_dir() or info.filename in skip:
+                continue
+            subproc.check_cancelled()
+            name = posixpath.basename(info.filename).replace(' ', '_')
+            dst_path = os.path.join(out_dir, name)
+            if info.filename in kept:
+                kept_name, data = kept[info.filename]
+                dst_path = os.path.join(out_dir, _kept_name(name, kept_name))
+                with open(dst_path, "wb") as fdst:
+                    fdst.write(data)
+            elif os.path.splitext(name)[1].lower() in VECTOR_EXTS:
+                # Формулы-превью небольшие и повторяются — через кэш конвертаций
+                data = zin.read(info)
+                try:
+                    name, data = convert_bytes_to_jpeg(name, data)
+                except subproc.Cancelled:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Ошибка обработки {dst_path}: {str(e)}")
+                dst_path = os.path.join(out_dir, name)
+                with open(dst_path, "wb") as fdst:
+                    fdst.write(data)
+            else:
+                with zin.open(info) as fsrc, open(dst_path, "wb") as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1 << 16)
+                try:
+                    dst_path = convert_to_jpeg(dst_path)
+                except subproc.Cancelled:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Ошибка обработки {dst_path}: {str(e)}")
+            urls[info.filename] = f"/img/{docname}/{os.path.basename(dst_path)}"
+    return _map_rels(rels, urls)
+
+
+def load_media(src, docname: str, skip: set = frozenset(),
+               kept: dict | None = None) -> tuple[dict, dict]:
+    """
+    Вариант extract_media без диска: медиа конвертируются в памяти и
+    держатся буферами до publish_media.
+    Возвращает (media_map, {имя файла: байты}).
+    """
+    kept = kept or {}
+    files: dict[str, bytes] = {}
+    with zipfile.ZipFile(src) as zin:
+        rels = read_document_rels(zin)
+        urls: dict[str, str] = {}
+        for info in zin.infolist():
+            if not info.filename.startswith(MEDIA_PREFIX) or info.is_dir() or info.filename in skip:
+                continue
+            subproc.check_cancelled()
+            name = posixpath.basename(info.filename).replace(' ', '_')
+            if info.filename in kept:
+                kept_name, data = kept[info.filename]
+                name = _kept_name(name, kept_name)
+            else:
+                data = zin.read(info)
+                try:
+                    name, data = convert_bytes_to_jpeg(name, data)
+                except subproc.Cancelled:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Ошибка обработки {name}: {str(e)}")
+            files[name] = data
+            urls[info.filename] = f"/img/{docname}/{name}"
+    return _map_rels(rels, urls), files
+
+
+def publish_media(files: dict, out_dir: str) -> None:
+    os.makedirs(out_dir, exist_ok=True)
+    for name, data in files.items():
+        with open(os.path.join(out_dir, name), "wb") as f:
+            f.write(data)
@@ -0,0 +1,253 @@
+"""
+Хранилище медиа документов в static/img/<docname> с квотой на диск.
+
+У каждого документа есть манифест (MEDIA_MANIFEST_DIR/<docname>.json):
+медиа последней версии (записанные её разбором и те, на которые ссылаются
+её вопросы), их объём и время последнего использования — разбора или
+запроса картинки через /img. После разбора остальные файлы каталога
+(прошлая версия) удаляются.
+
+Фоновая сборка мусора (collect) раз в MEDIA_GC_INTERVAL секунд удаляет
+файлы, которых нет в манифесте документа. Вытеснение документов целиком —
+только если оно включено явно (на них могут ссылаться уже выданные строки):
+- MEDIA_TTL_DAYS — документы, не использовавшиеся дольше срока;
+- MEDIA_QUOTA_MB — давно не использованные документы, пока объём не
+  опустится до 90% квоты.
+Каталоги без манифеста (загрузки до его появления) не трогаются и в
+квоте не учитываются. Документы, которые сейчас разбираются (pin), и
+недавно изменённые каталоги тоже не трогаются.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from fastapi.staticfiles import StaticFiles
+
+from app import metrics
+from app.config import IMG_DIR, MEDIA_GC_INTERVAL, MEDIA_MANIFEST_DIR, MEDIA_QUOTA_MB, MEDIA_TTL_DAYS
+
+logger = logging.getLogger(__name__)
+
+# Каталог, изменённый недавно, может принадлежать разбору в другом воркере
+_GRACE = 600
+
+_lock = threading.Lock()
+_pinned: dict[str, int] = {}
+_used: dict[str, float] = {}  # docname → время запроса через /img, до записи в манифест
+_gc_lock = threading.Lock()
+_stats = {"documents": 0, "bytes": 0, "evicted": 0, "last_gc": None}
+
+
+def _manifest_path(docname: str) -> str:
+    return os.path.join(MEDIA_MANIFEST_DIR, f"{docname}.json")
+
+
+def read_manifest(docname: str) -> dict | None:
+    try:
+        with open(_manifest_path(docname), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Не удалось прочитать манифест медиа %s: %s", docname, e)
+        return None
+
+
+def _write_manifest(docname: str, manifest: dict) -> None:
+    os.makedirs(MEDIA_MANIFEST_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=MEDIA_MANIFEST_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, _manifest_path(docname))
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def pin(docname: str):
+    """Пока документ разбирается, сборка мусора не трогает его медиа."""
+    with _lock:
+        _pinned[docname] = _pinned.get(docname, 0) + 1
+    try:
+        yield
+    finally:
+        with _lock:
+            if _pinned[docname] == 1:
+                del _pinned[docname]
+            else:
+                _pinned[docname] -= 1
+
+
+def _is_pinned(docname: str) -> bool:
+    with _lock:
+        return docname in _pinned
+
+
+def touch(docname: str) -> None:
+    _used[docname] = time.time()
+
+
+def commit(docname: str, texts: list[str], urls=()) -> None:
+    """
+    Записывает манифест новой версии документа и удаляет остальные файлы
+    его каталога. Остаются файлы, которые разбор только что записал
+    (urls — значения media_map), и файлы, на которые ссылаются тексты
+    вопросов (texts): ссылка по имени без media_map тоже должна работать.
+    """
+    out_dir = os.path.join(IMG_DIR, docname)
+    prefix = f"/img/{docname}/"
+    link_re = re.compile(rf'{re.escape(prefix)}([^/)\s]+)')
+    names = {url[len(prefix):] for url in urls if url.startswith(prefix)}
+    for text in texts:
+        names.update(link_re.findall(text or ""))
+    files = {}
+    for name in names:
+        try:
+            files[name] = os.path.getsize(os.path.join(out_dir, name))
+        except OSError:
+            continue
+    try:
+        for name in os.listdir(out_dir):
+            if name not in files:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(out_dir, name))
+    except FileNotFoundError:
+        pass
+    now = time.time()
+    try:
+        _write_manifest(docname, {"files": files, "bytes": sum(files.values()), "updated": now, "used": now})
+    except Exception as e:
+        logger.warning("Не удалось сохранить манифест медиа %s: %s", docname, e)
+
+
+def _remove(docname: str) -> None:
+    shutil.rmtree(os.path.join(IMG_DIR, docname), ignore_errors=True)
+    with contextlib.suppress(OSError):
+        os.remove(_manifest_path(docname))
+
+
+def _scan(now: float) -> list[tuple]:
+    """
+    Документы IMG_DIR с манифестом: [время использования, объём, docname];
+    заодно дописывает touch в манифесты и удаляет файлы вне манифестов.
+    """
+    used = {}
+    while _used:
+        docname, ts = _used.popitem()
+        used[docname] = max(ts, used.get(docname, 0))
+    docs = []
+    for entry in os.scandir(IMG_DIR):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        docname = entry.name
+        manifest = read_manifest(docname)
+        if manifest is None:
+            continue  # загрузка до появления манифестов или прерванный разбор
+        try:
+            last = manifest.get("used", manifest.get("updated", 0))
+            if docname in used and used[docname] > last:
+                last = manifest["used"] = used[docname]
+                _write_manifest(docname, manifest)
+            size = manifest.get("bytes", 0)
+            if now - entry.stat().st_mtime > _GRACE and not _is_pinned(docname):
+                size += _drop_unlisted(entry.path, manifest.get("files", {}))
+        except OSError as e:
+            logger.warning("Сборка мусора медиа: пропущен %s: %s", docname, e)
+            continue
+        docs.append((last, size, docname))
+    _drop_stale_manifests({d[2] for d in docs}, now)
+    return docs
+
+
+def _drop_stale_manifests(present: set, now: float) -> None:
+    """Манифесты документов, чей каталог уже удалён."""
+    if not os.path.isdir(MEDIA_MANIFEST_DIR):
+        return
+    for entry in os.scandir(MEDIA_MANIFEST_DIR):
+        docname, ext = os.path.splitext(entry.name)
+        if ext != ".json" or docname in present or _is_pinned(docname):
+            continue
+        with contextlib.suppress(OSError):
+            if now - entry.stat().st_mtime > _GRACE:
+                os.remove(entry.path)
+
+
+def _drop_unlisted(path: str, files: dict) -> int:
+    """Удаляет файлы, которых нет в манифесте; возвращает объём оставшихся лишних."""
+    left = 0
+    for entry in os.scandir(path):
+        if entry.name in files:
+            continue
+        try:
+            os.remove(entry.path)
+            metrics.incr("media_store.orphan_files")
+        except OSError:
+            with contextlib.suppress(OSError):
+                left += entry.stat().st_size
+    return left
+
+
+def collect() -> dict:
+    """Один проход сборки мусора; возвращает {"documents", "bytes", "evicted"}."""
+    with _gc_lock:
+        now = time.time()
+        if not os.path.isdir(IMG_DIR):
+            return dict(_stats)
+        docs = _scan(now)
+        total = sum(size for _, size, _ in docs)
+        quota = MEDIA_QUOTA_MB * 1024 * 1024
+        ttl = MEDIA_TTL_DAYS * 86400
+        target = int(quota * 0.9)
+        evicted = 0
+        for last, size, docname in sorted(docs):
+            expired = ttl > 0 and now - last > ttl
+            over_quota = quota > 0 and total > target
+            if not (expired or over_quota):
+                continue
+            if _is_pinned(docname) or now - os.path.getmtime(os.path.join(IMG_DIR, docname)) < _GRACE:
+                continue
+            _remove(docname)
+            total -= size
+            evicted += 1
+            metrics.incr("media_store.evicted_bytes", size)
+            logger.info("Медиа %s удалены (%s)", docname, "срок хранения" if expired else "квота")
+        _stats.update(documents=len(docs) - evicted, bytes=total, last_gc=round(now, 3))
+        _stats["evicted"] += evicted
+        metrics.incr("media_store.evicted", evicted)
+        return {"documents": _stats["documents"], "bytes": total, "evicted": evicted}
+
+
+async def gc_loop() -> None:
+    """Фоновая задача: collect в отдельном потоке, чтобы не задерживать запросы."""
+    while True:
+        try:
+            await asyncio.to_thread(collect)
+        except Exception as e:
+            logger.warning("Сборка мусора медиа не удалась: %s", e)
+        await asyncio.sleep(MEDIA_GC_INTERVAL)
+
+
+def stats() -> dict:
+    return {**_stats, "quota_bytes": MEDIA_QUOTA_MB * 1024 * 1024}
+
+
+class MediaFiles(StaticFiles):
+    """StaticFiles для /img, отмечающий использование документа для вытеснения."""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200:
+            docname = path.replace("\\", "/").split("/", 1)[0]
+            if docname:
+                touch(docname)
+        return response
@@ -0,0 +1,314 @@
+"""
+Учёт памяти запросов разбора и ограничитель по бюджету воркера.
+
+Учёт: RSS процесса снимается на входе и выходе каждого спана и фоновым
+потоком раз в MEMORY_SAMPLE_INTERVAL. Для запроса /split* считается пик
+прироста RSS над значением на входе — целиком и по этапам (имя спана:
+split_docx, extract_media, pandoc, pil_jpeg, build_rows, encode_json, ...).
+Итог пишется в лог и в metrics (memory.request_mb, memory.stage.<этап>_mb).
+Параллельные запросы в одном воркере делят RSS, поэтому прирост — оценка
+давления на память во время запроса, а не точная принадлежность байтов.
+
+Ограничитель: по центральному каталогу загруженного ZIP оценивается память
+разбора (estimate). Оценка резервируется в бюджете MEMORY_BUDGET_MB до
+конца запроса; документ больше всего бюджета отклоняется сразу
+(MemoryLimitExceeded), остальные ждут своей очереди не дольше
+MEMORY_QUEUE_TIMEOUT (MemoryQueueTimeout).
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+import time
+import zipfile
+from collections import deque
+from contextvars import ContextVar
+
+from app import images, metrics
+from app.config import (MEMORY_BUDGET_MB, MEMORY_QUEUE_TIMEOUT, MEMORY_SAMPLE_INTERVAL,
+                        MEMORY_XML_FACTOR)
+from app.docx_package import DOC_XML, MEDIA_PREFIX
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+_FRESH = 0.002
+# Постоянная часть запроса (строки, JSON, индексы) — по замерам на малых документах
+_REQUEST_BASE = 3 * MB
+# Шаги пайплайна по вопросу — тысячи коротких спанов на документ, не этапы
+_SKIP_CATS = {"pipeline"}
+
+try:
+    _PAGE = os.sysconf("SC_PAGE_SIZE")
+    open("/proc/self/statm").close()
+except (AttributeError, ValueError, OSError):  # не Linux: учёт памяти выключен
+    _PAGE = None
+
+_current: ContextVar["RequestMemory | None"] = ContextVar("request_memory", default=None)
+_lock = threading.Lock()
+_active: set["RequestMemory"] = set()
+_wake = threading.Event()
+_sampler: threading.Thread | None = None
+
+
+class MemoryLimitExceeded(Exception):
+    """Оценка памяти документа больше всего бюджета воркера."""
+
+
+class MemoryQueueTimeout(Exception):
+    """Бюджет не освободился за MEMORY_QUEUE_TIMEOUT."""
+
+
+def rss() -> int | None:
+    """Текущий RSS процесса в байтах (None — не Linux)."""
+    if _PAGE is None:
+        return None
+    with open("/proc/self/statm", "rb") as f:
+        return int(f.read().split()[1]) * _PAGE
+
+
+_last = [0.0, 0]
+
+
+def _rss_fresh() -> int:
+    """RSS не старше _FRESH секунд: мелкие этапы идут тысячами на документ."""
+    now = time.monotonic()
+    if now - _last[0] > _FRESH:
+        _last[:] = now, rss() or 0
+    return _last[1]
+
+
+class RequestMemory:
+    """Пик прироста RSS за время запроса и открытых в нём этапов."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.label = ""
+        self.estimate = 0
+        self.reserved = 0
+        self.base = rss() or 0
+        self.peak = self.base
+        self.stages: dict[str, int] = {}
+        self._open: dict[str, list] = {}  # этап → [сколько открыто, пик RSS]
+
+    def update(self, value: int) -> None:
+        with _lock:
+            if value > self.peak:
+                self.peak = value
+            for entry in self._open.values():
+                if value > entry[1]:
+                    entry[1] = value
+
+    def enter(self, stage: str) -> None:
+        value = _rss_fresh()
+        with _lock:
+            entry = self._open.setdefault(stage, [0, value])
+            entry[0] += 1
+        self.update(value)
+
+    def exit(self, stage: str) -> None:
+        value = _rss_fresh()
+        self.update(value)
+        with _lock:
+            entry = self._open.get(stage)
+            if entry is None:
+                return
+            self.stages[stage] = max(entry[1] - self.base, self.stages.get(stage, 0))
+            entry[0] -= 1
+            if not entry[0]:
+                del self._open[stage]
+
+    def summary(self) -> str:
+        stages = sorted(self.stages.items(), key=lambda kv: -kv[1])[:6]
+        text = f"пик +{(self.peak - self.base) / MB:.1f} МБ (RSS {self.peak / MB:.0f} МБ)"
+        if self.estimate:
+            text += f", оценка {self.estimate / MB:.1f} МБ"
+        if stages:
+            text += "; этапы: " + ", ".join(f"{name} +{growth / MB:.1f}" for name, growth in stages)
+        return text
+
+
+def stage_enter(stage: str, cat: str) -> None:
+    account = _current.get()
+    if account is not None and cat not in _SKIP_CATS:
+        account.enter(stage)
+
+
+def stage_exit(stage: str, cat: str) -> None:
+    account = _current.get()
+    if account is not None and cat not in _SKIP_CATS:
+        account.exit(stage)
+
+
+def _sample_loop() -> None:
+    while True:
+        _wake.wait()
+        time.sleep(MEMORY_SAMPLE_INTERVAL)
+        with _lock:
+            accounts = list(_active)
+            if not accounts:
+                _wake.clear()
+                continue
+        value = rss()
+        for account in accounts:
+            account.update(value)
+
+
+def _start_sampler() -> None:
+    global _sampler
+    with _lock:
+        if _sampler is None and MEMORY_SAMPLE_INTERVAL > 0:
+            _sampler = threading.Thread(target=_sample_loop, name="memory-sampler", daemon=True)
+            _sampler.start()
+
+
+def estimate(fp, size: int) -> int:
+    """
+    Оценка памяти разбора документа, байт: постоянная часть + загрузка
+    (size) + MEMORY_XML_FACTOR × document.xml + медиа без сжатия +
+    крупнейшая картинка после декодирования. Читаются только каталог ZIP
+    и заголовки картинок.
+    """
+    xml = media = decoded = 0
+    try:
+        with zipfile.ZipFile(fp) as zin:
+            for info in zin.infolist():
+                if info.filename == DOC_XML:
+                    xml = info.file_size
+                elif info.filename.startswith(MEDIA_PREFIX) and not info.is_dir():
+                    media += info.file_size
+                    try:
+                        with zin.open(info) as f:
+                            decoded = max(decoded, images.decoded_bytes(f))
+                    except Exception:
+                        continue  # EMF/WMF и неизвестные форматы — только размер файла
+    except zipfile.BadZipFile:
+        pass  # битый .docx отклонит сам разбор
+    return int(_REQUEST_BASE + size + MEMORY_XML_FACTOR * xml + media + decoded)
+
+
+class MemoryBudget:
+    """
+    Взвешенный семафор на байты для event loop: запрос занимает свою оценку,
+    очередь — по порядку прихода (крупный документ не обгоняется мелкими).
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.free = total
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    async def acquire(self, need: int, timeout: float) -> None:
+        if need > self.total:
+            raise MemoryLimitExceeded(
+                f"Документ потребует около {need / MB:.1f} МБ памяти, бюджет воркера {self.total / MB:.1f} МБ")
+        if not self._waiters and self.free >= need:
+            self.free -= need
+            return
+        metrics.incr("memory.queued")
+        fut = asyncio.get_running_loop().create_future()
+        waiter = (need, fut)
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                self.release(need)  # бюджет выдан в последний момент
+            else:
+                fut.cancel()
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove(waiter)
+                self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.incr("memory.queue_timeouts")
+                raise MemoryQueueTimeout(
+                    f"Нет свободной памяти для разбора за {timeout:g} c, повторите позже") from None
+            raise
+        task = asyncio.current_task()
+        if task is not None and task.cancelling():
+            # wait_for в 3.11 глотает отмену, пришедшую вместе с выдачей бюджета
+            self.release(need)
+            raise asyncio.CancelledError()
+
+    def release(self, n: int) -> None:
+        self.free += n
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.free >= self._waiters[0][0]:
+            need, fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self.free -= need
+            fut.set_result(None)
+
+    def stats(self) -> dict:
+        return {"budget_mb": round(self.total / MB, 1), "reserved_mb": round((self.total - self.free) / MB, 1),
+                "waiting": len(self._waiters)}
+
+
+budget = MemoryBudget(MEMORY_BUDGET_MB * MB) if MEMORY_BUDGET_MB > 0 else None
+
+
+async def reserve(fp, size: int, label: str) -> None:
+    """
+    Оценивает память документа и занимает её в бюджете до конца запроса
+    (освобождает RequestMemoryMiddleware). Без бюджета — только оценка для лога.
+    """
+    need = await asyncio.to_thread(estimate, fp, size)
+    metrics.observe("memory.estimate_mb", need / MB)
+    account = _current.get()
+    if account is not None:
+        account.label, account.estimate = label, need
+    if budget is None:
+        return
+    try:
+        await budget.acquire(need, MEMORY_QUEUE_TIMEOUT)
+    except MemoryLimitExceeded:
+        metrics.incr("memory.rejected")
+        logger.warning("Документ %s отклонён: оценка памяти %.1f МБ больше бюджета", label, need / MB)
+        raise
+    if account is not None:
+        account.reserved = need
+    else:
+        budget.release(need)  # вне учёта запроса освободить будет некому
+
+
+def stats() -> dict:
+    value = rss()
+    return {"rss_mb": round(value / MB, 1) if value else None,
+            **(budget.stats() if budget is not None else {"budget_mb": 0})}
+
+
+class RequestMemoryMiddleware:
+    """
+    Учёт памяти запросов /split*: пик в лог и metrics, освобождение
+    зарезервированного бюджета после отправки ответа.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _PAGE is None or scope["type"] != "http" or not scope["path"].startswith("/split"):
+            return await self.app(scope, receive, send)
+        account = RequestMemory(scope["path"])
+        token = _current.set(account)
+        with _lock:
+            _active.add(account)
+        _wake.set()
+        _start_sampler()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
+            with _lock:
+                _active.discard(account)
+            account.update(rss() or 0)
+            if account.reserved and budget is not None:
+                budget.release(account.reserved)
+            metrics.observe("memory.request_mb", (account.peak - account.base) / MB)
+            for stage, growth in account.stages.items():
+                metrics.observe(f"memory.stage.{stage}_mb", growth / MB)
+            logger.info("Память %s %s: %s", account.path, account.label, account.summary())
@@ -0,0 +1,31 @@
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters: dict[str, int] = defaultdict(int)
+_timings: dict[str, list] = {}
+
+
+def incr(name: str, n: int = 1) -> None:
+    with _lock:
+        _counters[name] += n
+
+
+def observe(name: str, value: float) -> None:
+    """Накопительная статистика по значению (count/sum/max), например по длительности."""
+    with _lock:
+        t = _timings.setdefault(name, [0, 0.0, 0.0])
+        t[0] += 1
+        t[1] += value
+        t[2] = max(t[2], value)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "timings": {
+                name: {"count": c, "sum": round(s, 6), "avg": round(s / c, 6) if c else 0.0, "max": round(m, 6)}
+                for name, (c, s, m) in _timings.items()
+            },
+        }
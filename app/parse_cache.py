@@ -0,0 +1,98 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+
+from app import metrics
+from app.config import PARSE_CACHE_SIZE
+
+_MEDIA_TOKEN = "@@media:{}@@"
+
+
+def tokenize_media(md: str, media: dict) -> str:
+    """
+    Заменяет пути медиа в markdown ({путь в архиве: sha256}) на метки по хэшу:
+    имена медиа внутри архива у разных файлов и версий разные.
+    """
+    for target, sha in media.items():
+        md = md.replace(target, _MEDIA_TOKEN.format(sha))
+    return md
+
+
+def resolve_media(md: str, media: dict) -> str:
+    """Обратная замена: метки по хэшу → пути медиа текущего архива."""
+    for target, sha in media.items():
+        md = md.replace(_MEDIA_TOKEN.format(sha), target)
+    return md
+
+
+class ParseCache:
+    """
+    LRU-кэш разбора вопросов, общий для всех загрузок:
+    - markdown от pandoc по нормализованному отпечатку части документа;
+    - состояние пайплайна по хэшу итогового текста и типу пайплайна.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key, kind: str):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        metrics.incr(f"parse_cache.{kind}.{'miss' if value is None else 'hit'}")
+        return value
+
+    def _put(self, key, value) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_markdown(self, fingerprint: str, media: dict) -> str | None:
+        """media — {путь в архиве: sha256} для текущего документа."""
+        md = self._get(("md", fingerprint), "markdown")
+        return resolve_media(md, media) if md is not None else None
+
+    def put_markdown(self, fingerprint: str, md: str, media: dict) -> None:
+        self._put(("md", fingerprint), tokenize_media(md, media))
+
+    @staticmethod
+    def _text_key(text: str, kind: str) -> tuple:
+        return "state", kind, hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_state(self, text: str, kind: str) -> dict | None:
+        # Копия: эндпоинты дочищают вложенные поля состояния на месте
+        state = self._get(self._text_key(text, kind), "state")
+        return copy.deepcopy(state) if state is not None else None
+
+    def put_state(self, text: str, kind: str, state: dict) -> None:
+        self._put(self._text_key(text, kind), copy.deepcopy(state))
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+parse_cache = ParseCache(PARSE_CACHE_SIZE)
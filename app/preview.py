@@ -0,0 +1,141 @@
+"""
+Сохранённые результаты разбора для постраничного просмотра (GET /preview/...).
+Строки лежат в SQLite в тех же колонках, что и экспорт в sqlite, поэтому
+выбор полей — это выбор колонок. Страницы — по курсору (row_no последней
+отданной строки), без OFFSET: любая страница читается по первичному ключу.
+Хранятся последние PREVIEW_MAX_DOCUMENTS разборов.
+"""
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from app.config import PREVIEW_DB, PREVIEW_MAX_DOCUMENTS, PREVIEW_PAGE_MAX
+from app.export import QUESTION_COLUMNS, question_records
+from app.rows import QuestionRow
+
+logger = logging.getLogger(__name__)
+
+JSON_COLUMNS = ("otvety", "pravOtv")
+FIELDS = QUESTION_COLUMNS[1:]  # всё, кроме row_no — он отдаётся всегда
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    docname TEXT,
+    created REAL,
+    total INTEGER
+);
+CREATE TABLE IF NOT EXISTS questions (
+    doc_id TEXT NOT NULL,
+    {", ".join(QUESTION_COLUMNS)},
+    PRIMARY KEY (doc_id, row_no)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_documents_created ON documents(created);
+"""
+
+_init_lock = threading.Lock()
+_ready = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _ready
+    conn = sqlite3.connect(PREVIEW_DB, timeout=10)
+    if not _ready:
+        with _init_lock:
+            if not _ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                _ready = True
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def save(docname: str, rows: list[QuestionRow]) -> str | None:
+    """Сохраняет строки разбора; возвращает doc_id для /preview или None."""
+    if PREVIEW_MAX_DOCUMENTS <= 0:
+        return None
+    doc_id = uuid.uuid4().hex
+    try:
+        os.makedirs(os.path.dirname(PREVIEW_DB), exist_ok=True)
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO documents VALUES (?, ?, ?, ?)",
+                             (doc_id, docname, time.time(), len(rows)))
+                conn.executemany(
+                    f"INSERT INTO questions VALUES (?, {','.join('?' * len(QUESTION_COLUMNS))})",
+                    ((doc_id, *rec) for rec in question_records(rows)))
+                _prune(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.warning("Не удалось сохранить разбор %s для просмотра: %s", docname, e)
+        return None
+    return doc_id
+
+
+def _prune(conn: sqlite3.Connection) -> None:
+    old = [r[0] for r in conn.execute(
+        "SELECT doc_id FROM documents ORDER BY created DESC LIMIT -1 OFFSET ?",
+        (PREVIEW_MAX_DOCUMENTS,))]
+    for doc_id in old:
+        conn.execute("DELETE FROM questions WHERE doc_id = ?", (doc_id,))
+        conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+
+
+def encode_cursor(row_no: int) -> str:
+    return base64.urlsafe_b64encode(str(row_no).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str | None) -> int:
+    if not cursor:
+        return 0
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError(f"Неверный курсор: {cursor}")
+
+
+def page(doc_id: str, cursor: str | None = None, limit: int = 20,
+         fields: list[str] | None = None) -> dict | None:
+    """
+    Страница вопросов после курсора: {"doc_id", "docname", "total",
+    "questions": [{"row_no", поля...}], "next_cursor"}. None — разбора нет.
+    fields — подмножество FIELDS (по умолчанию все).
+    """
+    fields = list(fields or FIELDS)
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+    after = decode_cursor(cursor)
+    limit = max(1, min(limit, PREVIEW_PAGE_MAX))
+    if not os.path.exists(PREVIEW_DB):
+        return None
+    conn = _connect()
+    try:
+        doc = conn.execute("SELECT docname, total FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+        if doc is None:
+            return None
+        rows = conn.execute(
+            f"SELECT row_no, {', '.join(fields)} FROM questions "
+            "WHERE doc_id = ? AND row_no > ? ORDER BY row_no LIMIT ?",
+            (doc_id, after, limit + 1)).fetchall()
+    finally:
+        conn.close()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    questions = []
+    for row in rows:
+        item = {"row_no": row[0]}
+        for name, value in zip(fields, row[1:]):
+            item[name] = json.loads(value) if name in JSON_COLUMNS and value is not None else value
+        questions.append(item)
+    return {
+        "doc_id": doc_id, "docname": doc[0], "total": doc[1], "questions": questions,
+        "next_cursor": encode_cursor(rows[-1][0]) if has_more else None,
+    }
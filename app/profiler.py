@@ -0,0 +1,220 @@
+"""
+Встроенный сэмплирующий профилировщик (GET /debug/profile).
+
+Поток-сэмплер PROFILER_HZ раз в секунду снимает стеки всех потоков
+(sys._current_frames) и считает одинаковые стеки; результат — данные для
+flame graph в формате collapsed stacks (flamegraph.pl, speedscope).
+
+Каждый стек относится к маршруту:
+- в потоке event loop — по коду эндпоинта, найденному в стеке, или по
+  текущей задаче asyncio: задачи, созданные при обработке запроса
+  (ensure_future и т.п.), наследуют его маршрут;
+- в рабочих потоках asyncio.to_thread — по маршруту, из которого задача
+  была отправлена (RouteExecutor запоминает его при submit).
+Простаивающие потоки (ожидание в select, пустой пул, ожидание дочерних
+процессов) не учитываются.
+
+Если снимок стоит дороже, чем позволяет PROFILER_MAX_OVERHEAD, интервал
+между снимками растягивается.
+"""
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import PROFILER_HZ, PROFILER_MAX_OVERHEAD, PROFILER_MAX_STACKS
+
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = 96
+NO_ROUTE = "-"
+# (файл, функция) самого вложенного кадра простаивающего потока
+_IDLE = {("selectors.py", "select"), ("thread.py", "_worker"), ("threading.py", "wait"),
+         ("queue.py", "get"), ("unix_events.py", "_do_waitpid")}
+
+_endpoints: dict = {}  # code эндпоинта → путь маршрута
+_thread_routes: dict[int, str] = {}
+_task_routes: "weakref.WeakKeyDictionary[asyncio.Task, str]" = weakref.WeakKeyDictionary()
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_tid: int | None = None
+_counts: collections.Counter = collections.Counter()
+_lock = threading.Lock()
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+_stats = {"samples": 0, "dropped": 0, "sampling_seconds": 0.0, "started": None, "interval": None}
+
+
+def register_routes(routes) -> None:
+    """Запоминает код эндпоинтов приложения для отнесения стеков к маршрутам."""
+    for route in routes:
+        endpoint = getattr(route, "endpoint", None)
+        code = getattr(endpoint, "__code__", None)
+        if code is not None:
+            _endpoints[code] = route.path
+
+
+def _route_of(frame) -> str | None:
+    while frame is not None:
+        route = _endpoints.get(frame.f_code)
+        if route is not None:
+            return route
+        frame = frame.f_back
+    return None
+
+
+def _task_route() -> str | None:
+    try:
+        return _task_routes.get(asyncio.current_task(_loop))
+    except Exception:  # задача завершается, словарь меняется
+        return None
+
+
+def _task_factory(loop, coro, **kwargs):
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    route = _route_of(sys._getframe(1)) or _task_route()
+    if route is not None:
+        _task_routes[task] = route
+    return task
+
+
+class RouteExecutor(ThreadPoolExecutor):
+    """Пул по умолчанию для event loop: рабочий поток знает маршрут своей задачи."""
+
+    def __init__(self):
+        super().__init__(thread_name_prefix="asyncio")
+
+    def submit(self, fn, /, *args, **kwargs):
+        route = None
+        if _thread is not None and threading.get_ident() == _loop_tid:
+            route = _route_of(sys._getframe(1)) or _task_route()
+        if route is None:
+            return super().submit(fn, *args, **kwargs)
+        return super().submit(_run_for_route, route, fn, *args, **kwargs)
+
+
+def _run_for_route(route: str, fn, *args, **kwargs):
+    tid = threading.get_ident()
+    _thread_routes[tid] = route
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _thread_routes.pop(tid, None)
+
+
+def _sample(me: int) -> None:
+    for tid, frame in sys._current_frames().items():
+        if tid == me:
+            continue
+        route = _thread_routes.get(tid)
+        code = frame.f_code
+        if route is None and (os.path.basename(code.co_filename), code.co_name) in _IDLE:
+            continue
+        codes = []
+        f = frame
+        while f is not None and len(codes) < MAX_DEPTH:
+            code = f.f_code
+            if route is None:
+                route = _endpoints.get(code)
+            codes.append(code)
+            f = f.f_back
+        if route is None:
+            route = _route_of(f)
+        if route is None and tid == _loop_tid:
+            route = _task_route()
+        key = (route or NO_ROUTE, tuple(codes))
+        with _lock:
+            if key in _counts or len(_counts) < PROFILER_MAX_STACKS:
+                _counts[key] += 1
+            else:
+                _stats["dropped"] += 1
+
+
+def _run() -> None:
+    me = threading.get_ident()
+    interval = 1 / PROFILER_HZ
+    cost = 0.0
+    while not _stop.wait(interval):
+        t0 = time.perf_counter()
+        try:
+            _sample(me)
+        except Exception as e:
+            logger.warning("Снимок стеков не удался: %s", e)
+        spent = time.perf_counter() - t0
+        cost = spent if not cost else 0.8 * cost + 0.2 * spent
+        interval = max(1 / PROFILER_HZ, cost / PROFILER_MAX_OVERHEAD)
+        with _lock:
+            _stats["samples"] += 1
+            _stats["sampling_seconds"] += spent
+            _stats["interval"] = round(interval, 4)
+
+
+def start(routes) -> bool:
+    """
+    Запускает сэмплер, если PROFILER_HZ > 0; вызывается в потоке event loop.
+    Ставит loop пул RouteExecutor и фабрику задач. True — запущен.
+    """
+    global _thread, _loop, _loop_tid
+    if PROFILER_HZ <= 0 or _thread is not None:
+        return False
+    register_routes(routes)
+    _loop = asyncio.get_running_loop()
+    _loop_tid = threading.get_ident()
+    _loop.set_default_executor(RouteExecutor())
+    if _loop.get_task_factory() is None:
+        _loop.set_task_factory(_task_factory)
+    _stop.clear()
+    _stats["started"] = time.time()
+    _thread = threading.Thread(target=_run, name="profiler", daemon=True)
+    _thread.start()
+    return True
+
+
+def stop() -> None:
+    global _thread
+    if _thread is not None:
+        _stop.set()
+        _thread.join(timeout=5)
+        _thread = None
+
+
+def reset() -> None:
+    with _lock:
+        _counts.clear()
+        _stats.update(samples=0, dropped=0, sampling_seconds=0.0, started=time.time())
+
+
+def _label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapsed(route: str | None = None) -> list[tuple[str, int]]:
+    """[(«маршрут;внешний кадр;…;внутренний кадр», число снимков)], по убыванию."""
+    with _lock:
+        items = list(_counts.items())
+    out = []
+    for (stack_route, codes), count in items:
+        if route is not None and stack_route != route:
+            continue
+        out.append((";".join([stack_route, *(_label(c) for c in reversed(codes))]), count))
+    out.sort(key=lambda item: -item[1])
+    return out
+
+
+def stats() -> dict:
+    with _lock:
+        elapsed = time.time() - _stats["started"] if _stats["started"] else 0.0
+        return {
+            "running": _thread is not None,
+            "hz": PROFILER_HZ,
+            "interval": _stats["interval"],
+            "samples": _stats["samples"],
+            "distinct_stacks": len(_counts),
+            "dropped": _stats["dropped"],
+            "overhead": round(_stats["sampling_seconds"] / elapsed, 5) if elapsed else 0.0,
+            "routes": sorted({r for r, _ in _counts}),
+        }
@@ -0,0 +1,540 @@
+"""
+Растеризация векторных картинок (WMF/EMF) по уровням, от дешёвого к дорогому:
+- WMF — wmf2gd из libwmf-bin;
+- EMF — встроенный рендер простого подмножества записей EMF, которым
+  MathType рисует формулы-превью (линии, многоугольники, текст);
+- LibreOffice — если быстрый путь не справился или дал пустую картинку.
+Для каждого уровня в metrics пишутся raster.<уровень>.ok/fail/blank
+и длительность span.raster.<уровень>.
+"""
+import functools
+import logging
+import os
+import struct
+
+from PIL import Image, ImageDraw, ImageFont
+
+from app import metrics, subproc
+from app.config import LIBREOFFICE_BIN, LIBREOFFICE_TIMEOUT, RASTER_DPI, RASTER_FONT_DIR, \
+    WMF2GD_BIN, WMF2GD_TIMEOUT
+from app.tracing import span
+
+logger = logging.getLogger(__name__)
+
+TIERS = ("wmf2gd", "emf_native", "libreoffice")
+
+# Картинки больше этого по стороне встроенный рендер не рисует
+_MAX_SIDE = 6000
+
+
+class Unsupported(Exception):
+    """Встроенный рендер не умеет эту картинку — нужен следующий уровень."""
+
+
+def is_blank(img: Image.Image) -> bool:
+    """Картинка пустая: все пиксели белые или полностью прозрачные."""
+    if img.mode in ("RGBA", "LA", "P"):
+        rgba = img.convert("RGBA")
+        bg = Image.new("RGBA", rgba.size, "white")
+        img = Image.alpha_composite(bg, rgba)
+    lo, _ = img.convert("L").getextrema()
+    return lo >= 250
+
+
+def rasterize(src_path: str) -> str:
+    """
+    WMF/EMF → PNG рядом с исходником (исходник удаляется).
+    Возвращает путь к PNG; если не справился ни один уровень — исключение
+    последнего (LibreOffice).
+    """
+    root = os.path.dirname(src_path)
+    base, ext = os.path.splitext(os.path.basename(src_path))
+    png_path = os.path.join(root, f"{base}.png")
+    ext = ext.lower()
+
+    fast = []
+    if ext == ".wmf":
+        fast.append(("wmf2gd", _wmf2gd))
+    elif ext == ".emf":
+        fast.append(("emf_native", _emf_native))
+    for tier, convert in fast:
+        if _try_tier(tier, convert, src_path, png_path):
+            os.remove(src_path)
+            return png_path
+
+    _try_tier("libreoffice", _libreoffice, src_path, png_path, raise_errors=True)
+    os.remove(src_path)
+    return png_path
+
+
+def _try_tier(tier: str, convert, src_path: str, png_path: str, raise_errors: bool = False) -> bool:
+    try:
+        with span(tier, cat="raster", file=os.path.basename(src_path)):
+            convert(src_path, png_path)
+            with Image.open(png_path) as img:
+                blank = is_blank(img)
+    except subproc.Cancelled:
+        raise
+    except Exception as e:
+        metrics.incr(f"raster.{tier}.fail")
+        if raise_errors:
+            raise
+        logger.debug("raster %s не справился с %s: %s", tier, src_path, e)
+        return False
+    if blank and not raise_errors:
+        metrics.incr(f"raster.{tier}.blank")
+        logger.debug("raster %s дал пустую картинку для %s", tier, src_path)
+        return False
+    metrics.incr(f"raster.{tier}.ok")
+    return True
+
+
+def _wmf2gd(src_path: str, png_path: str) -> None:
+    subproc.run([WMF2GD_BIN, "-t", "png", "-o", png_path, src_path], WMF2GD_TIMEOUT)
+
+
+def _libreoffice(src_path: str, png_path: str) -> None:
+    subproc.run([
+        LIBREOFFICE_BIN,
+        "--headless",
+        "--convert-to", "png",
+        src_path,
+        "--outdir", os.path.dirname(png_path)
+    ], LIBREOFFICE_TIMEOUT)
+
+
+def _emf_native(src_path: str, png_path: str) -> None:
+    with open(src_path, "rb") as f:
+        data = f.read()
+    render_emf(data, RASTER_DPI).save(png_path, "PNG")
+
+
+def stats() -> dict:
+    """Доля успехов и средняя длительность по уровням — для /metrics."""
+    snap = metrics.snapshot()
+    out = {}
+    for tier in TIERS:
+        ok, fail, blank = (snap["counters"].get(f"raster.{tier}.{k}", 0) for k in ("ok", "fail", "blank"))
+        total = ok + fail + blank
+        if not total:
+            continue
+        timing = snap["timings"].get(f"span.raster.{tier}", {})
+        out[tier] = {
+            "ok": ok, "fail": fail, "blank": blank,
+            "success_rate": round(ok / total, 4),
+            "avg_seconds": timing.get("avg", 0.0),
+        }
+    return out
+
+
+# --- Встроенный рендер EMF ------------------------------------------------
+
+# Типы записей EMF (MS-EMF 2.1.1)
+EMR_HEADER = 1
+EMR_POLYBEZIER, EMR_POLYGON, EMR_POLYLINE, EMR_POLYBEZIERTO, EMR_POLYLINETO = 2, 3, 4, 5, 6
+EMR_POLYPOLYLINE, EMR_POLYPOLYGON = 7, 8
+EMR_SETWINDOWEXTEX, EMR_SETWINDOWORGEX, EMR_SETVIEWPORTEXTEX, EMR_SETVIEWPORTORGEX = 9, 10, 11, 12
+EMR_EOF = 14
+EMR_SETMAPMODE = 17
+EMR_SETTEXTALIGN = 22
+EMR_SETTEXTCOLOR = 24
+EMR_MOVETOEX = 27
+EMR_SAVEDC, EMR_RESTOREDC = 33, 34
+EMR_SETWORLDTRANSFORM, EMR_MODIFYWORLDTRANSFORM = 35, 36
+EMR_SELECTOBJECT, EMR_CREATEPEN, EMR_CREATEBRUSHINDIRECT, EMR_DELETEOBJECT = 37, 38, 39, 40
+EMR_ELLIPSE, EMR_RECTANGLE = 42, 43
+EMR_LINETO = 54
+EMR_BEGINPATH, EMR_ENDPATH, EMR_CLOSEFIGURE = 59, 60, 61
+EMR_FILLPATH, EMR_STROKEANDFILLPATH, EMR_STROKEPATH = 62, 63, 64
+EMR_EXTCREATEFONTINDIRECTW = 82
+EMR_EXTTEXTOUTW = 84
+EMR_POLYBEZIER16, EMR_POLYGON16, EMR_POLYLINE16, EMR_POLYBEZIERTO16, EMR_POLYLINETO16 = 85, 86, 87, 88, 89
+EMR_POLYPOLYLINE16, EMR_POLYPOLYGON16 = 90, 91
+EMR_EXTCREATEPEN = 95
+
+# Записи, которые не влияют на картинку формулы (режимы, отсечение, комментарии)
+_IGNORED = {
+    15, 16, 18, 19, 20, 21, 23, 25, 26, 29, 30, 58, 67, 70, 75, 98, 115,
+}
+
+_MM_TEXT, _MM_ANISOTROPIC = 1, 8
+_TA_UPDATECP, _TA_RIGHT, _TA_CENTER, _TA_BOTTOM, _TA_BASELINE = 1, 2, 6, 8, 24
+_PS_NULL, _BS_NULL = 5, 1
+_ETO_PDY = 0x2000
+
+# Стандартные объекты GDI (индекс | 0x80000000)
+_STOCK_BRUSHES = {0: (255, 255, 255), 1: (192, 192, 192), 2: (128, 128, 128), 3: (64, 64, 64), 4: (0, 0, 0)}
+_STOCK_PENS = {6: (255, 255, 255), 7: (0, 0, 0)}
+
+# Кодировка шрифта Symbol → Unicode; символы вне таблицы (куски больших
+# скобок и т.п.) встроенный рендер не рисует
+_SYMBOL = {
+    0x20: " ", 0x21: "!", 0x22: "∀", 0x23: "#", 0x24: "∃", 0x25: "%", 0x26: "&", 0x27: "∋",
+    0x28: "(", 0x29: ")", 0x2A: "∗", 0x2B: "+", 0x2C: ",", 0x2D: "−", 0x2E: ".", 0x2F: "/",
+    0x3A: ":", 0x3B: ";", 0x3C: "<", 0x3D: "=", 0x3E: ">", 0x3F: "?", 0x40: "≅",
+    0x5B: "[", 0x5C: "∴", 0x5D: "]", 0x5E: "⊥", 0x5F: "_",
+    0x7B: "{", 0x7C: "|", 0x7D: "}", 0x7E: "∼",
+    0xA2: "′", 0xA3: "≤", 0xA4: "⁄", 0xA5: "∞", 0xA6: "ƒ", 0xAB: "↔", 0xAC: "←", 0xAD: "↑",
+    0xAE: "→", 0xAF: "↓", 0xB0: "°", 0xB1: "±", 0xB2: "″", 0xB3: "≥", 0xB4: "×", 0xB5: "∝",
+    0xB6: "∂", 0xB7: "•", 0xB8: "÷", 0xB9: "≠", 0xBA: "≡", 0xBB: "≈", 0xBC: "…",
+    0xC0: "ℵ", 0xC4: "⊗", 0xC5: "⊕", 0xC6: "∅", 0xC7: "∩", 0xC8: "∪", 0xC9: "⊃", 0xCA: "⊇",
+    0xCB: "⊄", 0xCC: "⊂", 0xCD: "⊆", 0xCE: "∈", 0xCF: "∉", 0xD0: "∠", 0xD1: "∇", 0xD5: "∏",
+    0xD6: "√", 0xD7: "⋅", 0xD8: "¬", 0xD9: "∧", 0xDA: "∨", 0xDB: "⇔", 0xDC: "⇐", 0xDD: "⇑",
+    0xDE: "⇒", 0xDF: "⇓", 0xE0: "◊", 0xE1: "〈", 0xE5: "∑", 0xF1: "〉", 0xF2: "∫",
+}
+_SYMBOL.update({0x30 + i: str(i) for i in range(10)})
+_SYMBOL.update(zip(range(0x41, 0x5B), "ΑΒΧΔΕΦΓΗΙϑΚΛΜΝΟΠΘΡΣΤΥςΩΞΨΖ"))
+_SYMBOL.update(zip(range(0x61, 0x7B), "αβχδεφγηιϕκλμνοπθρστυϖωξψζ"))
+
+
+def _color(ref: int) -> tuple[int, int, int]:
+    return ref & 0xFF, (ref >> 8) & 0xFF, (ref >> 16) & 0xFF
+
+
+@functools.lru_cache(maxsize=64)
+def _font(family: str, bold: bool, italic: bool, size: int):
+    suffixes = []
+    if bold and italic:
+        suffixes.append("-BoldOblique" if family == "Sans" else "-BoldItalic")
+    if italic:
+        suffixes.append("-Oblique" if family == "Sans" else "-Italic")
+    if bold:
+        suffixes.append("-Bold")
+    suffixes.append("")
+    for suffix in suffixes:
+        path = os.path.join(RASTER_FONT_DIR, f"DejaVu{family}{suffix}.ttf")
+        if os.path.exists(path):
+            return ImageFont.truetype(path, size)
+    raise Unsupported(f"нет шрифта DejaVu{family} в {RASTER_FONT_DIR}")
+
+
+def _decode_text(text: str, face: str) -> str:
+    symbol = face.lower().startswith("symbol")
+    if "mt extra" in face.lower():
+        raise Unsupported("шрифт MT Extra")
+    out = []
+    for ch in text:
+        code = ord(ch)
+        if symbol:
+            if 0xF000 <= code <= 0xF0FF:
+                code -= 0xF000
+            if code not in _SYMBOL:
+                raise Unsupported(f"символ Symbol 0x{code:02X}")
+            out.append(_SYMBOL[code])
+        elif 0xE000 <= code <= 0xF8FF:
+            raise Unsupported(f"символ из области PUA U+{code:04X}")
+        else:
+            out.append(ch)
+    return "".join(out)
+
+
+def _bezier(p0, p1, p2, p3, steps: int = 8) -> list:
+    pts = []
+    for i in range(1, steps + 1):
+        t = i / steps
+        mt = 1 - t
+        pts.append((
+            mt ** 3 * p0[0] + 3 * mt * mt * t * p1[0] + 3 * mt * t * t * p2[0] + t ** 3 * p3[0],
+            mt ** 3 * p0[1] + 3 * mt * mt * t * p1[1] + 3 * mt * t * t * p2[1] + t ** 3 * p3[1],
+        ))
+    return pts
+
+
+def render_emf(data: bytes, dpi: int) -> Image.Image:
+    """
+    Рисует EMF средствами PIL. Поддерживаются MM_TEXT/MM_ANISOTROPIC, перья,
+    кисти, линии, многоугольники, кривые Безье, пути и текст (EXTTEXTOUTW);
+    на любой другой записи — Unsupported.
+    """
+    if len(data) < 88 or struct.unpack_from("<I", data, 0)[0] != EMR_HEADER or data[40:44] != b" EMF":
+        raise Unsupported("не EMF")
+    frame = struct.unpack_from("<4i", data, 24)  # в сотых долях мм
+    dev_px = struct.unpack_from("<2i", data, 72)
+    dev_mm = struct.unpack_from("<2i", data, 80)
+    if min(dev_px + dev_mm) <= 0:
+        raise Unsupported("нет размеров устройства")
+    unit_mm = (dev_mm[0] / dev_px[0], dev_mm[1] / dev_px[1])  # мм на единицу устройства
+    px_mm = dpi / 25.4
+    width = round((frame[2] - frame[0]) / 100 * px_mm)
+    height = round((frame[3] - frame[1]) / 100 * px_mm)
+    if not (0 < width <= _MAX_SIDE and 0 < height <= _MAX_SIDE):
+        raise Unsupported(f"размер {width}×{height}")
+    origin = (frame[0] / 100 / unit_mm[0], frame[1] / 100 / unit_mm[1])  # в единицах устройства
+    scale = (unit_mm[0] * px_mm, unit_mm[1] * px_mm)  # единица устройства → пиксель
+
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+
+    st = {
+        "worg": (0, 0), "wext": (1, 1), "vorg": (0, 0), "vext": (1, 1), "mapmode": _MM_TEXT,
+        "pen": ((0, 0, 0), 1), "brush": (255, 255, 255), "font": None,
+        "text_color": (0, 0, 0), "align": 0, "pos": (0, 0),
+    }
+    saved: list[dict] = []
+    objects: dict[int, tuple] = {}
+    path: list[list] | None = None
+
+    def to_px(x, y) -> tuple[float, float]:
+        if st["mapmode"] == _MM_ANISOTROPIC:
+            x = (x - st["worg"][0]) * st["vext"][0] / st["wext"][0] + st["vorg"][0]
+            y = (y - st["worg"][1]) * st["vext"][1] / st["wext"][1] + st["vorg"][1]
+        else:
+            x = x - st["worg"][0] + st["vorg"][0]
+            y = y - st["worg"][1] + st["vorg"][1]
+        return (x - origin[0]) * scale[0], (y - origin[1]) * scale[1]
+
+    def len_px(v: float, axis: int = 1) -> float:
+        k = st["vext"][axis] / st["wext"][axis] if st["mapmode"] == _MM_ANISOTROPIC else 1
+        return abs(v * k * scale[axis])
+
+    def stroke(pts: list, closed: bool = False) -> None:
+        color, w = st["pen"]
+        if color is None or len(pts) < 2:
+            return
+        draw.line(pts + [pts[0]] if closed else pts, fill=color, width=max(1, round(len_px(w, 0))))
+
+    def fill(pts: list) -> None:
+        if st["brush"] is not None and len(pts) >= 3:
+            draw.polygon(pts, fill=st["brush"])
+
+    def points(off: int, count: int, small: bool) -> list:
+        fmt = "<%dh" if small else "<%di"
+        vals = struct.unpack_from(fmt % (2 * count), data, off)
+        return [to_px(vals[i], vals[i + 1]) for i in range(0, len(vals), 2)]
+
+    def emit(kind: str, pts: list) -> None:
+        """Многоугольник/ломаная/кривая: в путь, если он открыт, иначе сразу на холст."""
+        nonlocal path
+        if kind in ("bezierto", "lineto"):
+            start = to_px(*st["pos"])
+            seq = [start]
+            if kind == "bezierto":
+                for i in range(0, len(pts) - 2, 3):
+                    seq += _bezier(seq[-1], pts[i], pts[i + 1], pts[i + 2])
+            else:
+                seq += pts
+            if path is not None:
+                if not path or path[-1][0] != start:
+                    path.append([start])
+                path[-1] += seq[1:]
+            else:
+                stroke(seq)
+            return
+        if kind == "bezier":
+            seq = [pts[0]]
+            for i in range(1, len(pts) - 2, 3):
+                seq += _bezier(seq[-1], pts[i], pts[i + 1], pts[i + 2])
+            pts, kind = seq, "line"
+        if path is not None:
+            path.append(list(pts))
+        elif kind == "polygon":
+            fill(pts)
+            stroke(pts, closed=True)
+        else:
+            stroke(pts)
+
+    def device_to_logical(px: tuple[float, float]) -> tuple[int, int]:
+        # для обновления текущей позиции после poly*to
+        x = px[0] / scale[0] + origin[0]
+        y = px[1] / scale[1] + origin[1]
+        if st["mapmode"] == _MM_ANISOTROPIC:
+            x = (x - st["vorg"][0]) * st["wext"][0] / st["vext"][0] + st["worg"][0]
+            y = (y - st["vorg"][1]) * st["wext"][1] / st["vext"][1] + st["worg"][1]
+        else:
+            x, y = x - st["vorg"][0] + st["worg"][0], y - st["vorg"][1] + st["worg"][1]
+        return round(x), round(y)
+
+    off = 0
+    while off + 8 <= len(data):
+        rtype, size = struct.unpack_from("<II", data, off)
+        if size < 8 or off + size > len(data):
+            raise Unsupported("повреждённая запись")
+        p = off + 8
+        if rtype == EMR_HEADER or rtype in _IGNORED:
+            pass
+        elif rtype == EMR_EOF:
+            break
+        elif rtype == EMR_SETMAPMODE:
+            mode = struct.unpack_from("<I", data, p)[0]
+            if mode not in (_MM_TEXT, _MM_ANISOTROPIC):
+                raise Unsupported(f"режим отображения {mode}")
+            st["mapmode"] = mode
+        elif rtype == EMR_SETWINDOWEXTEX:
+            ext = struct.unpack_from("<2i", data, p)
+            if 0 in ext:
+                raise Unsupported("нулевой размер окна")
+            st["wext"] = ext
+        elif rtype == EMR_SETWINDOWORGEX:
+            st["worg"] = struct.unpack_from("<2i", data, p)
+        elif rtype == EMR_SETVIEWPORTEXTEX:
+            ext = struct.unpack_from("<2i", data, p)
+            if 0 in ext:
+                raise Unsupported("нулевой размер области вывода")
+            st["vext"] = ext
+        elif rtype == EMR_SETVIEWPORTORGEX:
+            st["vorg"] = struct.unpack_from("<2i", data, p)
+        elif rtype in (EMR_SETWORLDTRANSFORM, EMR_MODIFYWORLDTRANSFORM):
+            xform = struct.unpack_from("<6f", data, p)
+            mode = struct.unpack_from("<I", data, p + 24)[0] if rtype == EMR_MODIFYWORLDTRANSFORM else 0
+            if mode != 1 and any(abs(a - b) > 1e-6 for a, b in zip(xform, (1, 0, 0, 1, 0, 0))):
+                raise Unsupported("мировое преобразование")
+        elif rtype == EMR_SAVEDC:
+            saved.append(dict(st))
+        elif rtype == EMR_RESTOREDC:
+            n = struct.unpack_from("<i", data, p)[0]
+            for _ in range(-n if n < 0 else 1):
+                if saved:
+                    st = saved.pop()
+        elif rtype == EMR_SETTEXTALIGN:
+            st["align"] = struct.unpack_from("<I", data, p)[0]
+        elif rtype == EMR_SETTEXTCOLOR:
+            st["text_color"] = _color(struct.unpack_from("<I", data, p)[0])
+        elif rtype == EMR_CREATEPEN:
+            ih, style, width, _, color = struct.unpack_from("<IIiiI", data, p)
+            objects[ih] = ("pen", None if style & 0xF == _PS_NULL else _color(color), width)
+        elif rtype == EMR_EXTCREATEPEN:
+            ih = struct.unpack_from("<I", data, p)[0]
+            style, width, _, color = struct.unpack_from("<IIII", data, p + 20)
+            objects[ih] = ("pen", None if style & 0xF == _PS_NULL else _color(color), width)
+        elif rtype == EMR_CREATEBRUSHINDIRECT:
+            ih, style, color = struct.unpack_from("<III", data, p)
+            objects[ih] = ("brush", None if style == _BS_NULL else _color(color))
+        elif rtype == EMR_EXTCREATEFONTINDIRECTW:
+            ih, lf_height, _, escapement, _, weight = struct.unpack_from("<Iiiiii", data, p)
+            italic = data[p + 24]
+            face = data[p + 32:p + 96].decode("utf-16-le", "ignore").split("\x00", 1)[0]
+            if escapement:
+                raise Unsupported("повёрнутый текст")
+            objects[ih] = ("font", lf_height, weight >= 600, bool(italic), face)
+        elif rtype == EMR_SELECTOBJECT:
+            ih = struct.unpack_from("<I", data, p)[0]
+            if ih & 0x80000000:
+                stock = ih & 0x7FFFFFFF
+                if stock in _STOCK_BRUSHES:
+                    st["brush"] = _STOCK_BRUSHES[stock]
+                elif stock == 5:
+                    st["brush"] = None
+                elif stock in _STOCK_PENS:
+                    st["pen"] = (_STOCK_PENS[stock], 0)
+                elif stock == 8:
+                    st["pen"] = (None, 0)
+            elif ih in objects:
+                obj = objects[ih]
+                if obj[0] == "pen":
+                    st["pen"] = (obj[1], obj[2])
+                elif obj[0] == "brush":
+                    st["brush"] = obj[1]
+                else:
+                    st["font"] = obj[1:]
+        elif rtype == EMR_DELETEOBJECT:
+            objects.pop(struct.unpack_from("<I", data, p)[0], None)
+        elif rtype == EMR_MOVETOEX:
+            st["pos"] = struct.unpack_from("<2i", data, p)
+            if path is not None:
+                path.append([to_px(*st["pos"])])
+        elif rtype == EMR_LINETO:
+            pt = struct.unpack_from("<2i", data, p)
+            emit("lineto", [to_px(*pt)])
+            st["pos"] = pt
+        elif rtype in (EMR_RECTANGLE, EMR_ELLIPSE):
+            left, top, right, bottom = struct.unpack_from("<4i", data, p)
+            (x0, y0), (x1, y1) = to_px(left, top), to_px(right, bottom)
+            box = [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+            color, w = st["pen"]
+            width = max(1, round(len_px(w, 0))) if color is not None else 0
+            if rtype == EMR_RECTANGLE:
+                draw.rectangle(box, fill=st["brush"], outline=color, width=width)
+            else:
+                draw.ellipse(box, fill=st["brush"], outline=color, width=width)
+        elif rtype in (EMR_POLYGON, EMR_POLYLINE, EMR_POLYBEZIER, EMR_POLYBEZIERTO, EMR_POLYLINETO,
+                       EMR_POLYGON16, EMR_POLYLINE16, EMR_POLYBEZIER16, EMR_POLYBEZIERTO16, EMR_POLYLINETO16):
+            small = rtype >= EMR_POLYBEZIER16
+            count = struct.unpack_from("<I", data, p + 16)[0]
+            pts = points(p + 20, count, small)
+            kind = {
+                EMR_POLYGON: "polygon", EMR_POLYGON16: "polygon",
+                EMR_POLYLINE: "line", EMR_POLYLINE16: "line",
+                EMR_POLYBEZIER: "bezier", EMR_POLYBEZIER16: "bezier",
+                EMR_POLYBEZIERTO: "bezierto", EMR_POLYBEZIERTO16: "bezierto",
+                EMR_POLYLINETO: "lineto", EMR_POLYLINETO16: "lineto",
+            }[rtype]
+            if pts:
+                emit(kind, pts)
+                if kind in ("bezierto", "lineto"):
+                    st["pos"] = device_to_logical(pts[-1])
+        elif rtype in (EMR_POLYPOLYGON, EMR_POLYPOLYLINE, EMR_POLYPOLYGON16, EMR_POLYPOLYLINE16):
+            small = rtype >= EMR_POLYPOLYLINE16
+            n_polys, _ = struct.unpack_from("<II", data, p + 16)
+            counts = struct.unpack_from(f"<{n_polys}I", data, p + 24)
+            pt_off = p + 24 + 4 * n_polys
+            kind = "polygon" if rtype in (EMR_POLYPOLYGON, EMR_POLYPOLYGON16) else "line"
+            for count in counts:
+                emit(kind, points(pt_off, count, small))
+                pt_off += count * (4 if small else 8)
+        elif rtype == EMR_BEGINPATH:
+            path = []
+        elif rtype == EMR_ENDPATH:
+            pass
+        elif rtype == EMR_CLOSEFIGURE:
+            if path and len(path[-1]) > 1:
+                path[-1].append(path[-1][0])
+        elif rtype in (EMR_FILLPATH, EMR_STROKEANDFILLPATH, EMR_STROKEPATH):
+            for figure in path or []:
+                if rtype != EMR_STROKEPATH:
+                    fill(figure)
+                if rtype != EMR_FILLPATH:
+                    stroke(figure)
+            path = None
+        elif rtype == EMR_EXTTEXTOUTW:
+            _text_out(draw, data, off, p, st, to_px, len_px)
+        else:
+            raise Unsupported(f"запись EMF {rtype}")
+        off += size
+    return img
+
+
+def _text_out(draw, data: bytes, off: int, p: int, st: dict, to_px, len_px) -> None:
+    ref = struct.unpack_from("<2i", data, p + 28)
+    n, off_string, options = struct.unpack_from("<III", data, p + 36)
+    off_dx = struct.unpack_from("<I", data, p + 64)[0]
+    if not n:
+        return
+    if st["font"] is None:
+        raise Unsupported("текст без выбранного шрифта")
+    lf_height, bold, italic, face = st["font"]
+    text = _decode_text(data[off + off_string:off + off_string + 2 * n].decode("utf-16-le"), face)
+
+    # Высота LOGFONT < 0 — кегль, > 0 — высота ячейки (с внутренним интервалом)
+    size = len_px(lf_height) * (1 if lf_height < 0 else 0.85)
+    if size < 1:
+        return
+    family = "Sans" if face.lower().startswith(("symbol", "arial", "helvetica", "verdana")) else "Serif"
+    font = _font(family, bold, italic, max(1, round(size)))
+
+    if st["align"] & _TA_UPDATECP:
+        ref = st["pos"]
+    x, y = to_px(*ref)
+    advances = None
+    if off_dx:
+        step = 2 if options & _ETO_PDY else 1
+        dx = struct.unpack_from(f"<{n * step}i", data, off + off_dx)[::step]
+        advances = [len_px(d, 0) for d in dx]
+    total = sum(advances) if advances else font.getlength(text)
+
+    halign = st["align"] & _TA_CENTER
+    if halign == _TA_CENTER:
+        x -= total / 2
+    elif halign == _TA_RIGHT:
+        x -= total
+    valign = st["align"] & _TA_BASELINE
+    anchor = "l" + ("s" if valign == _TA_BASELINE else "d" if valign == _TA_BOTTOM else "a")
+
+    if advances is None:
+        draw.text((x, y), text, font=font, fill=st["text_color"], anchor=anchor)
+    else:
+        cx = x
+        for ch, adv in zip(text, advances):
+            draw.text((cx, y), ch, font=font, fill=st["text_color"], anchor=anchor)
+            cx += adv
+    if st["align"] & _TA_UPDATECP:
+        st["pos"] = (ref[0] + round(total / max(len_px(1, 0), 1e-9)), ref[1])
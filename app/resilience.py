@@ -0,0 +1,186 @@
+"""
+Защита вызовов внешней модели: дедлайн на вызов, хеджированный повтор
+(дубликат запроса, если ответа нет дольше заданного перцентиля недавних
+задержек) и автомат-предохранитель (circuit breaker), который после серии
+ошибок сразу отказывает, чтобы вызывающий код ушёл на локальный разбор.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceUnavailable(Exception):
+    """Вызов не удался: предохранитель разомкнут, истёк дедлайн или ошибка сервиса."""
+
+
+class LatencyTracker:
+    """Скользящее окно последних успешных задержек."""
+
+    def __init__(self, window: int = 200):
+        self._values: deque[float] = deque(maxlen=window)
+
+    def add(self, value: float) -> None:
+        self._values.append(value)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, p: float) -> float:
+        if not self._values:
+            return 0.0
+        values = sorted(self._values)
+        k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+        return values[k]
+
+
+class CircuitBreaker:
+    """
+    closed → open после `failures` ошибок подряд; через `cooldown` секунд
+    пропускает один пробный вызов (half-open): успех замыкает, ошибка
+    снова размыкает, отмена пробного вызова (release_probe) освобождает
+    место для следующей пробы.
+    """
+
+    def __init__(self, name: str, failures: int, cooldown: float):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self._errors = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def would_allow(self) -> bool:
+        """Пропустит ли allow() вызов сейчас; пробный вызов не занимается."""
+        if self._opened_at is None:
+            return True
+        return not self._probing and time.monotonic() - self._opened_at >= self.cooldown
+
+    def allow(self) -> bool:
+        if not self.would_allow():
+            return False
+        if self._opened_at is not None:
+            self._probing = True
+        return True
+
+    def release_probe(self) -> None:
+        """Пробный вызов отменён, не дождавшись ответа: о сервисе он ничего не сказал."""
+        self._probing = False
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info("Предохранитель %s замкнут", self.name)
+        self._errors = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._errors += 1
+        if self._probing or (self._opened_at is None and self._errors >= self.failures):
+            logger.warning("Предохранитель %s разомкнут после %d ошибок", self.name, self._errors)
+            metrics.incr(f"breaker.{self.name}.opened")
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+async def call_hedged(factory, deadline: float, hedge_after: float | None):
+    """
+    Запускает factory() и, если ответа нет через hedge_after секунд (или
+    первая попытка упала раньше), один дубликат. Возвращает первый успешный
+    результат, остальные попытки отменяются. Весь вызов ограничен deadline.
+    """
+    start = time.monotonic()
+    end = start + deadline
+    pending = {asyncio.ensure_future(factory())}
+    hedged = hedge_after is None
+    error: BaseException | None = None
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                raise asyncio.TimeoutError()
+            wait_until = end if hedged else min(end, start + hedge_after)
+            done, pending = await asyncio.wait(pending, timeout=wait_until - now,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if not hedged and (not pending or time.monotonic() >= start + hedge_after):
+                hedged = True
+                metrics.incr("hedge.started")
+                pending.add(asyncio.ensure_future(factory()))
+            elif not pending:
+                raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class GuardedEndpoint:
+    """Дедлайн, хеджирование и предохранитель вокруг вызовов одного сервиса."""
+
+    def __init__(self, name: str, deadline: float, hedge_percentile: float,
+                 hedge_min_delay: float, breaker_failures: int, breaker_cooldown: float):
+        self.name = name
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(name, breaker_failures, breaker_cooldown)
+
+    def hedge_delay(self) -> float | None:
+        """Задержка до дубликата: перцентиль недавних задержек, не меньше hedge_min_delay."""
+        if self.hedge_percentile <= 0:
+            return None
+        return max(self.hedge_min_delay, self.latency.percentile(self.hedge_percentile))
+
+    def available(self) -> bool:
+        """Примет ли call вызов сейчас (без пробного вызова, уже идущего в half-open)."""
+        return self.breaker.would_allow()
+
+    async def call(self, factory):
+        probe = self.breaker.state != "closed"
+        if not self.breaker.allow():
+            metrics.incr(f"{self.name}.rejected")
+            raise ServiceUnavailable(f"{self.name}: предохранитель разомкнут")
+        started = time.monotonic()
+        try:
+            result = await call_hedged(factory, self.deadline, self.hedge_delay())
+        except asyncio.TimeoutError:
+            metrics.incr(f"{self.name}.timeouts")
+            self.breaker.record_failure()
+            raise ServiceUnavailable(f"{self.name}: нет ответа за {self.deadline:g} c")
+        except Exception as e:
+            metrics.incr(f"{self.name}.errors")
+            self.breaker.record_failure()
+            raise ServiceUnavailable(f"{self.name}: {e}") from e
+        except BaseException:
+            # Отмена (клиент отключился, вызов снят): иначе пробный вызов
+            # так и числился бы идущим и предохранитель отказывал бы всем
+            if probe:
+                self.breaker.release_probe()
+            raise
+        self.latency.add(time.monotonic() - started)
+        self.breaker.record_success()
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.state,
+            "latency_samples": len(self.latency),
+            "hedge_after": self.hedge_delay(),
+        }
@@ -0,0 +1,100 @@
+import json
+from dataclasses import dataclass, fields
+
+try:
+    import orjson
+except ImportError:  # без orjson работает стандартный json, только медленнее
+    orjson = None
+
+PLACEHOLDER_VOPROS = "вопрос не опознан"
+
+
+@dataclass(slots=True)
+class QuestionRow:
+    """
+    Итоговая строка вопроса. subject — общий для всех строк документа
+    объект, не копируется. question_type: "mcq", "matching" или None
+    для заглушки пропущенного номера. duplicates — похожие вопросы банка
+    (app.dedup) или None.
+    """
+    id: int | None
+    id_predmet: int
+    subject: dict
+    language: str
+    klass: str
+    vopros: str
+    temy_id: str | None
+    temy_name: str | None
+    podtemy_id: str | None
+    podtemy_name: str | None
+    target: str
+    tip: int
+    texty: str
+    otvety: list | dict
+    pravOtv: list | dict
+    exp: str
+    difficulty: str | None
+    quarter: int | None
+    question_type: str | None
+    duplicates: list | None = None
+
+    @classmethod
+    def from_state(cls, state: dict, subject: dict, language: str, klass: str,
+                   tip: int, question_type: str | None) -> "QuestionRow":
+        return cls(
+            id=state.get("number"),
+            id_predmet=1,
+            subject=subject,
+            language=language,
+            klass=klass,
+            vopros=state.get("vopros", PLACEHOLDER_VOPROS),
+            temy_id=state.get("temy_id"),
+            temy_name=state.get("temy_name"),
+            podtemy_id=state.get("podtemy_id"),
+            podtemy_name=state.get("podtemy_name"),
+            target=state.get("target", ""),
+            tip=tip,
+            texty="",
+            otvety=state.get("otvety", ["", "", "", ""]),
+            pravOtv=state.get("pravOtv", []),
+            exp=state.get("exp", ""),
+            difficulty=state.get("difficulty"),
+            quarter=state.get("quarter"),
+            question_type=state.get("question_type", question_type),
+        )
+
+    @classmethod
+    def placeholder(cls, number: int, subject: dict, language: str, klass: str,
+                    tip: int) -> "QuestionRow":
+        return cls(
+            id=number, id_predmet=1, subject=subject, language=language, klass=klass,
+            vopros=PLACEHOLDER_VOPROS,
+            temy_id=None, temy_name=None, podtemy_id=None, podtemy_name=None,
+            target="", tip=tip, texty="",
+            otvety=["", "", "", ""], pravOtv=[], exp="",
+            difficulty=None, quarter=None, question_type=None,
+        )
+
+    def to_dict(self) -> dict:
+        return {f: getattr(self, f) for f in ROW_FIELDS}
+
+
+ROW_FIELDS = tuple(f.name for f in fields(QuestionRow))
+# Поля, которых нет в ответе первых эндпоинтов (/split-multiple-choice-questions/,
+# /split-matching-questions/): там они выводятся только по запросу клиента
+EXTRA_FIELDS = ("question_type", "duplicates")
+LEGACY_FIELDS = tuple(f for f in ROW_FIELDS if f not in EXTRA_FIELDS)
+
+
+def dumps_questions(rows: list[QuestionRow], row_fields: tuple | None = None, **extra) -> bytes:
+    """
+    {"questions": [...], **extra} сразу в байты JSON, минуя jsonable_encoder.
+    row_fields — поля строк в ответе (по умолчанию все).
+    Ключи групп matching-ответов бывают int — их orjson приводит к строкам.
+    """
+    if row_fields is not None:
+        rows = [{f: getattr(row, f) for f in row_fields} for row in rows]
+    payload = {"questions": rows, **extra}
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, default=QuestionRow.to_dict).encode("utf-8")
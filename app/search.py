@@ -0,0 +1,213 @@
+"""
+Поисковый индекс разобранных вопросов (GET /search/questions).
+
+- Списки вхождений (postings) по temy_id, podtemy_id и кодам целей
+  обучения из target («10.4.1.26»): поиск по коду — это чтение одного
+  диапазона первичного ключа (field, term, qkey).
+- Полнотекстовый поиск по vopros и exp — SQLite FTS5 (unicode61: регистр
+  и диакритика не важны); слова запроса ищутся как префиксы, чтобы
+  «функци» находило «функция», «функции» и т.д.
+Эндпоинты разбора заменяют в индексе прошлую версию документа новой.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from app import metrics
+from app.config import SEARCH_DB, SEARCH_INDEX, SEARCH_PAGE_MAX
+from app.rows import PLACEHOLDER_VOPROS, QuestionRow
+
+logger = logging.getLogger(__name__)
+
+_GOAL_CODE_RE = re.compile(r'\d+(?:\.\d+){2,}')
+_IMAGE_RE = re.compile(r'!\[[^\]]*\]\([^)]*\)(?:\{[^}]*\})?')
+_WORD_RE = re.compile(r'\w+')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+    qkey INTEGER PRIMARY KEY,
+    docname TEXT NOT NULL,
+    qid INTEGER,
+    temy_id TEXT,
+    temy_name TEXT,
+    podtemy_id TEXT,
+    podtemy_name TEXT,
+    target TEXT,
+    vopros TEXT,
+    exp TEXT,
+    otvety TEXT,
+    pravOtv TEXT,
+    question_type TEXT,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS idx_questions_doc ON questions(docname);
+CREATE TABLE IF NOT EXISTS postings (
+    field TEXT NOT NULL,
+    term TEXT NOT NULL,
+    qkey INTEGER NOT NULL,
+    PRIMARY KEY (field, term, qkey)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_postings_qkey ON postings(qkey);
+CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+    vopros, exp, content='questions', content_rowid='qkey',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS questions_ai AFTER INSERT ON questions BEGIN
+    INSERT INTO questions_fts(rowid, vopros, exp) VALUES (new.qkey, new.vopros, new.exp);
+END;
+CREATE TRIGGER IF NOT EXISTS questions_ad AFTER DELETE ON questions BEGIN
+    INSERT INTO questions_fts(questions_fts, rowid, vopros, exp)
+    VALUES ('delete', old.qkey, old.vopros, old.exp);
+END;
+"""
+
+_RESULT_COLUMNS = ("docname", "qid", "temy_id", "temy_name", "podtemy_id", "podtemy_name",
+                   "target", "vopros", "exp", "otvety", "pravOtv", "question_type")
+_JSON_COLUMNS = ("otvety", "pravOtv")
+
+_init_lock = threading.Lock()
+_ready = False
+_write_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    global _ready
+    if not _ready:
+        os.makedirs(os.path.dirname(SEARCH_DB), exist_ok=True)
+    conn = sqlite3.connect(SEARCH_DB, timeout=10)
+    if not _ready:
+        with _init_lock:
+            if not _ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                _ready = True
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def goal_codes(target: str | None) -> list[str]:
+    """Коды целей обучения из target: «10.4.1.26 Знать … 10.4.1.27 …» → два кода."""
+    return list(dict.fromkeys(_GOAL_CODE_RE.findall(target or "")))
+
+
+def _postings(row: QuestionRow) -> list[tuple[str, str]]:
+    terms = [("target", code) for code in goal_codes(row.target)]
+    for field in ("temy_id", "podtemy_id"):
+        value = getattr(row, field)
+        if value not in (None, ""):
+            terms.append((field, str(value)))
+    return terms
+
+
+def index_rows(docname: str, rows: list[QuestionRow]) -> int:
+    """Заменяет в индексе вопросы документа docname строками rows; возвращает число строк."""
+    if not SEARCH_INDEX:
+        return 0
+    rows = [r for r in rows if r.vopros != PLACEHOLDER_VOPROS]
+    now = time.time()
+    try:
+        with _write_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM postings WHERE qkey IN "
+                                 "(SELECT qkey FROM questions WHERE docname = ?)", (docname,))
+                    conn.execute("DELETE FROM questions WHERE docname = ?", (docname,))
+                    for row in rows:
+                        qkey = conn.execute(
+                            f"INSERT INTO questions ({', '.join(_RESULT_COLUMNS)}, created) "
+                            f"VALUES ({','.join('?' * (len(_RESULT_COLUMNS) + 1))})",
+                            (docname, row.id, row.temy_id, row.temy_name, row.podtemy_id,
+                             row.podtemy_name, row.target, _IMAGE_RE.sub(" ", row.vopros or ""),
+                             _IMAGE_RE.sub(" ", row.exp or ""),
+                             json.dumps(row.otvety, ensure_ascii=False),
+                             json.dumps(row.pravOtv, ensure_ascii=False),
+                             row.question_type, now)).lastrowid
+                        conn.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?, ?)",
+                                         [(field, term, qkey) for field, term in _postings(row)])
+            finally:
+                conn.close()
+    except Exception as e:
+        logger.warning("Не удалось обновить поисковый индекс для %s: %s", docname, e)
+        return 0
+    metrics.incr("search.indexed", len(rows))
+    return len(rows)
+
+
+def _match_query(text: str) -> str | None:
+    """Слова запроса → запрос FTS5: все слова, каждое как префикс."""
+    words = _WORD_RE.findall(text.lower())
+    return " ".join(f'"{w}"*' for w in words) or None
+
+
+def search(q: str | None = None, temy_id: str | None = None, podtemy_id: str | None = None,
+           target: str | None = None, docname: str | None = None,
+           limit: int = 20, offset: int = 0) -> dict:
+    """
+    Вопросы, подходящие под все заданные условия. target — код цели или
+    его начало («10.4.1» находит 10.4.1.26 и 10.4.1.27). С q результаты
+    упорядочены по релевантности (bm25) и несут snippet, без q — новые первыми.
+    """
+    if not SEARCH_INDEX or not os.path.exists(SEARCH_DB):
+        return {"questions": [], "next_offset": None}
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    offset = max(0, offset)
+    where, args = [], []
+    for field, value in (("temy_id", temy_id), ("podtemy_id", podtemy_id)):
+        if value:
+            where.append("q.qkey IN (SELECT qkey FROM postings WHERE field = ? AND term = ?)")
+            args += [field, value]
+    if target:
+        # Код целиком или все коды под ним: диапазон [code., code/) по ключу
+        where.append("q.qkey IN (SELECT qkey FROM postings WHERE field = 'target' "
+                     "AND (term = ? OR (term >= ? AND term < ?)))")
+        args += [target, target + ".", target + "/"]
+    if docname:
+        where.append("q.docname = ?")
+        args.append(docname)
+
+    columns = ", ".join(f"q.{c}" for c in _RESULT_COLUMNS)
+    match = _match_query(q) if q else None
+    if q and match is None:
+        return {"questions": [], "next_offset": None}
+    if match:
+        sql = (f"SELECT {columns}, snippet(questions_fts, -1, '[', ']', '…', 16) "
+               "FROM questions_fts JOIN questions q ON q.qkey = questions_fts.rowid "
+               f"WHERE questions_fts MATCH ? {''.join(' AND ' + w for w in where)} "
+               "ORDER BY bm25(questions_fts) LIMIT ? OFFSET ?")
+        args = [match] + args
+    else:
+        sql = (f"SELECT {columns}, NULL FROM questions q "
+               f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+               "ORDER BY q.qkey DESC LIMIT ? OFFSET ?")
+    args += [limit + 1, offset]
+
+    conn = _connect()
+    try:
+        rows = conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+    questions = []
+    for row in rows[:limit]:
+        item = {}
+        for name, value in zip(_RESULT_COLUMNS, row):
+            item["id" if name == "qid" else name] = \
+                json.loads(value) if name in _JSON_COLUMNS and value is not None else value
+        if match:
+            item["snippet"] = row[-1]
+        questions.append(item)
+    return {"questions": questions, "next_offset": offset + limit if len(rows) > limit else None}
+
+
+def stats() -> dict:
+    if not SEARCH_INDEX or not os.path.exists(SEARCH_DB):
+        return {"questions": 0}
+    conn = _connect()
+    try:
+        return {"questions": conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0]}
+    finally:
+        conn.close()
@@ -0,0 +1,137 @@
+"""
+Общий запуск внешних программ (pandoc, LibreOffice): таймаут на вызов,
+убийство всей группы процессов, общий лимит одновременных дочерних
+процессов и отмена по флагу запроса (клиент отключился).
+"""
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import threading
+from contextvars import ContextVar
+
+from app import metrics
+from app.config import SUBPROCESS_MAX_CHILDREN
+
+logger = logging.getLogger(__name__)
+
+# Как часто ожидающий процесс проверяет флаг отмены, секунды
+_POLL = 0.2
+
+_children = threading.BoundedSemaphore(SUBPROCESS_MAX_CHILDREN)
+_cancel: ContextVar[threading.Event | None] = ContextVar("subproc_cancel", default=None)
+
+
+class Cancelled(Exception):
+    """Запрос отменён (клиент отключился) — оставшиеся этапы не выполняются."""
+
+
+class SubprocessTimeout(RuntimeError):
+    def __init__(self, args: list, timeout: float):
+        super().__init__(f"{os.path.basename(str(args[0]))}: нет результата за {timeout:g} c")
+
+
+def cancel_scope() -> threading.Event:
+    """
+    Флаг отмены для текущего контекста (запроса). Потоки из asyncio.to_thread
+    наследуют контекст и видят тот же флаг.
+    """
+    event = threading.Event()
+    _cancel.set(event)
+    return event
+
+
+def check_cancelled() -> None:
+    event = _cancel.get()
+    if event is not None and event.is_set():
+        raise Cancelled("Запрос отменён")
+
+
+def _kill_group(proc) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _acquire_sync() -> None:
+    while not _children.acquire(timeout=_POLL):
+        check_cancelled()
+
+
+async def _acquire_async() -> None:
+    # Семафор общий с синхронными вызовами, поэтому без блокировки цикла
+    while not _children.acquire(blocking=False):
+        check_cancelled()
+        await asyncio.sleep(_POLL / 4)
+
+
+def run(args: list, timeout: float, input: bytes | None = None, check: bool = True,
+        cwd: str | None = None) -> subprocess.CompletedProcess:
+    """
+    subprocess.run с таймаутом и отменой: процесс запускается в своей
+    группе и при таймауте или отмене убивается вместе с потомками
+    (LibreOffice запускает soffice.bin дочерним процессом).
+    """
+    check_cancelled()
+    _acquire_sync()
+    try:
+        proc = subprocess.Popen(
+            args, cwd=cwd, start_new_session=True,
+            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        deadline = timeout
+        pending_input = input
+        while True:
+            try:
+                out, err = proc.communicate(pending_input, timeout=min(_POLL, deadline))
+                break
+            except subprocess.TimeoutExpired:
+                pending_input = None  # stdin уже передан первым communicate
+                deadline -= _POLL
+                event = _cancel.get()
+                if deadline <= 0 or (event is not None and event.is_set()):
+                    _kill_group(proc)
+                    proc.communicate()
+                    if deadline <= 0:
+                        metrics.incr("subprocess.timeouts")
+                        raise SubprocessTimeout(args, timeout)
+                    metrics.incr("subprocess.cancelled")
+                    raise Cancelled("Запрос отменён")
+    finally:
+        _children.release()
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, out, err)
+    return subprocess.CompletedProcess(args, proc.returncode, out, err)
+
+
+async def run_async(args: list, timeout: float, input: bytes | None = None,
+                    check: bool = True) -> subprocess.CompletedProcess:
+    """То же для asyncio: отмена задачи тоже убивает группу процессов."""
+    check_cancelled()
+    await _acquire_async()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args, start_new_session=True,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            _kill_group(proc)
+            await proc.wait()
+            metrics.incr("subprocess.timeouts")
+            raise SubprocessTimeout(args, timeout)
+        except asyncio.CancelledError:
+            _kill_group(proc)
+            await proc.wait()
+            metrics.incr("subprocess.cancelled")
+            raise
+    finally:
+        _children.release()
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, out, err)
+    return subprocess.CompletedProcess(args, proc.returncode, out, err)
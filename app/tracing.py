@@ -0,0 +1,120 @@
+"""
+Лёгкие спаны по этапам разбора с выгрузкой в формат Chrome trace
+(открывается в chrome://tracing и ui.perfetto.dev).
+
+Длительность каждого спана всегда попадает в metrics как span.<cat>.<name>;
+события трассы пишутся, только если для запроса открыт Trace. Спаны — это
+и этапы учёта памяти запроса (app.memory).
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+from app import memory, metrics
+from app.config import TRACE_DIR, TRACE_MAX_FILES, TRACE_SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+_current: ContextVar["Trace | None"] = ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.pid = os.getpid()
+        self._t0 = time.perf_counter_ns()
+        self._events: list[dict] = []
+        self._threads: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, cat: str, start_ns: int, end_ns: int, args: dict) -> None:
+        tid = threading.get_ident()
+        event = {
+            "name": name, "cat": cat, "ph": "X", "pid": self.pid, "tid": tid,
+            "ts": (start_ns - self._t0) / 1000, "dur": (end_ns - start_ns) / 1000,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self._events.append(event)
+            if tid not in self._threads:
+                self._threads[tid] = threading.current_thread().name
+
+    def to_chrome(self) -> dict:
+        with self._lock:
+            meta = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": self.name}}]
+            meta += [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": tname}}
+                     for tid, tname in self._threads.items()]
+            return {"traceEvents": meta + list(self._events), "displayTimeUnit": "ms"}
+
+
+class span:
+    """with span("pandoc", cat="subprocess", part=3): ..."""
+    __slots__ = ("name", "cat", "args", "_trace", "_t0")
+
+    def __init__(self, name: str, cat: str = "stage", **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self._trace = _current.get()
+        memory.stage_enter(self.name, self.cat)
+        self._t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        t1 = time.perf_counter_ns()
+        memory.stage_exit(self.name, self.cat)
+        metrics.observe(f"span.{self.cat}.{self.name}", (t1 - self._t0) / 1e9)
+        if self._trace is not None:
+            if exc_type is not None:
+                self.args["error"] = exc_type.__name__
+            self._trace.add(self.name, self.cat, self._t0, t1, self.args)
+        return False
+
+
+def should_trace(forced: bool) -> bool:
+    return forced or (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE)
+
+
+def start_trace(name: str) -> tuple[Trace, object]:
+    trace = Trace(name)
+    return trace, _current.set(trace)
+
+
+def finish_trace(trace: Trace, token) -> str | None:
+    """Закрывает трассу и сохраняет её в TRACE_DIR; возвращает путь к файлу."""
+    _current.reset(token)
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = trace_path(trace.id)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace.to_chrome(), f, ensure_ascii=False)
+        _prune()
+        return path
+    except Exception as e:
+        logger.warning("Не удалось сохранить трассу %s: %s", trace.id, e)
+        return None
+
+
+def trace_path(trace_id: str) -> str:
+    return os.path.join(TRACE_DIR, f"{trace_id}.json")
+
+
+def _prune() -> None:
+    files = [os.path.join(TRACE_DIR, f) for f in os.listdir(TRACE_DIR) if f.endswith(".json")]
+    if len(files) <= TRACE_MAX_FILES:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - TRACE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,166 @@
+"""
+Нагрузочный генератор для эндпоинтов разбора.
+
+    python -m loadtest.run --url http://127.0.0.1:8000 --concurrency 8 \\
+        --requests 200 --mix mcq=3,matching=1 --generate 4 --questions 30
+
+Шлёт загрузки .docx (свои через --docs или сгенерированные --generate)
+в эндпоинты по заданной пропорции и печатает пропускную способность
+и p50/p95/p99 задержки по каждому эндпоинту.
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+from docx import Document
+
+ENDPOINTS = {
+    "mcq": "/split-multiple-choice-questions/",
+    "matching": "/split-matching-questions/",
+    "mixed": "/split-questions/",
+}
+FORM = {
+    "subject_name": "Математика",
+    "subject_namekz": "Математика",
+    "language": "рус",
+    "klass": "10",
+}
+
+
+def generate_docx(path: str, questions: int, seed: int) -> str:
+    """Документ с чередующимися MCQ и matching-заданиями."""
+    rnd = random.Random(seed)
+    doc = Document()
+    for n in range(1, questions + 1):
+        doc.add_paragraph(f"{n} задание")
+        if n % 4 == 0:
+            doc.add_paragraph("Установите соответствие между функцией и значением")
+            doc.add_paragraph("----------")
+            for i, letter in enumerate("ABC", start=1):
+                doc.add_paragraph(f"{i}. f{i}({rnd.randint(0, 9)})  {letter}) {rnd.randint(0, 99)}")
+            doc.add_paragraph("Правильный ответ: 1-A, 2-B, 3-C")
+        else:
+            a, b = rnd.randint(1, 50), rnd.randint(1, 50)
+            doc.add_paragraph(f"Найдите значение выражения {a} + {b}")
+            for i, letter in enumerate("ABCD"):
+                doc.add_paragraph(f"{letter}) {a + b + i}")
+            doc.add_paragraph("Правильный ответ: A")
+            doc.add_paragraph(f"Объяснение: {a} + {b} = {a + b}")
+        doc.add_paragraph("Раздел: 11 Применение производной")
+        doc.add_paragraph("Тема: 216 Критические точки")
+        doc.add_paragraph("Цель: 10.4.1.26 Знать условие")
+        doc.add_paragraph("Уровень: A")
+        doc.add_paragraph("Четверть: 4")
+    doc.save(path)
+    return path
+
+
+def parse_mix(mix: str) -> list[tuple[str, float]]:
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ENDPOINTS:
+            raise SystemExit(f"неизвестный эндпоинт в --mix: {name}")
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+async def worker(client, queue, docs, results):
+    while True:
+        try:
+            name = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        path = random.choice(docs)
+        with open(path, "rb") as f:
+            content = f.read()
+        started = time.perf_counter()
+        try:
+            resp = await client.post(
+                ENDPOINTS[name],
+                files={"file": (os.path.basename(path), content)},
+                data=FORM,
+            )
+            status = resp.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        results[name].append((time.perf_counter() - started, status))
+
+
+def report(results: dict, elapsed: float) -> None:
+    total = sum(len(v) for v in results.values())
+    print(f"запросов: {total}, время: {elapsed:.2f} c, пропускная способность: {total / elapsed:.2f} rps")
+    print(f"{'эндпоинт':<10} {'n':>6} {'ошибки':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    rows = list(results.items())
+    rows.append(("всего", [r for v in results.values() for r in v]))
+    for name, items in rows:
+        ok = [t for t, status in items if status == 200]
+        errors = len(items) - len(ok)
+        print(f"{name:<10} {len(items):>6} {errors:>7} "
+              f"{percentile(ok, 50):>8.3f} {percentile(ok, 95):>8.3f} "
+              f"{percentile(ok, 99):>8.3f} {max(ok, default=0):>8.3f}")
+    statuses = defaultdict(int)
+    for items in results.values():
+        for _, status in items:
+            if status != 200:
+                statuses[status] += 1
+    if statuses:
+        print("ошибки по статусам:", dict(statuses))
+
+
+async def main_async(args) -> None:
+    docs = list(args.docs)
+    if args.generate:
+        tmp = tempfile.mkdtemp(prefix="loadtest_")
+        docs += [generate_docx(os.path.join(tmp, f"loadtest_{i}.docx"), args.questions, i)
+                 for i in range(args.generate)]
+    if not docs:
+        raise SystemExit("нужны --docs или --generate")
+
+    mix = parse_mix(args.mix)
+    names = random.choices([m for m, _ in mix], weights=[w for _, w in mix], k=args.requests)
+    queue: asyncio.Queue = asyncio.Queue()
+    for name in names:
+        queue.put_nowait(name)
+
+    results: dict = defaultdict(list)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client, queue, docs, results) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    report(results, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--mix", default="mcq=1,matching=1", help="эндпоинты и веса: mcq, matching, mixed")
+    parser.add_argument("--docs", nargs="*", default=[], help="свои .docx для загрузки")
+    parser.add_argument("--generate", type=int, default=0, help="сколько документов сгенерировать")
+    parser.add_argument("--questions", type=int, default=20, help="заданий в сгенерированном документе")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
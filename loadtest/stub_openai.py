@@ -0,0 +1,100 @@
+"""
+Заглушка OpenAI chat completions для нагрузочных тестов.
+
+    python -m loadtest.stub_openai --port 8081 --latency-ms 800
+
+Сервис направляется на неё через OPENAI_BASE_URL=http://127.0.0.1:8081/v1.
+--error-rate отвечает долей 500-х, --slow-rate/--slow-ms добавляют редкие
+очень медленные ответы — для проверки дедлайнов, дубликатов и предохранителя.
+На запрос с картинками отвечает одним вопросом на картинку (с task_index,
+если картинок несколько), на запрос с JSON (fix_math_json) возвращает присланные вопросы без изменений.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI()
+settings = {"latency_ms": 800.0, "jitter": 0.3, "error_rate": 0.0, "slow_rate": 0.0, "slow_ms": 30000.0}
+
+
+def _canned_question(n: int) -> dict:
+    return {
+        "question": f"Заглушка вопроса {n}: $x^2 = 4$",
+        "options": {"A": "$2$", "B": "$-2$", "C": "$\\pm 2$", "D": "$0$"},
+        "correct_answer": "C",
+        "explanation": "$x = \\pm 2$",
+        "section": {"id": 1, "name": "Заглушка"},
+        "topic": {"id": 1, "name": "Заглушка"},
+        "learning_goals": "10.1.1.1 Заглушка",
+        "difficulty_level": "A",
+        "quarter": 1,
+    }
+
+
+def _answer(messages: list) -> dict:
+    user = messages[-1]["content"] if messages else ""
+    if isinstance(user, list):
+        images = [c for c in user if c.get("type") == "image_url"]
+        questions = [_canned_question(i + 1) for i in range(len(images))]
+        if len(images) > 1:
+            for i, q in enumerate(questions, start=1):
+                q["task_index"] = i
+        return {"questions": questions}
+    try:
+        return {"questions": json.loads(user).get("questions", [])}
+    except (TypeError, ValueError):
+        return {"questions": []}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    latency = settings["latency_ms"] / 1000
+    if random.random() < settings["slow_rate"]:
+        latency = settings["slow_ms"] / 1000
+    await asyncio.sleep(max(0.0, latency * (1 + random.uniform(-settings["jitter"], settings["jitter"]))))
+    if random.random() < settings["error_rate"]:
+        return JSONResponse({"error": {"message": "stub: injected error", "type": "server_error"}}, status_code=500)
+    arguments = json.dumps(_answer(body.get("messages", [])), ensure_ascii=False)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {
+                "role": "assistant",
+                "content": None,
+                "function_call": {"name": "return_json", "arguments": arguments},
+            },
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=800.0)
+    parser.add_argument("--jitter", type=float, default=0.3, help="разброс задержки, доля от --latency-ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="доля очень медленных ответов")
+    parser.add_argument("--slow-ms", type=float, default=30000.0, help="задержка медленного ответа")
+    args = parser.parse_args()
+    settings.update(latency_ms=args.latency_ms, jitter=args.jitter, error_rate=args.error_rate,
+                    slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,68 @@
+import asyncio
+import contextlib
+import hmac
+import io
 import shutil
 import tempfile
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Header, Request, Response
 import os
 import re
-import subprocess
-import json
 import logging
-import openai
 from dotenv import load_dotenv
-from docx import Document
 from docx.document import Document as _Document
 from docx.oxml.text.paragraph import CT_P
 from docx.oxml.table import CT_Tbl
 from docx.table import _Cell, Table
 from docx.text.paragraph import Paragraph
-from pdf2image import convert_from_path
-import base64
-from fastapi.staticfiles import StaticFiles
-
-from app.auto_parser import split_questions_logic, pipeline_mcq, \
-    build_rows_with_placeholders, clean_math_and_sub, pipeline_matching
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.background import BackgroundTask
+
+from app.auto_parser import split_questions_logic_async, pipeline_mcq, build_rows, clean_row, \
+    pipeline_matching, pipeline_auto
+from app.incremental import content_digest, load_previous, pipeline_state, save_result
+from app.parse_cache import parse_cache
+from app.conversion_cache import conversion_cache
+from app import dedup, media_store, memory, metrics, preview, profiler, raster, search, subproc
+from app.config import IMG_DIR, PARSE_IN_MEMORY, PARSE_IN_MEMORY_MAX_MB, DISCONNECT_POLL_INTERVAL, MEDIA_GC_INTERVAL, \
+    DEBUG_TOKEN
+from app.rows import LEGACY_FIELDS, dumps_questions
+from app.export import EXPORTERS
+from app.tracing import span, should_trace, start_trace, finish_trace, trace_path
+from app.gpt import endpoint as gpt_endpoint
+from app.hybrid import repair_states
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Сборка мусора в static/img идёт в фоне и не держит запросы
+    gc_task = asyncio.create_task(media_store.gc_loop()) if MEDIA_GC_INTERVAL > 0 else None
+    profiler.start(app.routes)
+    try:
+        yield
+    finally:
+        profiler.stop()
+        if gc_task is not None:
+            gc_task.cancel()
+            await asyncio.gather(gc_task, return_exceptions=True)
+
 
 app = FastAPI(
     docs_url="/import-sor/docs",         # Swagger UI
     redoc_url="/import-sor/redoc",       # ReDoc
-    openapi_url="/import-sor/openapi.json"  # OpenAPI JSON
+    openapi_url="/import-sor/openapi.json",  # OpenAPI JSON
+    lifespan=lifespan,
 )
 
-from app.promt import GLOBAL_SYSTEM_PROMPT, GLOBAL_FIX_PROMPT
-
-PROMPT = GLOBAL_SYSTEM_PROMPT
-
-BASE_DIR = os.path.dirname(__file__)
-STATIC_DIR = os.path.join(BASE_DIR, "static")
-IMG_DIR = os.path.join(STATIC_DIR, "img")
 os.makedirs(IMG_DIR, exist_ok=True)
 app.mount(
     "/img",
-    StaticFiles(directory=os.path.join(STATIC_DIR, "img")),
+    media_store.MediaFiles(directory=IMG_DIR),
     name="img",
 )
 
@@ -62,87 +80,90 @@ def iter_block_items(parent):
             yield Table(child, parent)
 
 
-async def send_image_to_gpt(image_path: str) -> dict:
-    logger.info(f"Sending image to GPT: {image_path}")
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-    messages = [
-        {"role": "system", "content": PROMPT},
-        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}}]},
-    ]
-    functions = [
-        {
-            "name": "return_json",
-            "description": "Return the parsed questions as JSON matching the schema.",
-            "parameters": {
-                "type": "object",
-                "properties": {"questions": {"type": "array", "items": {"type": "object"}}},
-                "required": ["questions"]
-            }
-        }
-    ]
-    try:
-        resp = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.0,
-            functions=functions,
-            function_call={"name": "return_json"}
-        )
-        logger.info("Received GPT response with function call")
-    except Exception as e:
-        logger.error(f"OpenAI request failed: {e}")
-        return {"questions": [], "error": "OpenAI request failed"}
-
-    # Access function call args
-    func_call = resp.choices[0].message.function_call
-    if not func_call or not func_call.arguments:
-        logger.error("No function_call in GPT response")
-        return {"questions": [], "error": "No function_call in GPT response"}
-    args = func_call.arguments
-    try:
-        parsed = json.loads(args)
-        logger.info("Successfully parsed JSON from GPT")
-        return parsed
-    except Exception as e:
-        logger.error(f"JSON parse error: {e}, raw args: {args}")
-        return {"questions": [], "error": "Invalid JSON from GPT", "raw": args}
-
-SYSTEM_PROMPT = GLOBAL_FIX_PROMPT
-
-def fix_math_json(input_data: dict) -> dict:
-    functions = [
-        {
-            "name": "return_json",
-            "description": "Return the parsed questions as JSON matching the schema.",
-            "parameters": {
-                "type": "object",
-                "properties": {"questions": {"type": "array", "items": {"type": "object"}}},
-                "required": ["questions"]
-            }
-        }
-    ]
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": json.dumps(input_data, ensure_ascii=False)}
-        ],
-        temperature=0,
-            functions=functions,
-            function_call={"name": "return_json"}
-    )
-    args = response.choices[0].message.function_call.arguments
-    try:
-        corrected_json = json.loads(args)
-        return corrected_json
-    except json.JSONDecodeError:
-        raise ValueError("Ответ от GPT не является валидным JSON:", args)
+class TraceRequestsMiddleware:
+    """
+    Трассирует запросы к /split*: по заголовку X-Trace: 1 или случайно
+    с долей TRACE_SAMPLE_RATE. Id трассы возвращается в X-Trace-Id,
+    файл доступен через /debug/traces/{id}.
+    Чистый ASGI, а не @app.middleware("http"): BaseHTTPMiddleware подменяет
+    receive, и эндпоинт перестаёт видеть отключение клиента.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/split"):
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        if not should_trace(headers.get(b"x-trace") == b"1"):
+            return await self.app(scope, receive, send)
+
+        trace, token = start_trace(scope["path"])
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + \
+                    [(b"x-trace-id", trace.id.encode())]
+            await send(message)
+
+        try:
+            with span("request", path=scope["path"]):
+                await self.app(scope, receive, send_with_id)
+        finally:
+            finish_trace(trace, token)
+
+
+app.add_middleware(TraceRequestsMiddleware)
+app.add_middleware(memory.RequestMemoryMiddleware)
+
+
+@app.get("/debug/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    if not re.fullmatch(r"[0-9a-f]{32}", trace_id) or not os.path.exists(trace_path(trace_id)):
+        raise HTTPException(status_code=404, detail="Трасса не найдена")
+    return FileResponse(trace_path(trace_id), media_type="application/json",
+                        filename=f"trace-{trace_id}.json")
+
+
+@app.get("/debug/profile")
+async def get_profile(x_debug_token: str = Header(""), route: str | None = None,
+                      format: str = "collapsed", reset: bool = False):
+    """
+    Данные профилировщика с момента запуска (или прошлого reset=true):
+    collapsed — строки «маршрут;кадр;…;кадр число» для flamegraph.pl и
+    speedscope, json — то же со статистикой. route — только этот маршрут.
+    """
+    if not DEBUG_TOKEN or not hmac.compare_digest(x_debug_token.encode(), DEBUG_TOKEN.encode()):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if format not in ("collapsed", "json"):
+        raise HTTPException(status_code=400, detail=f"Неизвестный формат: {format}")
+    stacks = profiler.collapsed(route)
+    stats = profiler.stats()
+    if reset:
+        profiler.reset()
+    if format == "json":
+        return {**stats, "stacks": [{"stack": stack, "count": count} for stack, count in stacks]}
+    return Response("".join(f"{stack} {count}\n" for stack, count in stacks), media_type="text/plain")
+
 
 @app.get("/healthcheck")
 async def healthcheck():
     return {"status": "ok"}
+
+
+def _stored_stats() -> dict:
+    """Статистика хранилищ на диске (sqlite, каталог кэша) — в рабочем потоке."""
+    return {"conversion_cache": conversion_cache.stats(), "dedup": dedup.stats(), "search": search.stats()}
+
+
+@app.get("/metrics")
+async def metrics_snapshot():
+    stored = await asyncio.to_thread(_stored_stats)
+    return {**metrics.snapshot(), "parse_cache": parse_cache.stats(),
+            "conversion_cache": stored["conversion_cache"], "raster": raster.stats(),
+            "dedup": stored["dedup"], "search": stored["search"], "media_store": media_store.stats(),
+            "profiler": profiler.stats(), "memory": memory.stats(), "gpt": gpt_endpoint.stats()}
 #
 # @app.post("/convert-and-send/", tags=["GPT Parser"])
 # async def convert_docx_to_images_and_send(file: UploadFile = File(...)):
@@ -231,123 +252,300 @@ async def healthcheck():
 #     logger.info(
 #         "Calling fix_math_json with raw questions:\n" + json.dumps({"questions": all_questions}, ensure_ascii=False,
 #                                                                    indent=2))
-#     fixed = fix_math_json({"questions": all_questions})
+#     fixed = await fix_math_json({"questions": all_questions})
 #     return fixed
 
 
 
-@app.post("/split-multiple-choice-questions/", tags=["Python Parser"])
-async def split_questions_api(
-    file: UploadFile = File(...),
-    subject_name: str = Form(..., description="Название предмета"),
-    subject_namekz: str = Form(..., description="Название предмета на казахском"),
-    language: str = Form("рус", description="Язык задания"),
-    klass: str = Form(..., description="Класс, например '10 ЕМН'"),
-    tip: int = Form(1, description="Тип задания (целое число)")
-):
+def check_export(export: str) -> None:
+    """Неизвестный формат — 400 до разбора документа, а не после."""
+    if export != "json" and export not in EXPORTERS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный формат экспорта: {export}")
+
+
+async def questions_response(rows: list, export: str, filename: str | None,
+                             row_fields: tuple | None = None) -> Response:
+    """
+    JSON по умолчанию или готовый к загрузке файл (sqlite / csv / parquet);
+    export проверен check_export.
+    Строки помечаются почти-дубликатами из банка (поле duplicates) и
+    сохраняются для /preview; их id — в заголовке X-Preview-Id и в поле
+    preview_id ответа JSON. Вопросы попадают в поисковый индекс (/search/questions).
+    row_fields — поля строк в ответе JSON (по умолчанию все).
+    """
+    docname = os.path.splitext((filename or "input.docx").replace(' ', '_'))[0]
+    with span("dedup", questions=len(rows)):
+        await asyncio.to_thread(dedup.flag_duplicates, docname, rows)
+    with span("search_index", questions=len(rows)):
+        await asyncio.to_thread(search.index_rows, docname, rows)
+    with span("save_preview"):
+        preview_id = await asyncio.to_thread(preview.save, docname, rows)
+    headers = {"X-Preview-Id": preview_id} if preview_id else None
+    if export == "json":
+        extra = {"preview_id": preview_id} if preview_id else {}
+        with span("encode_json"):
+            return Response(dumps_questions(rows, row_fields, **extra), media_type="application/json",
+                            headers=headers)
+    exporter, suffix, media_type = EXPORTERS[export]
     tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, docname + suffix)
+    try:
+        with span("export", format=export):
+            await asyncio.to_thread(exporter, rows, path)
+    except ValueError as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return FileResponse(path, media_type=media_type, filename=docname + suffix, headers=headers,
+                        background=BackgroundTask(shutil.rmtree, tmp, ignore_errors=True))
+
+
+PREVIEW_VIEWER = os.path.join(os.path.dirname(__file__), "app", "preview.html")
+
+
+@app.get("/preview/{doc_id}", tags=["Preview"])
+async def preview_viewer(doc_id: str):
+    """Страница просмотра: грузит вопросы по страницам и набирает формулы только видимых."""
+    return FileResponse(PREVIEW_VIEWER, media_type="text/html")
+
+
+@app.get("/preview/{doc_id}/questions", tags=["Preview"])
+async def preview_questions(doc_id: str, cursor: str | None = None, limit: int = 20,
+                            fields: str | None = None):
+    """
+    Страница сохранённого разбора. cursor — next_cursor прошлой страницы;
+    fields — поля через запятую (по умолчанию все).
+    """
+    try:
+        page = await asyncio.to_thread(preview.page, doc_id, cursor, limit,
+                                       fields.split(",") if fields else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail="Разбор не найден")
+    # Сохранённый разбор не меняется — страницу можно кэшировать
+    return JSONResponse(page, headers={"Cache-Control": "private, max-age=3600"})
+
+
+@app.get("/search/questions", tags=["Search"])
+async def search_questions(q: str | None = None, temy_id: str | None = None,
+                           podtemy_id: str | None = None, target: str | None = None,
+                           docname: str | None = None, limit: int = 20, offset: int = 0):
+    """
+    Поиск по всем разобранным документам. Условия складываются по И:
+    q — слова из vopros/exp, target — код цели («10.4.1.26») или его начало.
+    """
+    if not any((q, temy_id, podtemy_id, target, docname)):
+        raise HTTPException(status_code=400, detail="Нужно хотя бы одно условие поиска")
+    with span("search", q=q or ""):
+        return await asyncio.to_thread(search.search, q, temy_id, podtemy_id, target,
+                                       docname, limit, offset)
+
+
+async def watch_disconnect(request: Request, work: asyncio.Task, cancel) -> None:
+    """Пока идёт разбор, опрашивает соединение; при отключении клиента отменяет работу."""
+    while not work.done():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+        if await request.is_disconnected():
+            logger.warning("Клиент отключился, разбор %s прерван", request.url.path)
+            metrics.incr("requests.disconnected")
+            cancel.set()
+            work.cancel()
+            return
+
+
+async def parse_upload(request: Request, file: UploadFile, kind: str, pipeline,
+                       mode: str = "local") -> list[dict]:
+    """
+    Разбирает загрузку (см. parse_document). Если клиент отключился,
+    оставшиеся этапы и запущенные подпроцессы прерываются, ответ — 499.
+    Перед разбором оценка памяти документа занимает бюджет воркера:
+    документ больше бюджета — 413, бюджет не освободился вовремя — 503.
+    """
+    if mode not in ("local", "hybrid"):
+        raise HTTPException(status_code=400, detail=f"Неизвестный режим разбора: {mode}")
+    try:
+        await memory.reserve(file.file, file.size or 0, file.filename or "")
+    except memory.MemoryLimitExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except memory.MemoryQueueTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    await file.seek(0)
+    cancel = subproc.cancel_scope()
+    work = asyncio.ensure_future(parse_document(file, kind, pipeline, mode))
+    watcher = asyncio.ensure_future(watch_disconnect(request, work, cancel))
+    try:
+        return await work
+    except (asyncio.CancelledError, subproc.Cancelled):
+        disconnected = cancel.is_set()
+        cancel.set()  # останавливает и потоки, которые ещё работают
+        if not disconnected:
+            raise
+        raise HTTPException(status_code=499, detail="Клиент отключился, разбор прерван")
+    finally:
+        watcher.cancel()
+
+
+async def parse_document(file: UploadFile, kind: str, pipeline, mode: str) -> list[dict]:
+    """
+    Сохраняет загрузку во временную папку (или держит в памяти при
+    PARSE_IN_MEMORY), разбирает документ на вопросы и прогоняет их через
+    pipeline. В режиме hybrid неполно распознанные MCQ-вопросы дораспознаются
+    GPT по картинке. Возвращает состояния пайплайна.
+    """
     filename = (file.filename or "input.docx").replace(' ', '_')
-    src = os.path.join(tmp, filename)
     docname = os.path.splitext(filename)[0]
+    data = await file.read()
+    digest = await asyncio.to_thread(content_digest, data)
+    tmp = None
     try:
         # 1) Сохраняем загруженный .docx во временную папку
-        with open(src, "wb") as f:
-            f.write(await file.read())
+        if PARSE_IN_MEMORY and len(data) <= PARSE_IN_MEMORY_MAX_MB * 1024 * 1024:
+            src = io.BytesIO(data)
+        else:
+            tmp = tempfile.mkdtemp()
+            src = os.path.join(tmp, filename)
+            with open(src, "wb") as f:
+                f.write(data)
+        del data
+
+        # 2) Разбираем документ на вопросы и извлекаем медиа;
+        # 3) каждый готовый вопрос сразу идёт через пайплайн, пока остальные
+        # части ещё конвертируются
+        previous = await asyncio.to_thread(load_previous, docname, digest)
+        by_number: dict[int, dict] = {}
+        reused = 0
+        # Пайплайн (регулярные выражения) — в потоке, пачками из вопросов,
+        # готовых к моменту, когда поток освободился
+        pending: list[dict] = []
+        batches: list[asyncio.Future] = []
+
+        def run_pipeline(batch: list[dict]) -> list[tuple[dict, bool]]:
+            return [pipeline_state(raw_item, previous, kind, pipeline) for raw_item in batch]
+
+        async def drain() -> None:
+            nonlocal reused
+            while pending:
+                batch = pending[:]
+                pending.clear()
+                for raw_item, (state, was_reused) in zip(batch, await asyncio.to_thread(run_pipeline, batch)):
+                    reused += was_reused
+                    by_number[raw_item["number"]] = state
+
+        def on_question(raw_item: dict) -> None:
+            pending.append(raw_item)
+            if not batches or batches[-1].done():
+                batches.append(asyncio.ensure_future(drain()))
 
-        # 2) Разбираем документ на вопросы и извлекаем медиа
         try:
-            raw_list = split_questions_logic(src)
-
-            # Перемещаем извлечённые изображения в static/img/<docname>
-            media_dir = os.path.join(tmp, "media")
-            target_img_dir = os.path.join(IMG_DIR, docname)
-            os.makedirs(target_img_dir, exist_ok=True)
-
-            if os.path.isdir(media_dir):
-                for root, _, files in os.walk(media_dir):
-                    for fname in files:
-                        src_img = os.path.join(root, fname)
-                        fname_clean = fname.replace(' ', '_')
-                        dst_img = os.path.join(target_img_dir, fname_clean)
-                        shutil.copy2(src_img, dst_img)
-
+            with span("split_questions_logic"), media_store.pin(docname):
+                try:
+                    raw_list = await split_questions_logic_async(src, previous, docname, on_question)
+                    await asyncio.gather(*batches)
+                except BaseException:
+                    for batch in batches:
+                        batch.cancel()
+                    await asyncio.gather(*batches, return_exceptions=True)
+                    raise
+        except subproc.Cancelled:
+            raise
         except Exception as e:
             logger.error("Ошибка при split_questions_logic: %s", e)
             raise HTTPException(status_code=400, detail=str(e))
+        states = [by_number[raw_item["number"]] for raw_item in raw_list]
+        logger.info("Инкрементальный разбор: переиспользовано %d из %d вопросов", reused, len(raw_list))
+
+        subproc.check_cancelled()
+        # В прошлый разбор — только локальные состояния: дополненные GPT
+        # хранятся в parse_cache отдельно и в mode=local не попадают
+        with span("save_result"):
+            await asyncio.to_thread(save_result, docname, digest, raw_list, states, kind, previous)
+        if mode == "hybrid":
+            with span("hybrid", questions=len(states)):
+                states = await repair_states(src, raw_list, states, kind)
+        return states
 
-        # 3) Прогоним через пайплайн для multiple choice
-        states = [pipeline_mcq(raw_item) for raw_item in raw_list]
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
 
-        # 4) Собираем итоговые строки
-        subject = {"name": subject_name, "namekz": subject_namekz}
-        db_rows = build_rows_with_placeholders(states, subject, language, klass, tip)
 
-        # 5) Чистим LaTeX/математические выражения
+@app.post("/split-multiple-choice-questions/", tags=["Python Parser"])
+async def split_questions_api(
+    request: Request,
+    file: UploadFile = File(...),
+    subject_name: str = Form(..., description="Название предмета"),
+    subject_namekz: str = Form(..., description="Название предмета на казахском"),
+    language: str = Form("рус", description="Язык задания"),
+    klass: str = Form(..., description="Класс, например '10 ЕМН'"),
+    tip: int = Form(1, description="Тип задания (целое число)"),
+    export: str = Form("json", description="Формат ответа: json, sqlite, csv или parquet"),
+    mode: str = Form("local", description="local — только локальный разбор; hybrid — нераспознанные вопросы дораспознаёт GPT"),
+    extra_fields: bool = Form(False, description="Добавить в строки поля question_type и duplicates"),
+):
+    check_export(export)
+    states = await parse_upload(request, file, "mcq", pipeline_mcq, mode)
+
+    # 4) Собираем итоговые строки и 5) чистим математические выражения
+    subject = {"name": subject_name, "namekz": subject_namekz}
+    with span("build_rows"):
+        db_rows = build_rows(states, subject, language, klass, tip, "mcq")
         for row in db_rows:
-            row["vopros"] = clean_math_and_sub(row.get("vopros", ""))
-            row["exp"] = clean_math_and_sub(row.get("exp", ""))
-            row["otvety"] = [clean_math_and_sub(opt) for opt in row.get("otvety", [])]
+            clean_row(row)
 
-        return {"questions": db_rows}
+    return await questions_response(db_rows, export, file.filename, None if extra_fields else LEGACY_FIELDS)
 
-    finally:
-        shutil.rmtree(tmp, ignore_errors=True)
 
 @app.post("/split-matching-questions/", tags=["Python Parser"])
-async def split_questions_api(
+async def split_matching_questions_api(
+    request: Request,
     file: UploadFile = File(...),
     subject_name: str = Form(..., description="Название предмета"),
     subject_namekz: str = Form(..., description="Название предмета на казахском"),
     language: str = Form("рус", description="Язык задания"),
     klass: str = Form(..., description="Класс, например '10 ЕМН'"),
-    tip: int = Form(1, description="Тип задания (целое число)")
+    tip: int = Form(1, description="Тип задания (целое число)"),
+    export: str = Form("json", description="Формат ответа: json, sqlite, csv или parquet"),
+    extra_fields: bool = Form(False, description="Добавить в строки поля question_type и duplicates"),
 ):
-    tmp = tempfile.mkdtemp()
-    filename = (file.filename or "input.docx").replace(' ', '_')
-    src = os.path.join(tmp, filename)
-    docname = os.path.splitext(filename)[0]
-    try:
-        # 1) Сохраняем загруженный .docx во временную папку
-        with open(src, "wb") as f:
-            f.write(await file.read())
-
-        # 2) Разбираем документ на вопросы и извлекаем медиа
-        try:
-            raw_list = split_questions_logic(src)
-
-            # Перемещаем все извлечённые Pandoc'ом медиа-файлы в static/img/<docname>
-            media_dir = os.path.join(tmp, "media")
-            target_img_dir = os.path.join(IMG_DIR, docname)
-            os.makedirs(target_img_dir, exist_ok=True)
-
-            if os.path.isdir(media_dir):
-                for root, _, files in os.walk(media_dir):
-                    for fname in files:
-                        src_img = os.path.join(root, fname)
-                        fname_clean = fname.replace(' ', '_')
-                        dst_img = os.path.join(target_img_dir, fname_clean)
-                        shutil.copy2(src_img, dst_img)
+    check_export(export)
+    states = await parse_upload(request, file, "matching", pipeline_matching)
 
-        except Exception as e:
-            logger.error("Ошибка при split_questions_logic: %s", e)
-            raise HTTPException(status_code=400, detail=str(e))
+    # 4) Собираем итоговые строки и 5) чистим математические выражения
+    subject = {"name": subject_name, "namekz": subject_namekz}
+    with span("build_rows"):
+        db_rows = build_rows(states, subject, language, klass, tip, "matching")
+        for row in db_rows:
+            clean_row(row)
 
-        # 3) Прогоним через нашу ML-пайплайн логику
-        states = [pipeline_matching(raw_item) for raw_item in raw_list]
+    return await questions_response(db_rows, export, file.filename, None if extra_fields else LEGACY_FIELDS)
 
-        # 4) Собираем итоговые строки
-        subject = {"name": subject_name, "namekz": subject_namekz}
-        db_rows = build_rows_with_placeholders(states, subject, language, klass, tip)
 
-        # 5) Чистим математические выражения
+@app.post("/split-questions/", tags=["Python Parser"])
+async def split_mixed_questions_api(
+    request: Request,
+    file: UploadFile = File(...),
+    subject_name: str = Form(..., description="Название предмета"),
+    subject_namekz: str = Form(..., description="Название предмета на казахском"),
+    language: str = Form("рус", description="Язык задания"),
+    klass: str = Form(..., description="Класс, например '10 ЕМН'"),
+    tip: int = Form(1, description="Тип задания (целое число)"),
+    export: str = Form("json", description="Формат ответа: json, sqlite, csv или parquet"),
+    mode: str = Form("local", description="local — только локальный разбор; hybrid — нераспознанные MCQ-вопросы дораспознаёт GPT")
+):
+    """
+    Документ с заданиями разных типов: тип каждого вопроса (mcq/matching)
+    определяется автоматически и возвращается в поле question_type.
+    """
+    check_export(export)
+    states = await parse_upload(request, file, "auto", pipeline_auto, mode)
+
+    subject = {"name": subject_name, "namekz": subject_namekz}
+    with span("build_rows"):
+        db_rows = build_rows(states, subject, language, klass, tip)
         for row in db_rows:
-            row["vopros"] = clean_math_and_sub(row.get("vopros", ""))
-            row["exp"]    = clean_math_and_sub(row.get("exp", ""))
-            for group_name, opts in row.get("otvety", {}).items():
-                for key, val in list(opts.items()):
-                    opts[key] = clean_math_and_sub(val)
+            clean_row(row)
 
-        return {"questions": db_rows}
-
-    finally:
-        shutil.rmtree(tmp, ignore_errors=True)
\ No newline at end of file
+    return await questions_response(db_rows, export, file.filename)
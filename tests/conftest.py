@@ -0,0 +1,28 @@
+"""
+Общая настройка тестов: данные сервиса — во временном каталоге, pandoc и
+LibreOffice — заглушки из loadtest/fakes (без задержки).
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["PATH"] = os.path.join(ROOT, "loadtest", "fakes") + os.pathsep + os.environ.get("PATH", "")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="import-sor-tests-"))
+os.environ["FAKE_PANDOC_LATENCY"] = "0"
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def img_dir(tmp_path, monkeypatch):
+    """static/img во временном каталоге."""
+    from app import auto_parser, media_store
+
+    path = tmp_path / "img"
+    path.mkdir()
+    monkeypatch.setattr(auto_parser, "IMG_DIR", str(path))
+    monkeypatch.setattr(media_store, "IMG_DIR", str(path))
+    monkeypatch.setattr(media_store, "MEDIA_MANIFEST_DIR", str(tmp_path / "manifests"))
+    return path
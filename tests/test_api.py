@@ -0,0 +1,64 @@
+import asyncio
+import io
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from loadtest.run import FORM, generate_docx
+
+
+@pytest.fixture
+def client(img_dir):
+    return TestClient(main.app)
+
+
+def _upload(path) -> dict:
+    with open(path, "rb") as f:
+        return {"file": ("export.docx", f.read())}
+
+
+@pytest.mark.parametrize("endpoint", ["/split-multiple-choice-questions/", "/split-matching-questions/",
+                                      "/split-questions/"])
+def test_unknown_export_rejected_before_parsing(client, monkeypatch, tmp_path, endpoint):
+    async def parse_upload(*args, **kwargs):
+        raise AssertionError("документ не должен разбираться")
+
+    monkeypatch.setattr(main, "parse_upload", parse_upload)
+    resp = client.post(endpoint, files=_upload(generate_docx(str(tmp_path / "a.docx"), 1, 0)),
+                       data={**FORM, "export": "xml"})
+    assert resp.status_code == 400
+    assert "xml" in resp.json()["detail"]
+
+
+def test_csv_export(client, tmp_path):
+    resp = client.post("/split-questions/", files=_upload(generate_docx(str(tmp_path / "a.docx"), 3, 0)),
+                       data={**FORM, "export": "csv"})
+    assert resp.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(resp.content)) as zf:
+        assert "questions.csv" in zf.namelist()
+
+
+def test_pipeline_runs_off_event_loop(client, monkeypatch, tmp_path):
+    from app import incremental
+    from app.parse_cache import ParseCache
+
+    on_loop = []
+    pipeline_auto = main.pipeline_auto
+
+    def pipeline(raw_item):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(raw_item["number"])
+        except RuntimeError:
+            pass
+        return pipeline_auto(raw_item)
+
+    monkeypatch.setattr(incremental, "parse_cache", ParseCache(0))
+    monkeypatch.setattr(main, "pipeline_auto", pipeline)
+    resp = client.post("/split-questions/", files=_upload(generate_docx(str(tmp_path / "b.docx"), 5, 1)),
+                       data=FORM)
+    assert resp.status_code == 200
+    assert len(resp.json()["questions"]) == 5
+    assert on_loop == []
@@ -0,0 +1,14 @@
+from app.conversion_cache import ConversionCache
+
+
+def _disk_size(root) -> int:
+    return sum(p.stat().st_size for p in root.rglob("*") if p.is_file())
+
+
+def test_limit_is_shared_between_workers(tmp_path):
+    # Два воркера с общим каталогом: каждый видит записи другого при пересчёте
+    workers = [ConversionCache(str(tmp_path), 1000), ConversionCache(str(tmp_path), 1000)]
+    for i in range(40):
+        workers[i % 2].put(ConversionCache.key(bytes([i])), b"x" * 100)
+        assert _disk_size(tmp_path) <= 1000 * (1 + 0.1 * len(workers)) + 100
+    assert sum(w.evictions for w in workers) > 0
@@ -0,0 +1,21 @@
+from app.gpt import _split_by_task
+
+
+def test_split_by_task_uses_task_index():
+    questions = [{"task_index": 2, "question": "b"}, {"task_index": "1", "question": "a"}]
+    assert _split_by_task(questions, 2) == [[{"question": "a"}], [{"question": "b"}]]
+
+
+def test_split_by_task_without_indexes_needs_one_question_per_task():
+    assert _split_by_task([{"question": "a"}, {"question": "b"}], 2) == [[{"question": "a"}], [{"question": "b"}]]
+    assert _split_by_task([{"question": "a"}], 2) is None
+
+
+def test_split_by_task_fills_remaining_tasks_in_order():
+    questions = [{"question": "a"}, {"task_index": 2, "question": "b"}, {"question": "c"}]
+    assert _split_by_task(questions, 3) == [[{"question": "a"}], [{"question": "b"}], [{"question": "c"}]]
+
+
+def test_split_by_task_does_not_drop_unmatched_questions():
+    questions = [{"task_index": 1, "question": "a"}, {"task_index": 9, "question": "b"}, {"question": "c"}]
+    assert _split_by_task(questions, 2) is None
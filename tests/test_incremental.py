@@ -0,0 +1,153 @@
+import io
+
+import pytest
+from docx import Document
+from PIL import Image
+
+from app import auto_parser, incremental, media
+from app.parse_cache import ParseCache
+
+DOC = "stale"
+
+
+def _png(color: str) -> io.BytesIO:
+    buf = io.BytesIO()
+    Image.new("RGB", (40, 40), color).save(buf, "PNG")
+    buf.seek(0)
+    return buf
+
+
+def _docx(path, pictures: dict) -> str:
+    """Три задания; pictures — {номер задания: цвет картинки}."""
+    doc = Document()
+    for n in range(1, 4):
+        doc.add_paragraph(f"{n} задание")
+        doc.add_paragraph(f"Текст вопроса {n}")
+        if n in pictures:
+            doc.add_picture(_png(pictures[n]))
+    doc.save(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch, img_dir):
+    monkeypatch.setattr(incremental, "PARSE_STATE_DIR", str(tmp_path / "parsed"))
+    monkeypatch.setattr(auto_parser, "parse_cache", ParseCache(100))
+    return tmp_path
+
+
+def _parse(path: str, kind: str = "mcq", docname: str = DOC) -> list[dict]:
+    with open(path, "rb") as f:
+        digest = incremental.content_digest(f.read())
+    previous = incremental.load_previous(docname, digest)
+    raw_list = auto_parser.split_questions_logic(path, previous, docname)
+    states = [incremental.pipeline_state(raw, previous, kind, lambda r: {"text": r["text"]})[0]
+              for raw in raw_list]
+    incremental.save_result(docname, digest, raw_list, states, kind, previous)
+    return raw_list, states
+
+
+def _color(img_dir, text: str) -> tuple:
+    url = text.split("](", 1)[1].split(")", 1)[0]
+    assert url.startswith(f"/img/{DOC}/")
+    with Image.open(img_dir / DOC / url.rsplit("/", 1)[1]) as img:
+        return img.convert("RGB").getpixel((20, 20))
+
+
+def _is(rgb: tuple, color: str) -> bool:
+    r, g, b = rgb
+    return {"red": r > 200 and g < 60 and b < 60, "blue": b > 200 and r < 60 and g < 60}[color]
+
+
+def test_renumbered_image_gets_current_url(state_dir, img_dir, monkeypatch):
+    (state_dir / "v1").mkdir()
+    (state_dir / "v2").mkdir()
+    raw_v1, _ = _parse(_docx(state_dir / "v1" / f"{DOC}.docx", {2: "red"}))
+    assert _is(_color(img_dir, raw_v1[1]["text"]), "red")
+
+    converted = []
+    convert = media.convert_to_jpeg
+    monkeypatch.setattr(media, "convert_to_jpeg", lambda p: converted.append(p) or convert(p))
+
+    # Картинка в первом задании сдвигает нумерацию: красная теперь image2
+    raw_v2, states = _parse(_docx(state_dir / "v2" / f"{DOC}.docx", {1: "blue", 2: "red"}))
+    assert raw_v2[1]["fingerprint"] == raw_v1[1]["fingerprint"]
+    assert raw_v2[1]["text"] != raw_v1[1]["text"]
+    assert _is(_color(img_dir, raw_v2[0]["text"]), "blue")
+    assert _is(_color(img_dir, raw_v2[1]["text"]), "red")
+    # Состояние с прошлой загрузки не годится: ссылка в тексте другая
+    assert states[1]["text"] == raw_v2[1]["text"]
+    # Конвертируется только картинка изменившегося задания
+    assert [p.rsplit("/", 1)[1] for p in converted] == ["image1.png"]
+
+
+def test_unchanged_document_reuses_everything(state_dir, img_dir, monkeypatch):
+    (state_dir / "v1").mkdir()
+    raw_v1, _ = _parse(_docx(state_dir / "v1" / f"{DOC}.docx", {1: "blue", 2: "red"}))
+
+    monkeypatch.setattr(auto_parser, "docx_to_markdown", lambda part: pytest.fail("pandoc не нужен"))
+    monkeypatch.setattr(media, "convert_to_jpeg", lambda p: pytest.fail("конвертация не нужна"))
+    raw_v2, _ = _parse(_docx(state_dir / "v1" / f"{DOC}.docx", {1: "blue", 2: "red"}))
+    assert [r["text"] for r in raw_v2] == [r["text"] for r in raw_v1]
+    assert _is(_color(img_dir, raw_v2[1]["text"]), "red")
+
+
+def test_legacy_state_without_markdown_is_not_reused(state_dir, img_dir):
+    (state_dir / "v1").mkdir()
+    path = _docx(state_dir / "v1" / f"{DOC}.docx", {2: "red"})
+    raw_v1, _ = _parse(path)
+    previous = {raw["fingerprint"]: {"text": "устаревший текст", "states": {"mcq": {"text": "x"}}}
+                for raw in raw_v1}
+    raw_v2 = auto_parser.split_questions_logic(path, previous, DOC)
+    assert [r["text"] for r in raw_v2] == [r["text"] for r in raw_v1]
+    state, _ = incremental.pipeline_state(raw_v2[0], previous, "mcq", lambda r: {"text": r["text"]})
+    assert state == {"text": raw_v2[0]["text"]}
+
+
+def test_async_split_converts_media_alongside_pandoc(state_dir, img_dir, monkeypatch):
+    import asyncio
+    import threading
+
+    (state_dir / "v1").mkdir()
+    path = _docx(state_dir / "v1" / f"{DOC}.docx", {1: "blue", 3: "red"})
+    pandoc_started = threading.Event()
+    overlapped = []
+    convert = media.convert_to_jpeg
+
+    def slow_convert(p):
+        # Конвертация медиа идёт, пока pandoc уже работает
+        overlapped.append(pandoc_started.wait(5))
+        return convert(p)
+
+    async def pandoc(part):
+        pandoc_started.set()
+        return auto_parser.docx_to_markdown(part)
+
+    monkeypatch.setattr(media, "convert_to_jpeg", slow_convert)
+    monkeypatch.setattr(auto_parser, "docx_to_markdown_async", pandoc)
+    seen = []
+    raw_list = asyncio.run(auto_parser.split_questions_logic_async(path, {}, DOC, seen.append))
+    assert overlapped == [True, True]
+    assert sorted(q["number"] for q in seen) == [1, 2, 3]
+    assert _is(_color(img_dir, raw_list[0]["text"]), "blue")
+    assert _is(_color(img_dir, raw_list[2]["text"]), "red")
+
+
+def test_same_name_uploads_keep_separate_states(state_dir, img_dir, monkeypatch):
+    (state_dir / "a").mkdir()
+    (state_dir / "b").mkdir()
+    monkeypatch.setattr(auto_parser, "parse_cache", ParseCache(0))
+    path_a = _docx(state_dir / "a" / f"{DOC}.docx", {2: "red"})
+    _parse(path_a)
+    # Другой файл с тем же именем: его медиа заменяют static/img/<docname>
+    _parse(_docx(state_dir / "b" / f"{DOC}.docx", {1: "blue", 3: "blue"}))
+
+    monkeypatch.setattr(auto_parser, "docx_to_markdown", lambda part: pytest.fail("pandoc не нужен"))
+    raw_a, _ = _parse(path_a)
+    assert _is(_color(img_dir, raw_a[1]["text"]), "red")
+    assert len(list((state_dir / "parsed" / DOC).iterdir())) == 2
+
+
+def test_state_path_stays_inside_state_dir(state_dir):
+    _parse(_docx(state_dir / "doc.docx", {}), docname="a/b c")
+    assert [p.name for p in (state_dir / "parsed").iterdir()] == ["a_b_c"]
@@ -0,0 +1,106 @@
+import re
+import struct
+import zipfile
+
+from docx import Document
+
+from app import auto_parser
+from app.auto_parser import build_rows, clean_math_and_sub, clean_row, pipeline_mcq
+
+DOC = "mathtype"
+_END, _FREE, _FAT_SECT, _NO_STREAM = 0xFFFFFFFE, 0xFFFFFFFF, 0xFFFFFFFD, 0xFFFFFFFF
+
+
+def _char(ch: str, typeface: int = 3) -> bytes:
+    return bytes([2, 0, 128 + typeface]) + struct.pack("<H", ord(ch))
+
+
+def _line(*items: bytes) -> bytes:
+    return bytes([1, 0]) + b"".join(items) + b"\0"
+
+
+def _tmpl(selector: int, *lines: bytes) -> bytes:
+    return bytes([3, 0, selector, 0, 0]) + b"".join(lines) + b"\0"
+
+
+def _mtef() -> bytes:
+    """MTEF v5 формулы 1/2 + √x."""
+    header = bytes([5, 1, 0, 6, 0]) + b"DSMT6\0" + b"\0"
+    return header + _line(_tmpl(11, _line(_char("1", 8)), _line(_char("2", 8))),
+                          _char("+", 6), _tmpl(10, _line(_char("x")), bytes([1, 1])))
+
+
+def _dir_entry(name: str, kind: int, child: int, start: int, size: int) -> bytes:
+    raw = name.encode("utf-16-le") + b"\0\0" if name else b""
+    return (raw.ljust(64, b"\0") + struct.pack("<HBB3I", len(raw), kind, 1, _NO_STREAM, _NO_STREAM, child)
+            + bytes(36) + struct.pack("<IQ", start, size))
+
+
+def _ole(stream: bytes) -> bytes:
+    """Составной файл OLE с одним потоком Equation Native (без mini-потока)."""
+    stream = stream.ljust(max(4096, -(-len(stream) // 512) * 512), b"\0")
+    count = len(stream) // 512
+    header = (bytes.fromhex("D0CF11E0A1B11AE1") + bytes(16)
+              + struct.pack("<HHHHH6xIIIIIIIII", 0x3E, 3, 0xFFFE, 9, 6, 0, 1, 1, 0, 4096, _END, 0, _END, 0)
+              + struct.pack("<109I", 0, *[_FREE] * 108))
+    fat = [_FAT_SECT, _END] + [i + 1 for i in range(2, count + 1)] + [_END]
+    fat_sector = struct.pack("<128I", *fat, *[_FREE] * (128 - len(fat)))
+    directory = (_dir_entry("Root Entry", 5, 1, _END, 0)
+                 + _dir_entry("Equation Native", 2, _NO_STREAM, 2, len(stream))
+                 + _dir_entry("", 0, _NO_STREAM, 0, 0) * 2)
+    return header + fat_sector + directory + stream
+
+
+def _equation_docx(path) -> str:
+    doc = Document()
+    doc.add_paragraph("1 задание")
+    doc.add_paragraph("Вычислите ").add_run("@@EQ@@")
+    for letter, value in zip("ABCD", ("1", "2", "3", "4")):
+        doc.add_paragraph(f"{letter}) {value}")
+    doc.add_paragraph("Правильный ответ: A")
+    doc.save(str(path))
+
+    mtef = _mtef()
+    native = struct.pack("<HIHI16x", 28, 0x00020000, 0xC1C6, len(mtef)) + mtef
+    obj = ('<w:r><w:object><v:shape id="_x0000_i1025" type="#_x0000_t75" style="width:30pt;height:20pt">'
+           '<v:imagedata r:id="rIdEqImg" o:title=""/></v:shape>'
+           '<o:OLEObject Type="Embed" ProgID="Equation.DSMT4" ShapeID="_x0000_i1025" '
+           'DrawAspect="Content" ObjectID="_1" r:id="rIdEqOle"/></w:object></w:r>')
+    rels = ('<Relationship Id="rIdEqImg" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/image" Target="media/image1.wmf"/>'
+            '<Relationship Id="rIdEqOle" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/oleObject" Target="embeddings/oleObject1.bin"/>')
+    with zipfile.ZipFile(str(path)) as zin:
+        members = {name: zin.read(name) for name in zin.namelist()}
+    xml = members["word/document.xml"].decode("utf-8")
+    xml = re.sub(r"<w:r>(?:(?!<w:r>).)*?@@EQ@@</w:t></w:r>", obj, xml, flags=re.S)
+    if "xmlns:v=" not in xml:
+        xml = xml.replace("<w:document ", '<w:document xmlns:v="urn:schemas-microsoft-com:vml" ', 1)
+    if "xmlns:o=" not in xml:
+        xml = xml.replace("<w:document ", '<w:document xmlns:o="urn:schemas-microsoft-com:office:office" ', 1)
+    members["word/document.xml"] = xml.encode("utf-8")
+    members["word/_rels/document.xml.rels"] = members["word/_rels/document.xml.rels"].replace(
+        b"</Relationships>", rels.encode() + b"</Relationships>")
+    members["[Content_Types].xml"] = members["[Content_Types].xml"].replace(
+        b"</Types>", b'<Default Extension="wmf" ContentType="image/x-wmf"/>'
+                     b'<Default Extension="bin" ContentType="application/vnd.openxmlformats-'
+                     b'officedocument.oleObject"/></Types>')
+    members["word/media/image1.wmf"] = b"\xd7\xcd\xc6\x9a" + bytes(40)
+    members["word/embeddings/oleObject1.bin"] = _ole(native)
+    with zipfile.ZipFile(str(path), "w", zipfile.ZIP_DEFLATED) as zout:
+        for name, data in members.items():
+            zout.writestr(name, data)
+    return str(path)
+
+
+def test_clean_keeps_latex_backslashes():
+    assert clean_math_and_sub(r"$\frac{1}{2}+\sqrt{x}$ и \[0; 1\] x^2^") == r"$\frac{1}{2}+\sqrt{x}$ и [0; 1] x^2"
+    assert clean_math_and_sub(r"$$\alpha$$ стоит 5\$") == r"$$\alpha$$ стоит 5$"
+
+
+def test_ole_equation_survives_clean_row(tmp_path, img_dir):
+    raw_list = auto_parser.split_questions_logic(_equation_docx(tmp_path / "eq.docx"), None, DOC)
+    rows = build_rows([pipeline_mcq(raw) for raw in raw_list], {}, "ru", "11", 1, "mcq")
+    row = clean_row(rows[0])
+    assert r"$\frac{1}{2}+\sqrt{x}$" in row.vopros
+    assert "/img/" not in row.vopros
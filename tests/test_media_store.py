@@ -0,0 +1,125 @@
+import os
+import time
+
+import pytest
+
+from app import media_store
+
+DAY = 86400
+
+
+@pytest.fixture
+def store(img_dir, monkeypatch):
+    monkeypatch.setattr(media_store, "MEDIA_QUOTA_MB", 0)
+    monkeypatch.setattr(media_store, "MEDIA_TTL_DAYS", 0)
+    monkeypatch.setattr(media_store, "_used", {})
+    return img_dir
+
+
+def _files(img_dir, docname: str, sizes: dict) -> None:
+    (img_dir / docname).mkdir(exist_ok=True)
+    for name, size in sizes.items():
+        (img_dir / docname / name).write_bytes(b"x" * size)
+
+
+def _age(img_dir, docname: str, seconds: float) -> None:
+    """Сдвигает mtime каталога и файлов, а также время использования в манифесте."""
+    past = time.time() - seconds
+    for entry in os.scandir(img_dir / docname):
+        os.utime(entry.path, (past, past))
+    os.utime(img_dir / docname, (past, past))
+    manifest = media_store.read_manifest(docname)
+    if manifest is not None:
+        manifest["used"] = manifest["updated"] = past
+        media_store._write_manifest(docname, manifest)
+
+
+def test_commit_keeps_written_and_linked_files(store):
+    _files(store, "doc", {"image1.jpg": 10, "image2.jpg": 20, "image3.jpg": 30, "old.jpg": 40})
+    media_store.commit("doc", ["Вопрос ![](/img/doc/image1.jpg)", "![](/img/other/image3.jpg)"],
+                       ["/img/doc/image2.jpg", "/img/doc/missing.jpg"])
+    assert sorted(os.listdir(store / "doc")) == ["image1.jpg", "image2.jpg"]
+    manifest = media_store.read_manifest("doc")
+    assert manifest["files"] == {"image1.jpg": 10, "image2.jpg": 20}
+    assert manifest["bytes"] == 30
+
+
+def test_commit_without_directory_writes_empty_manifest(store):
+    media_store.commit("nodir", [], [])
+    assert media_store.read_manifest("nodir")["files"] == {}
+
+
+def test_collect_keeps_documents_without_ttl_or_quota(store):
+    _files(store, "doc", {"image1.jpg": 10})
+    media_store.commit("doc", [], ["/img/doc/image1.jpg"])
+    _age(store, "doc", 365 * DAY)
+    assert media_store.collect()["evicted"] == 0
+    assert os.listdir(store / "doc") == ["image1.jpg"]
+
+
+def test_collect_expires_unused_documents(store, monkeypatch):
+    monkeypatch.setattr(media_store, "MEDIA_TTL_DAYS", 30)
+    for docname in ("fresh", "stale", "pinned"):
+        _files(store, docname, {"image1.jpg": 10})
+        media_store.commit(docname, [], [f"/img/{docname}/image1.jpg"])
+    _age(store, "stale", 31 * DAY)
+    _age(store, "pinned", 31 * DAY)
+    with media_store.pin("pinned"):
+        result = media_store.collect()
+    assert result["evicted"] == 1
+    assert sorted(os.listdir(store)) == ["fresh", "pinned"]
+    assert media_store.read_manifest("stale") is None
+
+
+def test_collect_touch_extends_lifetime(store, monkeypatch):
+    monkeypatch.setattr(media_store, "MEDIA_TTL_DAYS", 30)
+    _files(store, "doc", {"image1.jpg": 10})
+    media_store.commit("doc", [], ["/img/doc/image1.jpg"])
+    _age(store, "doc", 31 * DAY)
+    media_store.touch("doc")
+    assert media_store.collect()["evicted"] == 0
+    assert media_store.read_manifest("doc")["used"] > time.time() - 60
+
+
+def test_collect_evicts_least_recently_used_over_quota(store, monkeypatch):
+    monkeypatch.setattr(media_store, "MEDIA_QUOTA_MB", 1)
+    mb = 1024 * 1024
+    for i, docname in enumerate(("oldest", "older", "newest")):
+        _files(store, docname, {"image1.jpg": mb // 2})
+        media_store.commit(docname, [], [f"/img/{docname}/image1.jpg"])
+        _age(store, docname, (3 - i) * 3600)
+    result = media_store.collect()
+    # 1.5 МБ при квоте 1 МБ: удаляются давние, пока объём не станет ≤ 90% квоты
+    assert result["evicted"] == 2
+    assert os.listdir(store) == ["newest"]
+    assert result["bytes"] == mb // 2
+
+
+def test_collect_spares_recently_changed_directories(store, monkeypatch):
+    monkeypatch.setattr(media_store, "MEDIA_QUOTA_MB", 1)
+    _files(store, "busy", {"image1.jpg": 2 * 1024 * 1024})
+    media_store.commit("busy", [], ["/img/busy/image1.jpg"])
+    assert media_store.collect()["evicted"] == 0
+    assert os.listdir(store / "busy") == ["image1.jpg"]
+
+
+def test_collect_keeps_legacy_directory_without_manifest(store, monkeypatch):
+    monkeypatch.setattr(media_store, "MEDIA_TTL_DAYS", 30)
+    monkeypatch.setattr(media_store, "MEDIA_QUOTA_MB", 1)
+    _files(store, "legacy", {"image1.jpg": 2 * 1024 * 1024, "image2.jpg": 10})
+    _age(store, "legacy", 365 * DAY)
+    result = media_store.collect()
+    assert result["evicted"] == 0 and result["documents"] == 0
+    assert sorted(os.listdir(store / "legacy")) == ["image1.jpg", "image2.jpg"]
+
+
+def test_collect_drops_only_unlisted_files(store):
+    _files(store, "legacy", {"image1.jpg": 10})
+    _age(store, "legacy", 31 * DAY)
+    _files(store, "doc", {"image1.jpg": 10, "leftover.jpg": 10})
+    media_store.commit("doc", [], ["/img/doc/image1.jpg"])
+    (store / "doc" / "leftover.jpg").write_bytes(b"x" * 10)
+    _age(store, "doc", 3600)
+    assert media_store.collect()["evicted"] == 0
+    assert sorted(os.listdir(store)) == ["doc", "legacy"]
+    assert os.listdir(store / "doc") == ["image1.jpg"]
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from app.memory import MemoryBudget, MemoryLimitExceeded, MemoryQueueTimeout
+
+
+def test_over_budget_is_rejected_at_once():
+    async def scenario():
+        budget = MemoryBudget(100)
+        with pytest.raises(MemoryLimitExceeded):
+            await budget.acquire(101, timeout=5)
+        assert budget.free == 100
+
+    asyncio.run(scenario())
+
+
+def test_waiters_are_served_in_arrival_order():
+    async def scenario():
+        budget = MemoryBudget(100)
+        await budget.acquire(60, timeout=1)
+        order = []
+
+        async def waiter(name, need):
+            await budget.acquire(need, timeout=5)
+            order.append(name)
+
+        big = asyncio.ensure_future(waiter("big", 80))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(waiter("small", 10))
+        await asyncio.sleep(0.01)
+        # 40 свободно, но мелкий запрос не обгоняет крупный
+        assert order == [] and budget.free == 40
+        budget.release(60)
+        await asyncio.gather(big, small)
+        assert order == ["big", "small"]
+        assert budget.free == 10
+        budget.release(80)
+        budget.release(10)
+        assert budget.free == 100 and budget.stats()["waiting"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_timeout_leaves_no_reservation_and_wakes_next():
+    async def scenario():
+        budget = MemoryBudget(100)
+        await budget.acquire(50, timeout=1)
+        with pytest.raises(MemoryQueueTimeout):
+            await budget.acquire(80, timeout=0.02)
+        assert budget.free == 50 and budget.stats()["waiting"] == 0
+        # Следующий запрос не ждёт ушедшего по таймауту
+        await budget.acquire(40, timeout=0.02)
+        assert budget.free == 10
+
+    asyncio.run(scenario())
+
+
+def test_timed_out_head_unblocks_smaller_waiters():
+    async def scenario():
+        budget = MemoryBudget(100)
+        await budget.acquire(50, timeout=1)
+        big = asyncio.ensure_future(budget.acquire(80, timeout=0.05))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(budget.acquire(30, timeout=1))
+        with pytest.raises(MemoryQueueTimeout):
+            await big
+        await small
+        assert budget.free == 20
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_is_removed():
+    async def scenario():
+        budget = MemoryBudget(100)
+        await budget.acquire(90, timeout=1)
+        task = asyncio.ensure_future(budget.acquire(50, timeout=5))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert budget.stats()["waiting"] == 0
+        budget.release(90)
+        assert budget.free == 100
+
+    asyncio.run(scenario())
+
+
+def test_grant_racing_with_cancel_is_returned():
+    async def scenario():
+        budget = MemoryBudget(100)
+        await budget.acquire(90, timeout=1)
+        task = asyncio.ensure_future(budget.acquire(50, timeout=5))
+        await asyncio.sleep(0.01)
+        # Бюджет выдан, но задача отменена раньше, чем успела проснуться
+        budget.release(90)
+        assert budget.free == 50
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert budget.free == 100 and budget.stats()["waiting"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from app.resilience import CircuitBreaker, GuardedEndpoint, ServiceUnavailable
+
+COOLDOWN = 0.05
+
+
+def _endpoint() -> GuardedEndpoint:
+    return GuardedEndpoint("test", deadline=5, hedge_percentile=0, hedge_min_delay=0,
+                           breaker_failures=2, breaker_cooldown=COOLDOWN)
+
+
+async def _fail():
+    raise RuntimeError("boom")
+
+
+async def _ok():
+    return "ok"
+
+
+async def _open(endpoint: GuardedEndpoint) -> None:
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailable):
+            await endpoint.call(_fail)
+    assert endpoint.breaker.state == "open"
+    assert not endpoint.available()
+    with pytest.raises(ServiceUnavailable, match="разомкнут"):
+        await endpoint.call(_ok)
+    await asyncio.sleep(COOLDOWN * 1.5)
+
+
+def test_breaker_opens_and_probe_success_closes():
+    async def scenario():
+        endpoint = _endpoint()
+        await _open(endpoint)
+        assert endpoint.breaker.state == "half_open" and endpoint.available()
+        assert await endpoint.call(_ok) == "ok"
+        assert endpoint.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_failed_probe_reopens():
+    async def scenario():
+        endpoint = _endpoint()
+        await _open(endpoint)
+        with pytest.raises(ServiceUnavailable):
+            await endpoint.call(_fail)
+        assert endpoint.breaker.state == "open"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_releases_breaker():
+    async def scenario():
+        endpoint = _endpoint()
+        await _open(endpoint)
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        probe = asyncio.ensure_future(endpoint.call(hang))
+        await started.wait()
+        # Пока проба идёт, другие вызовы отклоняются и hybrid не рендерит зря
+        assert not endpoint.available()
+        with pytest.raises(ServiceUnavailable):
+            await endpoint.call(_ok)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert endpoint.available()
+        assert await endpoint.call(_ok) == "ok"
+        assert endpoint.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_cancel_in_closed_state_is_not_a_failure():
+    async def scenario():
+        endpoint = _endpoint()
+        for _ in range(3):
+            task = asyncio.ensure_future(endpoint.call(lambda: asyncio.sleep(60)))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        assert endpoint.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_ordinary_call_keeps_running_probe():
+    async def scenario():
+        endpoint = _endpoint()
+        slow = asyncio.ensure_future(endpoint.call(lambda: asyncio.sleep(60)))
+        await asyncio.sleep(0)
+        await _open(endpoint)
+        probe = asyncio.ensure_future(endpoint.call(lambda: asyncio.sleep(60)))
+        await asyncio.sleep(0)
+        slow.cancel()
+        await asyncio.gather(slow, return_exceptions=True)
+        assert not endpoint.available()
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        assert endpoint.available()
+
+    asyncio.run(scenario())
+
+
+def test_release_probe_without_probe_is_harmless():
+    breaker = CircuitBreaker("b", failures=1, cooldown=60)
+    breaker.release_probe()
+    assert breaker.allow()
+    breaker.record_failure()
+    breaker.release_probe()
+    assert breaker.state == "open" and not breaker.allow()
@@ -0,0 +1,28 @@
+import json
+
+from app.rows import LEGACY_FIELDS, QuestionRow, dumps_questions
+
+SUBJECT = {"name": "Математика", "namekz": "Математика"}
+
+
+def _rows() -> list[QuestionRow]:
+    row = QuestionRow.from_state({"number": 1, "vopros": "2 + 2", "otvety": ["4", "5"], "pravOtv": [0]},
+                                 SUBJECT, "рус", "10", 1, "mcq")
+    row.duplicates = [{"docname": "old", "id": 3, "vopros": "2 + 2", "similarity": 1.0}]
+    return [row, QuestionRow.placeholder(2, SUBJECT, "рус", "10", 1)]
+
+
+def test_legacy_fields_keep_original_row_shape():
+    payload = json.loads(dumps_questions(_rows(), LEGACY_FIELDS, preview_id="abc"))
+    assert payload["preview_id"] == "abc"
+    for row in payload["questions"]:
+        assert list(row) == list(LEGACY_FIELDS)
+        assert "question_type" not in row and "duplicates" not in row
+
+
+def test_all_fields_by_default():
+    payload = json.loads(dumps_questions(_rows()))
+    first = payload["questions"][0]
+    assert first["question_type"] == "mcq"
+    assert first["duplicates"][0]["docname"] == "old"
+    assert payload["questions"][1]["duplicates"] is None
@@ -0,0 +1,96 @@
+import io
+import re
+import zipfile
+
+from docx import Document
+from docx.shared import Mm
+from lxml import etree
+
+from app.auto_parser import W_NS, split_docx_into_parts
+
+
+def _docx(questions: int = 3, width: int = 148) -> io.BytesIO:
+    doc = Document()
+    section = doc.sections[0]
+    section.page_width, section.page_height = Mm(width), Mm(210)
+    doc.add_paragraph("Вариант 1")
+    for n in range(1, questions + 1):
+        doc.add_paragraph(f"{n} задание")
+        doc.add_paragraph(f"Текст вопроса {n}")
+    buf = io.BytesIO()
+    doc.save(buf)
+    buf.seek(0)
+    return buf
+
+
+def _body(data: bytes):
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        return etree.fromstring(z.read("word/document.xml")).find(W_NS + "body")
+
+
+def test_every_part_keeps_section_properties():
+    parts = split_docx_into_parts(_docx(), None)
+    assert len(parts) == 3
+    for part in parts:
+        body = _body(part["data"])
+        assert body[-1].tag == W_NS + "sectPr"
+        assert body[-1].find(W_NS + "pgSz").get(W_NS + "w") == str(Mm(148).twips)
+        texts = ["".join(p.itertext()) for p in body.iter(W_NS + "p")]
+        assert "Вариант 1" not in texts
+
+
+def test_section_properties_do_not_change_fingerprints():
+    skipped = split_docx_into_parts(_docx(), None, skip=lambda part: True)
+    written = split_docx_into_parts(_docx(width=210), None)
+    assert [p["fingerprint"] for p in skipped] == [p["fingerprint"] for p in written]
+    assert all(p["data"] is None for p in skipped)
+
+
+def _list_docx() -> io.BytesIO:
+    doc = Document()
+    for n in range(1, 3):
+        doc.add_paragraph(f"{n} задание")
+        doc.add_paragraph(f"Пункт вопроса {n}", style="List Number")
+    buf = io.BytesIO()
+    doc.save(buf)
+    buf.seek(0)
+    return buf
+
+
+def _rewrite(buf: io.BytesIO, fix) -> io.BytesIO:
+    """Копия документа, где fix(имя части, xml) правит document, styles и numbering."""
+    out = io.BytesIO()
+    with zipfile.ZipFile(buf) as zin, zipfile.ZipFile(out, "w") as zout:
+        for name in zin.namelist():
+            data = zin.read(name)
+            if name in ("word/document.xml", "word/styles.xml", "word/numbering.xml"):
+                data = fix(name, data.decode("utf-8")).encode("utf-8")
+            zout.writestr(name, data)
+    out.seek(0)
+    return out
+
+
+def _fingerprints(buf: io.BytesIO) -> list[str]:
+    return [p["fingerprint"] for p in split_docx_into_parts(buf, None, skip=lambda part: True)]
+
+
+def test_fingerprint_ignores_local_style_and_numbering_ids():
+    swap = {"5": "1", "1": "5"}
+
+    def renumber(name, xml):
+        xml = xml.replace('"ListNumber"', '"Spisok"')
+        return re.sub(r'(w:numId w:val="|<w:num w:numId=")(\d+)"',
+                      lambda m: m.group(1) + swap.get(m.group(2), m.group(2)) + '"', xml)
+
+    assert _fingerprints(_rewrite(_list_docx(), renumber)) == _fingerprints(_list_docx())
+
+
+def test_fingerprint_follows_numbering_definition():
+    def other_list(name, xml):
+        if name != "word/numbering.xml":
+            return xml
+        return re.sub(r'(<w:num w:numId="5"><w:abstractNumId w:val=")(\d+)"',
+                      lambda m: m.group(1) + ("0" if m.group(2) != "0" else "1") + '"', xml)
+
+    original, changed = _fingerprints(_list_docx()), _fingerprints(_rewrite(_list_docx(), other_list))
+    assert all(a != b for a, b in zip(original, changed))